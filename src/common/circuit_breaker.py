@@ -0,0 +1,231 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import re
+import threading
+import time
+from enum import Enum
+
+from thiscovery_lib.utilities import get_logger
+
+from common.rate_limiting import (
+    HUBSPOT_CRM,
+    HUBSPOT_SINGLE_SEND,
+    RATE_LIMITS,
+    ThrottledError,
+    call_rate_limited,
+)
+
+
+CORE_API = "core-api"
+DOWNSTREAM_DEPENDENCIES = [HUBSPOT_CRM, HUBSPOT_SINGLE_SEND, CORE_API]
+FAILURE_THRESHOLD = 5  # consecutive failures
+RESET_TIMEOUT_SECONDS = 60
+# CoreApiClient asserts on the response, e.g.
+# "Call to core API returned error: {'statusCode': 502, ...}"
+CORE_API_STATUS_CODE_PATTERN = re.compile(
+    r"['\"]statusCode['\"]:\s*(?:<\w+\.\w+:\s*)?(\d+)"
+)
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a dependency whose circuit breaker is open
+    """
+
+    def __init__(self, dependency, retry_after):
+        super().__init__(
+            f"Circuit breaker for {dependency} is open; retry after {retry_after} seconds"
+        )
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class DependencyError(Exception):
+    """
+    Raised instead of an exception that a client library uses for every error
+    response (e.g. the AssertionError raised by CoreApiClient) when that exception
+    reports a server or transport error
+    """
+
+    def __init__(self, dependency, message, status_code=None):
+        super().__init__(message)
+        self.dependency = dependency
+        self.status_code = status_code
+
+
+class CircuitBreaker:
+    """
+    Thread-safe circuit breaker. The circuit opens after failure_threshold
+    consecutive failures and calls are then refused for reset_timeout seconds. After
+    that, a single probe call is let through (half-open state): the circuit closes
+    if it succeeds and opens again if it fails.
+    """
+
+    def __init__(
+        self,
+        dependency,
+        failure_threshold=FAILURE_THRESHOLD,
+        reset_timeout=RESET_TIMEOUT_SECONDS,
+    ):
+        self.dependency = dependency
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.CLOSED
+        self.logger = get_logger()
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.logger.warning(
+                "Circuit breaker state changed",
+                extra={
+                    "dependency": self.dependency,
+                    "from_state": self.state.value,
+                    "to_state": state.value,
+                },
+            )
+            self.state = state
+
+    def before_call(self):
+        """
+        Raises:
+            CircuitOpenError: if the call should not be made
+        """
+        with self._lock:
+            if self.state == CircuitState.CLOSED:
+                return
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if self.state == CircuitState.OPEN and remaining <= 0:
+                self._set_state(CircuitState.HALF_OPEN)
+            if (self.state == CircuitState.HALF_OPEN) and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            raise CircuitOpenError(self.dependency, max(remaining, 1))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._set_state(CircuitState.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self.state == CircuitState.HALF_OPEN) or (
+                self._failures >= self.failure_threshold
+            ):
+                self._opened_at = time.monotonic()
+                self._set_state(CircuitState.OPEN)
+            self._probe_in_flight = False
+
+    def release(self):
+        """
+        Records a call that neither succeeded nor failed (e.g. it was throttled)
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+
+_breakers = dict()
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(dependency):
+    """
+    Returns the CircuitBreaker guarding calls to dependency
+    """
+    with _breakers_lock:
+        try:
+            return _breakers[dependency]
+        except KeyError:
+            breaker = _breakers[dependency] = CircuitBreaker(dependency)
+            return breaker
+
+
+def is_dependency_failure(outcome):
+    """
+    Decides whether the outcome of a call (a response, an HTTP status code or an
+    exception) indicates the dependency is unhealthy. Only network errors and 5xx
+    responses count; other errors are most likely caused by the data we sent.
+    """
+    response = getattr(outcome, "response", outcome)
+    status_code = getattr(response, "status_code", response)
+    if isinstance(status_code, int):
+        return status_code >= 500
+    return isinstance(outcome, (OSError, TimeoutError, DependencyError))
+
+
+def as_dependency_error(dependency, exception):
+    """
+    Converts a core API AssertionError reporting a 5xx response, or no response at
+    all, into a DependencyError. Returns None for any other exception, including
+    core API 4xx responses (e.g. user not found), which callers handle as before.
+    """
+    if (dependency != CORE_API) or not isinstance(exception, AssertionError):
+        return None
+    match = CORE_API_STATUS_CODE_PATTERN.search(str(exception))
+    status_code = int(match.group(1)) if match else None
+    if (status_code is not None) and (status_code < 500):
+        return None
+    return DependencyError(dependency, str(exception), status_code=status_code)
+
+
+def call_downstream(dependency, fn, *args, **kwargs):
+    """
+    Calls fn(*args, **kwargs) through the circuit breaker of dependency and, if the
+    dependency is rate limited, through its rate limiter
+
+    Raises:
+        CircuitOpenError: if the circuit breaker of dependency is open
+        ThrottledError: if the call was throttled on every attempt
+        DependencyError: if the core API responded with a server error
+    """
+    breaker = get_circuit_breaker(dependency)
+    breaker.before_call()
+    try:
+        if dependency in RATE_LIMITS:
+            result = call_rate_limited(dependency, fn, *args, **kwargs)
+        else:
+            result = fn(*args, **kwargs)
+    except ThrottledError:
+        breaker.release()
+        raise
+    except Exception as ex:
+        dependency_error = as_dependency_error(dependency, ex)
+        if dependency_error is not None:
+            breaker.record_failure()
+            raise dependency_error from ex
+        if is_dependency_failure(ex):
+            breaker.record_failure()
+        else:
+            breaker.release()
+        raise
+    if is_dependency_failure(result):
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return result
@@ -0,0 +1,101 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import threading
+from contextlib import contextmanager
+
+from thiscovery_lib.core_api_utilities import CoreApiClient
+from thiscovery_lib.dynamodb_utilities import Dynamodb
+from thiscovery_lib.hubspot_utilities import HubSpotClient, SingleSendClient
+
+import common.constants as const
+
+
+DYNAMODB_CLIENT = "dynamodb"
+HUBSPOT_CLIENT = "hubspot"
+SINGLE_SEND_CLIENT = "single-send"
+CORE_API_CLIENT = "core-api"
+
+
+def new_client(kind, stack_name):
+    if kind == DYNAMODB_CLIENT:
+        return Dynamodb(stack_name=stack_name)
+    if kind == HUBSPOT_CLIENT:
+        return HubSpotClient(stack_name=stack_name)
+    if kind == SINGLE_SEND_CLIENT:
+        return SingleSendClient(stack_name=stack_name)
+    if kind == CORE_API_CLIENT:
+        return CoreApiClient()
+    raise ValueError(f"Unknown client kind: {kind}")
+
+
+class ClientRegistry:
+    """
+    Pool of thiscovery_lib clients, keyed by client kind and stack name, so that
+    boto3 sessions are not built and secrets not fetched again for every
+    notification.
+
+    thiscovery_lib clients are not guaranteed to be thread-safe and log the
+    correlation id they hold, so a client is checked out by a single thread at a
+    time and given the caller's correlation id for as long as it is checked out.
+    """
+
+    def __init__(self):
+        self._idle = dict()  # (kind, stack_name) -> list of idle clients
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def checkout(self, kind, stack_name=const.STACK_NAME, correlation_id=None):
+        key = (kind, stack_name)
+        with self._lock:
+            idle = self._idle.setdefault(key, list())
+            client = idle.pop() if idle else None
+        if client is None:
+            client = new_client(kind, stack_name)
+        client.correlation_id = correlation_id
+        try:
+            yield client
+        finally:
+            client.correlation_id = None
+            with self._lock:
+                self._idle[key].append(client)
+
+    def clear(self):
+        """
+        Discards all idle clients
+        """
+        with self._lock:
+            self._idle.clear()
+
+
+# Module-level instances like this one live as long as the lambda container, so
+# they are shared by all its invocations and threads. The caches and indexes of the
+# other common modules are kept the same way and must be thread-safe too.
+_registry = ClientRegistry()
+
+
+def use_client(kind, stack_name=const.STACK_NAME, correlation_id=None):
+    """
+    Context manager checking out a client of the given kind from the registry,
+    e.g.:
+
+        with use_client(DYNAMODB_CLIENT, correlation_id=correlation_id) as ddb:
+            ddb.get_item(...)
+    """
+    return _registry.checkout(
+        kind, stack_name=stack_name, correlation_id=correlation_id
+    )
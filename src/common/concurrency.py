@@ -0,0 +1,191 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import queue
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from thiscovery_lib.utilities import get_logger
+
+
+_EXHAUSTED = object()
+_FAILED = object()
+# seconds producer threads of merge_parallel wait on a full queue before checking
+# whether the consumer has gone away
+_PUT_TIMEOUT = 0.1
+
+
+def prefetch(iterable):
+    """
+    Yields the items of iterable, fetching the next item in a background thread
+    while the caller works on the current one
+    """
+    iterator = iter(iterable)
+    try:
+        with ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prefetch"
+        ) as executor:
+            future = executor.submit(next, iterator, _EXHAUSTED)
+            while True:
+                item = future.result()
+                if item is _EXHAUSTED:
+                    return
+                future = executor.submit(next, iterator, _EXHAUSTED)
+                yield item
+    finally:
+        # let generators release their own resources if we stopped early
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+def merge_parallel(iterables, max_buffered=2, thread_name_prefix="merge"):
+    """
+    Yields the items of several iterables as soon as any of them produces one, each
+    iterable being consumed in its own thread (scatter-gather). Items of the same
+    iterable are yielded in order; there is no ordering between iterables.
+
+    Each thread reads at most max_buffered items ahead of the caller. The first
+    exception raised by an iterable is re-raised to the caller.
+    """
+    iterables = list(iterables)
+    if not iterables:
+        return
+    results = queue.Queue(maxsize=max_buffered * len(iterables))
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def drain(iterable):
+        try:
+            for item in iterable:
+                if not put((None, item)):
+                    return
+        except Exception as ex:
+            put((_FAILED, ex))
+        else:
+            put((_EXHAUSTED, None))
+
+    with ThreadPoolExecutor(
+        max_workers=len(iterables), thread_name_prefix=thread_name_prefix
+    ) as executor:
+        for iterable in iterables:
+            executor.submit(drain, iterable)
+        try:
+            remaining = len(iterables)
+            while remaining:
+                marker, item = results.get()
+                if marker is _EXHAUSTED:
+                    remaining -= 1
+                elif marker is _FAILED:
+                    raise item
+                else:
+                    yield item
+        finally:
+            stopped.set()
+
+
+class LaneExecutor:
+    """
+    Runs submitted calls on a pool of worker threads. Calls that share a lane key
+    are run one at a time, in the order they were submitted; calls in different
+    lanes run in parallel.
+
+    Exceptions raised by submitted calls do not stop their lane; they are logged
+    and collected in self.errors as (lane_key, exception) tuples.
+
+    If max_pending is set, submit blocks while that many calls are waiting or
+    running, which bounds the memory used by callers feeding work from a stream.
+    """
+
+    def __init__(self, max_workers, max_pending=None, thread_name_prefix="lane"):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.errors = list()
+        self.logger = get_logger()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix
+        )
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._lanes = dict()  # lane key -> deque of calls waiting to run
+        self._in_flight = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def submit(self, lane_key, fn, *args, **kwargs):
+        with self._lock:
+            while self.max_pending and self._in_flight >= self.max_pending:
+                self._idle.wait()
+            self._in_flight += 1
+            lane = self._lanes.get(lane_key)
+            if lane is None:
+                self._lanes[lane_key] = deque([(fn, args, kwargs)])
+                self._executor.submit(self._run_lane, lane_key)
+            else:
+                # a worker is already draining this lane; it will pick this call up
+                lane.append((fn, args, kwargs))
+
+    def _run_lane(self, lane_key):
+        while True:
+            with self._lock:
+                lane = self._lanes[lane_key]
+                if not lane:
+                    del self._lanes[lane_key]
+                    return
+                fn, args, kwargs = lane.popleft()
+            try:
+                fn(*args, **kwargs)
+            except Exception as ex:
+                self.logger.error(
+                    "Call failed in processing lane",
+                    extra={
+                        "lane_key": lane_key,
+                        "error": repr(ex),
+                        "traceback": traceback.format_exc(),
+                    },
+                )
+                with self._lock:
+                    self.errors.append((lane_key, ex))
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._idle.notify_all()
+
+    def wait(self):
+        """
+        Blocks until every submitted call has run
+        """
+        with self._lock:
+            while self._in_flight:
+                self._idle.wait()
+
+    def shutdown(self):
+        self.wait()
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,252 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import copy
+import os
+import threading
+import time
+
+from thiscovery_lib.utilities import (
+    DetailedIntegrityError,
+    DetailedValueError,
+    get_logger,
+    new_correlation_id,
+)
+
+import common.constants as const
+from common.clients import DYNAMODB_CLIENT, use_client
+
+
+TEMPLATES_TABLE_NAME = "HubspotEmailTemplates"
+LOOKUPS_TABLE_NAME = "lookups"
+# key of the lookups item whose version changes whenever a template changes
+TEMPLATES_VERSION_KEY = "email-templates-version"
+# cached templates are checked against that version at most this often
+TEMPLATES_VERSION_CHECK_SECONDS = int(
+    os.environ.get("EMAIL_TEMPLATES_VERSION_CHECK_SECONDS", 60)
+)
+# cached templates are reloaded after this long, even if no change was recorded
+TEMPLATES_TTL_SECONDS = int(os.environ.get("EMAIL_TEMPLATES_TTL", 3600))
+PROPERTY_TYPES = ["contact_properties", "custom_properties"]
+
+
+def record_templates_change(correlation_id=None, stack_name=const.STACK_NAME):
+    """
+    Saves a new templates version to the lookups table, so that TemplateCache
+    instances reload their templates
+    """
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        return ddb.put_item(
+            table_name=LOOKUPS_TABLE_NAME,
+            key=TEMPLATES_VERSION_KEY,
+            item_type="email_templates_version",
+            item_details=dict(),
+            item={"version": str(new_correlation_id())},
+            update_allowed=True,
+            correlation_id=correlation_id,
+        )
+
+
+class TemplateValidator:
+    """
+    Property checks of an email template, compiled once per template so that
+    validating an email only costs a few dict and set lookups
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.required = dict()  # property type -> names of required properties
+        self.allowed = dict()  # property type -> names of all template properties
+        for p_type in PROPERTY_TYPES:
+            properties = template[p_type]
+            self.required[p_type] = tuple(
+                p["name"] for p in properties if p["required"] is True
+            )
+            self.allowed[p_type] = frozenset(p["name"] for p in properties)
+
+    def validate(self, email_dict, lookup_map, lookup_properties, correlation_id):
+        """
+        Checks email_dict has a value for every required property of the template,
+        filling in missing values using lookup_map, and has no properties the
+        template does not specify
+
+        Args:
+            email_dict (dict): Email to validate; updated with looked up values
+            lookup_map (dict): Property name -> function returning its value
+            lookup_properties (list): Properties of email_dict that were used for
+                    lookups; these are allowed even if not in the template
+            correlation_id:
+        """
+        for p_type in PROPERTY_TYPES:
+            type_name = p_type.split("_")[0]
+            for p_name in self.required[p_type]:
+                try:  # get property value from email_dict
+                    p_value = email_dict[p_type][p_name]
+                except KeyError:
+                    try:  # lookup property value using appropriate class method
+                        p_value = lookup_map[p_name]()
+                    except KeyError:
+                        raise DetailedValueError(
+                            f"Required {type_name} property {p_name} not found in call body",
+                            details={
+                                "email_dict": email_dict,
+                                "correlation_id": correlation_id,
+                            },
+                        )
+                if not p_value:
+                    raise DetailedValueError(
+                        f"Required {type_name} property {p_name} cannot be null",
+                        details={
+                            "email_dict": email_dict,
+                            "correlation_id": correlation_id,
+                        },
+                    )
+                email_dict[p_type][p_name] = p_value
+
+            # check all properties in body of call are either specified in template
+            # or used for lookup
+            allowed = self.allowed[p_type]
+            for p in email_dict.get(p_type) or dict():
+                if (p not in allowed) and (p not in lookup_properties):
+                    raise DetailedIntegrityError(
+                        f"Call {type_name} property {p} is not specified in email template",
+                        details={
+                            "email_dict": email_dict,
+                            f"template_required_{type_name}_properties": self.template[
+                                p_type
+                            ],
+                            "correlation_id": correlation_id,
+                        },
+                    )
+        return True
+
+
+class TemplateCache:
+    """
+    In-memory copy of the HubspotEmailTemplates table, loaded in a single scan
+    the first time a template is needed.
+
+    Template changes are picked up through the version recorded by
+    record_templates_change (called from the table's stream), which is checked
+    at most every version_check_interval seconds. As a fallback, templates are
+    reloaded every ttl seconds.
+    """
+
+    def __init__(
+        self,
+        stack_name=const.STACK_NAME,
+        ttl=TEMPLATES_TTL_SECONDS,
+        version_check_interval=TEMPLATES_VERSION_CHECK_SECONDS,
+    ):
+        self.stack_name = stack_name
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.logger = get_logger()
+        self._templates = None  # template name -> template
+        self._validators = dict()  # template name -> TemplateValidator
+        self._version = None
+        self._loaded_at = None
+        self._version_checked_at = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read_version(ddb, correlation_id):
+        item = ddb.get_item(
+            table_name=LOOKUPS_TABLE_NAME,
+            key=TEMPLATES_VERSION_KEY,
+            correlation_id=correlation_id,
+        )
+        if item is None:
+            return None
+        return item["version"]
+
+    def _load(self, ddb, correlation_id):
+        # the version is read first, so that changes made during the scan are
+        # picked up by the next version check
+        self._version = self._read_version(ddb, correlation_id)
+        self._templates = {t["id"]: t for t in ddb.scan(TEMPLATES_TABLE_NAME)}
+        self._validators = dict()
+        self._loaded_at = self._version_checked_at = time.monotonic()
+        self.logger.info(
+            "Loaded email templates",
+            extra={
+                "template_count": len(self._templates),
+                "version": self._version,
+                "correlation_id": correlation_id,
+            },
+        )
+
+    def _refresh_if_stale(self, correlation_id):
+        now = time.monotonic()
+        expired = (self._templates is None) or (now - self._loaded_at >= self.ttl)
+        if (not expired) and (
+            now - self._version_checked_at < self.version_check_interval
+        ):
+            return
+        with use_client(
+            DYNAMODB_CLIENT, stack_name=self.stack_name, correlation_id=correlation_id
+        ) as ddb:
+            if expired:
+                self._load(ddb, correlation_id)
+                return
+            self._version_checked_at = now
+            if self._read_version(ddb, correlation_id) != self._version:
+                self._load(ddb, correlation_id)
+
+    def get(self, template_name, correlation_id=None):
+        """
+        Returns:
+            A copy of the template, or None if there is no such template
+        """
+        template, _ = self.get_with_validator(template_name, correlation_id)
+        return template
+
+    def get_with_validator(self, template_name, correlation_id=None):
+        """
+        Returns:
+            Tuple (template, validator): a copy of the template and its
+            TemplateValidator, or (None, None) if there is no such template
+        """
+        with self._lock:
+            self._refresh_if_stale(correlation_id)
+            template = self._templates.get(template_name)
+            if template is None:
+                return None, None
+            # compiled on first use, so that a malformed template only affects
+            # the emails using it
+            validator = self._validators.get(template_name)
+            if validator is None:
+                validator = self._validators[template_name] = TemplateValidator(
+                    template
+                )
+        return copy.deepcopy(template), validator
+
+    def clear(self):
+        with self._lock:
+            self._templates = None
+
+
+_template_cache = TemplateCache()
+
+
+def get_template_cache():
+    """
+    Returns the in-memory copy of the HubspotEmailTemplates table
+    """
+    return _template_cache
@@ -0,0 +1,117 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import os
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# maximum number of keep-alive connections kept open to each upstream host; further
+# concurrent requests to that host wait for a connection to be released
+POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 10))
+
+
+def get_origin(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class HostConnectionPools:
+    """
+    Keep-alive HTTP connections shared by all threads of a lambda container, so
+    that consecutive calls to the same upstream host (scheme and netloc) reuse an
+    open TCP/TLS connection instead of paying for a new handshake each time.
+
+    Each host gets its own requests.Session, whose connection pool holds at most
+    pool_maxsize connections.
+    """
+
+    def __init__(self, pool_maxsize=POOL_MAXSIZE):
+        self.pool_maxsize = pool_maxsize
+        self._sessions = dict()  # origin -> requests.Session
+        self._lock = threading.Lock()
+
+    def get_session(self, url):
+        origin = get_origin(url)
+        with self._lock:
+            try:
+                return self._sessions[origin]
+            except KeyError:
+                session = requests.Session()
+                session.mount(
+                    f"{origin}/",
+                    HTTPAdapter(
+                        pool_connections=1,
+                        pool_maxsize=self.pool_maxsize,
+                        pool_block=True,
+                    ),
+                )
+                self._sessions[origin] = session
+                return session
+
+    def request(self, method, url, **kwargs):
+        return self.get_session(url).request(method, url, **kwargs)
+
+    def get_stats(self):
+        """
+        Returns:
+            Dict mapping each host to the number of requests made to it, the
+            number of those that reused an open connection (hits) and the number
+            that had to open a new one (misses)
+        """
+        with self._lock:
+            sessions = dict(self._sessions)
+        stats = dict()
+        for origin, session in sessions.items():
+            # urllib3 pools of this host (one per set of TLS settings)
+            pools = session.get_adapter(f"{origin}/").poolmanager.pools
+            requests_made = connections = 0
+            for key in pools.keys():
+                try:
+                    pool = pools[key]
+                except KeyError:  # closed in the meantime
+                    continue
+                requests_made += pool.num_requests
+                connections += pool.num_connections
+            stats[origin] = {
+                "requests": requests_made,
+                "hits": requests_made - connections,
+                "misses": connections,
+            }
+        return stats
+
+    def close(self):
+        """
+        Closes all connections
+        """
+        with self._lock:
+            sessions, self._sessions = self._sessions, dict()
+        for session in sessions.values():
+            session.close()
+
+
+_pools = HostConnectionPools()
+
+
+def get_connection_pools():
+    """
+    Returns the keep-alive connections to upstream hosts
+    """
+    return _pools
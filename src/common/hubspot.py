@@ -0,0 +1,371 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import os
+import threading
+import time
+from http import HTTPStatus
+
+from dateutil import parser
+from thiscovery_lib.hubspot_utilities import (
+    LOGIN_TLE_TYPE_NAME,
+    TASK_SIGNUP_TLE_TYPE_NAME,
+)
+from thiscovery_lib.utilities import get_logger
+
+import common.constants as const
+from common.clients import DYNAMODB_CLIENT, HUBSPOT_CLIENT, use_client
+from common.http_pool import get_connection_pools
+
+
+# overridden in tests to point at a local stand-in for the HubSpot API
+HUBSPOT_BASE_URL = os.environ.get("HUBSPOT_BASE_URL", "https://api.hubapi.com")
+CONTACTS_BATCH_UPSERT_URL = "/crm/v3/objects/contacts/batch/upsert"
+CONTACTS_BATCH_SIZE = 100  # maximum number of inputs HubSpot accepts per batch
+TIMELINE_EVENTS_BATCH_URL = "/integrations/v1/{app_id}/timeline/event/batch"
+TIMELINE_EVENTS_BATCH_SIZE = 100
+# name of the login timeline event property holding the number of logins a
+# coalesced event stands for; the count is not posted if this is not set
+LOGIN_COUNT_PROPERTY = os.environ.get("HUBSPOT_LOGIN_COUNT_PROPERTY")
+REQUEST_TIMEOUT_SECONDS = 30
+# cached access tokens are refreshed this long before HubSpot says they expire
+TOKEN_EXPIRY_MARGIN_SECONDS = 120
+# lifetime assumed for tokens saved without expires_in (HubSpot's default)
+DEFAULT_TOKEN_LIFETIME_SECONDS = 1800
+# item of the tokens table where HubSpotClient saves the HubSpot token
+TOKENS_TABLE_NAME = "tokens"
+HUBSPOT_TOKEN_KEY = "hubspot"
+
+
+def get_hubspot_timestamp(datetime_string):
+    """
+    Converts a datetime string to the milliseconds since the epoch HubSpot expects
+    in datetime properties
+    """
+    return int(parser.isoparse(datetime_string).timestamp() * 1000)
+
+
+def get_contact_properties(user):
+    """
+    Returns the HubSpot contact properties of a user registration, matching those
+    set by HubSpotClient.post_new_user_to_crm
+    """
+    return {
+        "email": user["email"],
+        "firstname": user["first_name"],
+        "lastname": user["last_name"],
+        "thiscovery_id": user["id"],
+        "thiscovery_registered_date": get_hubspot_timestamp(user["created"]),
+        "country": user["country_name"],
+    }
+
+
+def get_task_signup_timeline_event(signup_details, event_type_id):
+    """
+    Returns the timeline event of a task signup, matching the one posted by
+    HubSpotClient.post_task_signup_to_crm. signup_details must include the
+    notification's extra_data and the user's crm_id.
+    """
+    return {
+        "id": signup_details["id"],
+        "objectId": signup_details["crm_id"],
+        "eventTypeId": event_type_id,
+        "project_id": signup_details["project_id"],
+        "project_name": signup_details["project_name"],
+        "task_id": signup_details["project_task_id"],
+        "task_name": signup_details["task_name"],
+        "task_type_id": signup_details["task_type_id"],
+        "task_type_name": signup_details["task_type_name"],
+        "signup_event_type": signup_details["signup_event_type"],
+        "timestamp": get_hubspot_timestamp(signup_details["created"]),
+    }
+
+
+def get_login_timeline_event(login_details, event_id, event_type_id, login_count=1):
+    """
+    Returns the timeline event of a user login, matching the one posted by
+    HubSpotClient.post_user_login_to_crm. Using the notification id as event_id
+    means a retried login updates its event instead of creating a duplicate.
+
+    login_count is the number of logins the event stands for (see
+    notification_process.coalesce_user_logins)
+    """
+    event = {
+        "id": event_id,
+        "email": login_details["email"],
+        "eventTypeId": event_type_id,
+        "timestamp": get_hubspot_timestamp(login_details["login_datetime"]),
+    }
+    if LOGIN_COUNT_PROPERTY:
+        event[LOGIN_COUNT_PROPERTY] = login_count
+    return event
+
+
+class HubSpotTokenCache:
+    """
+    Container-wide cache of the HubSpot access token saved in the tokens table.
+
+    The token is read from the table once and kept until shortly before it
+    expires. Its expiry is worked out from when it was saved to the table, not when
+    it was read, as another container may have saved it long before. Refreshes are
+    single-flight: the first thread to find the token expired (or rejected)
+    refreshes it, which saves the new token to the tokens table, while other
+    threads wait for it and then use the new token.
+    """
+
+    def __init__(self, stack_name=const.STACK_NAME):
+        self.stack_name = stack_name
+        self.logger = get_logger()
+        self._access_token = None
+        self._expires_at = None  # time.time() value
+        self._lock = threading.Lock()
+
+    def _read_token(self, correlation_id):
+        """
+        Returns the tokens table item holding the HubSpot token: the token itself is
+        in its details and the time it was saved in modified
+        """
+        with use_client(
+            DYNAMODB_CLIENT, stack_name=self.stack_name, correlation_id=correlation_id
+        ) as ddb:
+            return ddb.get_item(
+                TOKENS_TABLE_NAME, HUBSPOT_TOKEN_KEY, correlation_id=correlation_id
+            )
+
+    def _refresh_token(self, correlation_id):
+        """
+        Obtains a new token from HubSpot, saves it to the tokens table and returns
+        the updated tokens table item
+        """
+        with use_client(
+            HUBSPOT_CLIENT, stack_name=self.stack_name, correlation_id=correlation_id
+        ) as hs_client:
+            hs_client.refresh_token()
+        return self._read_token(correlation_id)
+
+    def _set_token(self, item):
+        token = item["details"]
+        lifetime = int(token.get("expires_in", DEFAULT_TOKEN_LIFETIME_SECONDS))
+        saved_at = parser.isoparse(item["modified"]).timestamp()
+        self._access_token = token["access_token"]
+        self._expires_at = saved_at + lifetime - TOKEN_EXPIRY_MARGIN_SECONDS
+
+    def get_access_token(self, correlation_id=None):
+        with self._lock:
+            if self._access_token is None:
+                self._set_token(self._read_token(correlation_id))
+            if time.time() >= self._expires_at:
+                self._set_token(self._refresh_token(correlation_id))
+            return self._access_token
+
+    def refresh(self, rejected_token, correlation_id=None):
+        """
+        Refreshes the access token after HubSpot rejected rejected_token, unless
+        another thread has already replaced it
+
+        Returns:
+            The new access token
+        """
+        with self._lock:
+            if (self._access_token is None) or (self._access_token == rejected_token):
+                self.logger.info(
+                    "Refreshing HubSpot access token",
+                    extra={"correlation_id": correlation_id},
+                )
+                self._set_token(self._refresh_token(correlation_id))
+            return self._access_token
+
+    def clear(self):
+        with self._lock:
+            self._access_token = None
+            self._expires_at = None
+
+
+_token_cache = HubSpotTokenCache()
+
+
+def get_token_cache():
+    """
+    Returns the cache of the HubSpot access token
+    """
+    return _token_cache
+
+
+class HubSpotBatchClient:
+    """
+    Client for the HubSpot batch endpoints not covered by thiscovery_lib's
+    HubSpotClient. Requests raise requests.HTTPError for error responses, so that
+    call_downstream can detect throttling and server errors, and reuse the
+    container's keep-alive connections to HubSpot.
+    """
+
+    def __init__(
+        self,
+        base_url=None,
+        access_token=None,
+        app_id=None,
+        correlation_id=None,
+        stack_name=const.STACK_NAME,
+        token_cache=None,
+    ):
+        """
+        Args:
+            base_url (str): Root URL of the HubSpot API; defaults to HUBSPOT_BASE_URL
+            access_token (str): If set, this token is used instead of the one saved
+                    in the tokens table and is never refreshed
+            app_id (str): Id of the HubSpot app owning our timeline event types;
+                    read from the HubSpot connection secret if not set
+            correlation_id:
+            stack_name:
+            token_cache (HubSpotTokenCache): Cache of the token saved in the tokens
+                    table; defaults to the one shared by this lambda container
+        """
+        self.base_url = (base_url or HUBSPOT_BASE_URL).rstrip("/")
+        self.correlation_id = correlation_id
+        self.stack_name = stack_name
+        self.logger = get_logger()
+        self._access_token = access_token
+        self._token_cache = token_cache or get_token_cache()
+        self._app_id = app_id
+        self._event_type_ids = dict()
+
+    def use_hs_client(self):
+        return use_client(
+            HUBSPOT_CLIENT,
+            stack_name=self.stack_name,
+            correlation_id=self.correlation_id,
+        )
+
+    def get_access_token(self):
+        if self._access_token is not None:
+            return self._access_token
+        return self._token_cache.get_access_token(self.correlation_id)
+
+    def get_app_id(self):
+        if self._app_id is None:
+            with self.use_hs_client() as hs_client:
+                self._app_id = hs_client.get_hubspot_connection_secret()["app-id"]
+        return self._app_id
+
+    def get_timeline_event_type_id(self, event_type_name):
+        try:
+            return self._event_type_ids[event_type_name]
+        except KeyError:
+            with self.use_hs_client() as hs_client:
+                event_type_id = hs_client.get_timeline_event_type_id(
+                    event_type_name, self.correlation_id
+                )
+            self._event_type_ids[event_type_name] = event_type_id
+            return event_type_id
+
+    def get_task_signup_event_type_id(self):
+        return self.get_timeline_event_type_id(TASK_SIGNUP_TLE_TYPE_NAME)
+
+    def get_login_event_type_id(self):
+        return self.get_timeline_event_type_id(LOGIN_TLE_TYPE_NAME)
+
+    def request(self, method, path, data=None):
+        """
+        Makes a request to the HubSpot API, refreshing the access token once if it
+        has expired
+
+        Returns:
+            requests.Response
+        """
+        for attempt in range(2):
+            access_token = self.get_access_token()
+            response = get_connection_pools().request(
+                method,
+                f"{self.base_url}{path}",
+                json=data,
+                headers={"Authorization": f"Bearer {access_token}"},
+                timeout=REQUEST_TIMEOUT_SECONDS,
+            )
+            if (
+                response.status_code == HTTPStatus.UNAUTHORIZED
+                and self._access_token is None
+                and attempt == 0
+            ):
+                self._token_cache.refresh(access_token, self.correlation_id)
+                continue
+            break
+        response.raise_for_status()
+        return response
+
+    def upsert_contacts(self, users):
+        """
+        Creates or updates the HubSpot contacts of up to CONTACTS_BATCH_SIZE users,
+        identified by email, in a single request
+
+        Args:
+            users (list): User registration details, as posted to
+                    HubSpotClient.post_new_user_to_crm
+
+        Returns:
+            Tuple (results, errors): results maps lowercase emails to
+            (hubspot_id, is_new) tuples; errors maps lowercase emails of contacts
+            HubSpot rejected to error messages. Users in neither were not processed.
+        """
+        assert (
+            len(users) <= CONTACTS_BATCH_SIZE
+        ), f"At most {CONTACTS_BATCH_SIZE} contacts can be upserted per request"
+        response = self.request(
+            "POST",
+            CONTACTS_BATCH_UPSERT_URL,
+            {
+                "inputs": [
+                    {
+                        "idProperty": "email",
+                        "id": user["email"],
+                        "properties": get_contact_properties(user),
+                    }
+                    for user in users
+                ]
+            },
+        )
+        body = response.json()
+        results = {
+            r["properties"]["email"].lower(): (r["id"], r.get("new", False))
+            for r in body.get("results", list())
+        }
+        errors = dict()
+        for error in body.get("errors", list()):
+            for email in error.get("context", dict()).get("ids", list()):
+                errors[email.lower()] = error.get("message", "Upsert failed")
+        if errors:
+            self.logger.warning(
+                "HubSpot rejected some contacts in batch upsert",
+                extra={"errors": errors, "correlation_id": self.correlation_id},
+            )
+        return results, errors
+
+    def create_timeline_events(self, events):
+        """
+        Creates or updates up to TIMELINE_EVENTS_BATCH_SIZE timeline events in a
+        single request. HubSpot accepts or rejects the batch as a whole.
+
+        Raises:
+            requests.HTTPError: if the batch was rejected
+        """
+        assert (
+            len(events) <= TIMELINE_EVENTS_BATCH_SIZE
+        ), f"At most {TIMELINE_EVENTS_BATCH_SIZE} events can be posted per request"
+        return self.request(
+            "PUT",
+            TIMELINE_EVENTS_BATCH_URL.format(app_id=self.get_app_id()),
+            {"eventWrappers": events},
+        )
@@ -0,0 +1,104 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import os
+import threading
+import time
+
+from thiscovery_lib.utilities import get_logger
+
+from common.circuit_breaker import CORE_API, call_downstream
+from common.clients import CORE_API_CLIENT, use_client
+
+
+# the project catalogue is downloaded again after this long
+PROJECT_INDEX_TTL_SECONDS = int(os.environ.get("PROJECT_INDEX_TTL", 900))
+# project task ids missing from the index trigger a new download, but no more than
+# once in this many seconds
+PROJECT_INDEX_MISS_REFRESH_SECONDS = 60
+
+
+class ProjectIndex:
+    """
+    Index of the thiscovery project catalogue by project task id. The catalogue is
+    downloaded from core once per refresh: when the index is first used, when it
+    is older than ttl seconds and when a project task id is not found in it (e.g.
+    the task was created after the last download).
+    """
+
+    def __init__(
+        self,
+        ttl=PROJECT_INDEX_TTL_SECONDS,
+        miss_refresh_interval=PROJECT_INDEX_MISS_REFRESH_SECONDS,
+    ):
+        self.ttl = ttl
+        self.miss_refresh_interval = miss_refresh_interval
+        self.logger = get_logger()
+        self._projects_by_task_id = None
+        self._built_at = None
+        self._lock = threading.Lock()
+
+    def _fetch_projects(self, correlation_id):
+        with use_client(CORE_API_CLIENT, correlation_id=correlation_id) as core_client:
+            return call_downstream(CORE_API, core_client.get_projects)
+
+    def _build(self, correlation_id):
+        projects = self._fetch_projects(correlation_id)
+        self._projects_by_task_id = {
+            task["id"]: project for project in projects for task in project["tasks"]
+        }
+        self._built_at = time.monotonic()
+        self.logger.debug(
+            "Built project index",
+            extra={
+                "project_count": len(projects),
+                "task_count": len(self._projects_by_task_id),
+                "correlation_id": correlation_id,
+            },
+        )
+
+    def get_project(self, project_task_id, correlation_id=None):
+        """
+        Returns:
+            The project (as returned by CoreApiClient.get_projects) the project
+            task belongs to, or None if it is not in the catalogue
+        """
+        with self._lock:
+            now = time.monotonic()
+            if (self._projects_by_task_id is None) or (
+                now - self._built_at >= self.ttl
+            ):
+                self._build(correlation_id)
+            elif (project_task_id not in self._projects_by_task_id) and (
+                now - self._built_at >= self.miss_refresh_interval
+            ):
+                self._build(correlation_id)
+            return self._projects_by_task_id.get(project_task_id)
+
+    def clear(self):
+        with self._lock:
+            self._projects_by_task_id = None
+
+
+_project_index = ProjectIndex()
+
+
+def get_project_index():
+    """
+    Returns the index of the project catalogue
+    """
+    return _project_index
@@ -0,0 +1,170 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import threading
+import time
+from http import HTTPStatus
+
+from thiscovery_lib.utilities import get_logger
+
+
+HUBSPOT_CRM = "hubspot-crm"
+HUBSPOT_SINGLE_SEND = "hubspot-single-send"
+
+# endpoint family -> (requests per second, burst size). HubSpot allows 100 requests
+# per 10 seconds per app. A full bucket lets through burst size + 10 * rate requests
+# in any 10 second window, so that must not exceed 100. Buckets are per container:
+# concurrently running Lambda containers each get their own, and rely on 429
+# responses pausing their bucket (see call_rate_limited) to share the quota
+RATE_LIMITS = {
+    HUBSPOT_CRM: (9, 10),
+    HUBSPOT_SINGLE_SEND: (9, 10),
+}
+DEFAULT_RETRY_AFTER_SECONDS = 10
+MAX_THROTTLED_ATTEMPTS = 3
+
+
+class ThrottledError(Exception):
+    """
+    Raised when a call is still being throttled after MAX_THROTTLED_ATTEMPTS
+    """
+
+    def __init__(self, endpoint_family, retry_after):
+        super().__init__(
+            f"Calls to {endpoint_family} throttled; retry after {retry_after} seconds"
+        )
+        self.endpoint_family = endpoint_family
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at rate tokens per second, up to capacity
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+
+    def acquire(self):
+        """
+        Blocks until a token is available and the bucket is not paused
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        Stops handing out tokens for the given number of seconds, e.g. after the
+        upstream server responded with 429 Too Many Requests
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            # no tokens accumulate while paused
+            self._tokens = 0
+            self._updated = self._paused_until
+
+
+_limiters = dict()
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(endpoint_family):
+    """
+    Returns the TokenBucket limiting calls to endpoint_family
+    """
+    with _limiters_lock:
+        try:
+            return _limiters[endpoint_family]
+        except KeyError:
+            rate, capacity = RATE_LIMITS[endpoint_family]
+            limiter = _limiters[endpoint_family] = TokenBucket(rate, capacity)
+            return limiter
+
+
+def get_retry_after(result):
+    """
+    Returns the number of seconds to wait before retrying if result (a response,
+    an HTTP status code or an exception carrying a response) indicates the call was
+    throttled; returns None otherwise
+    """
+    response = getattr(result, "response", result)
+    status_code = getattr(response, "status_code", response)
+    if status_code != HTTPStatus.TOO_MANY_REQUESTS:
+        return None
+    headers = getattr(response, "headers", None) or dict()
+    try:
+        return float(headers["Retry-After"])
+    except (KeyError, ValueError):
+        return DEFAULT_RETRY_AFTER_SECONDS
+
+
+def call_rate_limited(endpoint_family, fn, *args, **kwargs):
+    """
+    Calls fn(*args, **kwargs) once the rate limiter of endpoint_family allows it.
+    Throttled calls (429 Too Many Requests) pause the rate limiter for every thread
+    and are retried, up to MAX_THROTTLED_ATTEMPTS in total.
+
+    Raises:
+        ThrottledError: if the call is throttled on every attempt
+    """
+    logger = get_logger()
+    limiter = get_rate_limiter(endpoint_family)
+    retry_after = None
+    for attempt in range(MAX_THROTTLED_ATTEMPTS):
+        limiter.acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as ex:
+            retry_after = get_retry_after(ex)
+            if retry_after is None:
+                raise
+        else:
+            retry_after = get_retry_after(result)
+            if retry_after is None:
+                return result
+        logger.warning(
+            "Call throttled by upstream server",
+            extra={
+                "endpoint_family": endpoint_family,
+                "attempt": attempt + 1,
+                "retry_after": retry_after,
+            },
+        )
+        limiter.pause(retry_after)
+    raise ThrottledError(endpoint_family, retry_after)
@@ -0,0 +1,167 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import os
+import traceback
+
+from thiscovery_lib.utilities import ObjectDoesNotExistError, get_logger
+
+from common.caching import MISSING, TTLCache
+from common.circuit_breaker import CORE_API, call_downstream
+from common.clients import CORE_API_CLIENT, use_client
+from common.user_directory import USER_DETAILS_MAX_AGE_SECONDS, get_user_directory
+
+
+# id spaces of the recipient ids accepted by TransactionalEmail
+USER_ID = "user_id"
+ANON_PROJECT_SPECIFIC_USER_ID = "anon_project_specific_user_id"
+ID_SPACES = [USER_ID, ANON_PROJECT_SPECIFIC_USER_ID]
+CORE_LOOKUPS = {
+    USER_ID: "get_user_by_user_id",
+    ANON_PROJECT_SPECIFIC_USER_ID: "get_user_by_anon_project_specific_user_id",
+}
+
+RECIPIENT_CACHE_SIZE = int(os.environ.get("RECIPIENT_CACHE_SIZE", 5000))
+RECIPIENT_CACHE_TTL_SECONDS = int(os.environ.get("RECIPIENT_CACHE_TTL", 900))
+# ids that match no user are retried after this long (e.g. users registering now)
+RECIPIENT_NOT_FOUND_TTL_SECONDS = 60
+# ids never move between id spaces, so these are remembered for longer
+ID_SPACE_CACHE_TTL_SECONDS = 24 * 3600
+
+
+class RecipientResolver:
+    """
+    Resolves recipient ids (user_id or anon_project_specific_user_id) to users,
+    caching the users found and, briefly, the ids that match no user and the users
+    not yet posted to HubSpot.
+
+    The id space of each resolved id is remembered for longer than its user, so
+    resolving that id again costs a single core API call. Ids expected to be in
+    the user_id space are also looked up in the user directory before calling core.
+    """
+
+    def __init__(
+        self,
+        maxsize=RECIPIENT_CACHE_SIZE,
+        ttl=RECIPIENT_CACHE_TTL_SECONDS,
+        not_found_ttl=RECIPIENT_NOT_FOUND_TTL_SECONDS,
+        directory=None,
+    ):
+        self.not_found_ttl = not_found_ttl
+        self.directory = directory or get_user_directory()
+        self.logger = get_logger()
+        self._users = TTLCache(maxsize, ttl)  # recipient id -> user, or None
+        self._id_spaces = TTLCache(maxsize, ID_SPACE_CACHE_TTL_SECONDS)
+
+    def _fetch_user(self, id_space, recipient_id, correlation_id):
+        """
+        Raises:
+            AssertionError: if recipient_id matches no user in id_space
+            DependencyError: if the core API responded with a server error
+        """
+        with use_client(CORE_API_CLIENT, correlation_id=correlation_id) as core_client:
+            return call_downstream(
+                CORE_API, getattr(core_client, CORE_LOOKUPS[id_space]), recipient_id
+            )
+
+    def _save_to_directory(self, user, correlation_id):
+        try:
+            self.directory.put(user, user["crm_id"], correlation_id=correlation_id)
+        except Exception:
+            self.logger.warning(
+                "Failed to save user to directory",
+                extra={
+                    "user_id": user["id"],
+                    "traceback": traceback.format_exc(),
+                    "correlation_id": correlation_id,
+                },
+            )
+
+    def resolve(self, recipient_id, id_space=None, correlation_id=None):
+        """
+        Args:
+            recipient_id (str):
+            id_space (str): Id space recipient_id is expected to belong to
+                    (USER_ID or ANON_PROJECT_SPECIFIC_USER_ID); this is tried first
+                    if the id has not been resolved before
+            correlation_id:
+
+        Returns:
+            The user recipient_id belongs to
+
+        Raises:
+            ObjectDoesNotExistError: if recipient_id matches no user
+        """
+        user = self._users.get(recipient_id)
+        if user is MISSING:
+            user = self._resolve_uncached(recipient_id, id_space, correlation_id)
+        if user is None:
+            raise ObjectDoesNotExistError(
+                "Recipient id does not match any known user_id or anon_project_specific_user_id",
+                details={
+                    "to_recipient_id": recipient_id,
+                    "correlation_id": correlation_id,
+                },
+            )
+        return user
+
+    def _resolve_uncached(self, recipient_id, id_space, correlation_id):
+        known_id_space = self._id_spaces.get(recipient_id, None)
+        if known_id_space is not None:
+            id_spaces = [known_id_space]
+        else:
+            id_spaces = sorted(ID_SPACES, key=lambda s: s != id_space)
+        if id_spaces[0] == USER_ID:
+            user = self.directory.get(
+                recipient_id,
+                max_age=USER_DETAILS_MAX_AGE_SECONDS,
+                correlation_id=correlation_id,
+            )
+            if user is not None:
+                self._remember(recipient_id, USER_ID, user)
+                return user
+        for space in id_spaces:
+            try:
+                user = self._fetch_user(space, recipient_id, correlation_id)
+            except AssertionError:
+                continue
+            self._remember(recipient_id, space, user)
+            if user["crm_id"]:
+                self._save_to_directory(user, correlation_id)
+            return user
+        self._users.set(recipient_id, None, ttl=self.not_found_ttl)
+        return None
+
+    def _remember(self, recipient_id, id_space, user):
+        self._id_spaces.set(recipient_id, id_space)
+        # users not yet posted to HubSpot get a crm_id soon, so don't keep them long
+        ttl = None if user["crm_id"] else self.not_found_ttl
+        self._users.set(recipient_id, user, ttl=ttl)
+
+    def clear(self):
+        self._users.clear()
+        self._id_spaces.clear()
+
+
+_resolver = RecipientResolver()
+
+
+def get_recipient_resolver():
+    """
+    Returns the resolver of transactional email recipients
+    """
+    return _resolver
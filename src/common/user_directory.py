@@ -0,0 +1,169 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import os
+import threading
+from datetime import timedelta
+
+from dateutil import parser
+from thiscovery_lib.utilities import get_logger, now_with_tz
+
+import common.constants as const
+from common.caching import MISSING, TTLCache
+from common.clients import DYNAMODB_CLIENT, use_client
+
+
+LOOKUPS_TABLE_NAME = "lookups"
+USER_DIRECTORY_ITEM_TYPE = "user_directory"
+USER_DIRECTORY_KEY_PREFIX = "user-directory-"
+# users can change their email address and names in thiscovery-core, so entries
+# older than this are not trusted for anything but the (immutable) crm_id
+USER_DETAILS_MAX_AGE_SECONDS = 24 * 3600
+USER_DETAILS_ATTRIBUTES = ["crm_id", "email", "first_name", "last_name"]
+USER_DIRECTORY_CACHE_SIZE = int(os.environ.get("USER_DIRECTORY_CACHE_SIZE", 5000))
+USER_DIRECTORY_CACHE_TTL_SECONDS = int(os.environ.get("USER_DIRECTORY_CACHE_TTL", 900))
+# users not in the directory may be posted to HubSpot at any moment, so misses are
+# only remembered this long
+USER_DIRECTORY_NOT_FOUND_TTL_SECONDS = 60
+
+
+class UserDirectory:
+    """
+    Directory of the HubSpot ids (crm_id), emails and names of thiscovery users,
+    saved to the lookups table as soon as a user is posted to HubSpot. Entries are
+    also kept in a bounded in-memory cache for ttl seconds (not_found_ttl seconds
+    for users missing from the directory), so each user is read from the lookups
+    table at most once per processing run.
+
+    Entries are dicts of the USER_DETAILS_ATTRIBUTES plus "id" (the user_id) and
+    "updated" (when the entry was saved).
+    """
+
+    def __init__(
+        self,
+        stack_name=const.STACK_NAME,
+        maxsize=USER_DIRECTORY_CACHE_SIZE,
+        ttl=USER_DIRECTORY_CACHE_TTL_SECONDS,
+        not_found_ttl=USER_DIRECTORY_NOT_FOUND_TTL_SECONDS,
+    ):
+        self.stack_name = stack_name
+        self.not_found_ttl = not_found_ttl
+        self.logger = get_logger()
+        # user_id -> entry, or None if not in the directory
+        self._users = TTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """
+        Clears the in-memory copy of the directory
+        """
+        with self._lock:
+            self._users.clear()
+
+    def get(self, user_id, max_age=None, correlation_id=None):
+        """
+        Args:
+            user_id (str):
+            max_age (int): If set, entries saved more than this many seconds ago are
+                    treated as missing
+            correlation_id:
+
+        Returns:
+            The directory entry of user_id, or None if there is no (recent enough)
+            entry
+        """
+        entry = self._users.get(user_id)
+        if entry is MISSING:
+            with use_client(
+                DYNAMODB_CLIENT,
+                stack_name=self.stack_name,
+                correlation_id=correlation_id,
+            ) as ddb:
+                item = ddb.get_item(
+                    table_name=LOOKUPS_TABLE_NAME,
+                    key=f"{USER_DIRECTORY_KEY_PREFIX}{user_id}",
+                    correlation_id=correlation_id,
+                )
+            if item is None:
+                entry, ttl = None, self.not_found_ttl
+            else:
+                entry = {
+                    "id": user_id,
+                    "updated": item["modified"],
+                    **{a: item.get(a) for a in USER_DETAILS_ATTRIBUTES},
+                }
+                ttl = None
+            with self._lock:
+                # don't overwrite an entry put while the item was being read
+                cached = self._users.get(user_id)
+                if cached is MISSING:
+                    self._users.set(user_id, entry, ttl=ttl)
+                else:
+                    entry = cached
+        if (entry is None) or (max_age is None):
+            return entry
+        oldest_allowed = now_with_tz() - timedelta(seconds=max_age)
+        if parser.parse(entry["updated"]) < oldest_allowed:
+            return None
+        return entry
+
+    def put(self, user, crm_id, correlation_id=None):
+        """
+        Saves the HubSpot id of a user
+
+        Args:
+            user (dict): Must contain the user's id, email, first_name and last_name
+            crm_id (str): The user's HubSpot id
+            correlation_id:
+        """
+        user_details = {
+            "crm_id": str(crm_id),
+            "email": user["email"],
+            "first_name": user["first_name"],
+            "last_name": user["last_name"],
+        }
+        with use_client(
+            DYNAMODB_CLIENT, stack_name=self.stack_name, correlation_id=correlation_id
+        ) as ddb:
+            ddb.put_item(
+                table_name=LOOKUPS_TABLE_NAME,
+                key=f"{USER_DIRECTORY_KEY_PREFIX}{user['id']}",
+                item_type=USER_DIRECTORY_ITEM_TYPE,
+                item_details=dict(),
+                item=user_details,
+                update_allowed=True,
+                correlation_id=correlation_id,
+            )
+        with self._lock:
+            self._users.set(
+                user["id"],
+                {
+                    "id": user["id"],
+                    "updated": str(now_with_tz()),
+                    **user_details,
+                },
+            )
+
+
+_directory = UserDirectory()
+
+
+def get_user_directory():
+    """
+    Returns the directory of users posted to HubSpot
+    """
+    return _directory
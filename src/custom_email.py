@@ -33,7 +33,8 @@ def custom_email(event, context):
 
     try:
         email_dict = {
-            'to_recipient_id': detail.pop('anon_project_specific_user_id')
+            'to_recipient_id': detail.pop('anon_project_specific_user_id'),
+            'to_recipient_id_type': 'anon_project_specific_user_id',
         }
     except KeyError:
         try:
@@ -16,19 +16,23 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 import http
+import json
+import os
+import random
+import threading
 import time
 
 import thiscovery_lib.utilities as utils
 import traceback
+import zlib
+from boto3.dynamodb.types import TypeDeserializer
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dateutil import parser, tz
 from enum import Enum
 from http import HTTPStatus
-from thiscovery_lib.core_api_utilities import CoreApiClient
-from thiscovery_lib.dynamodb_utilities import Dynamodb
 from thiscovery_lib.eb_utilities import ThiscoveryEvent
-from thiscovery_lib.hubspot_utilities import HubSpotClient
 from thiscovery_lib.utilities import (
     get_logger,
     new_correlation_id,
@@ -37,10 +41,84 @@ from thiscovery_lib.utilities import (
 )
 
 import common.constants as const
+from common.clients import (
+    CORE_API_CLIENT,
+    DYNAMODB_CLIENT,
+    HUBSPOT_CLIENT,
+    use_client,
+)
+from common.concurrency import LaneExecutor, merge_parallel, prefetch
+from common.circuit_breaker import (
+    CORE_API,
+    CircuitOpenError,
+    call_downstream,
+    is_dependency_failure,
+)
+from common.hubspot import (
+    CONTACTS_BATCH_SIZE,
+    TIMELINE_EVENTS_BATCH_SIZE,
+    HubSpotBatchClient,
+    get_login_timeline_event,
+    get_task_signup_timeline_event,
+)
+from common.email_templates import get_template_cache
+from common.projects import get_project_index
+from common.rate_limiting import HUBSPOT_CRM, ThrottledError
+from common.recipients import get_recipient_resolver
+from common.user_directory import get_user_directory
 
 
 NOTIFICATION_TABLE_NAME = "notifications"
 MAX_RETRIES = 2
+# retries are scheduled with exponential backoff: the nth retry happens around
+# RETRY_BASE_DELAY_SECONDS * 2 ** (n - 1) seconds after the nth failure
+RETRY_BASE_DELAY_SECONDS = int(os.environ.get("NOTIFICATION_RETRY_BASE_DELAY", 300))
+RETRY_MAX_DELAY_SECONDS = int(
+    os.environ.get("NOTIFICATION_RETRY_MAX_DELAY", 6 * 3600)
+)
+PROCESSING_WORKERS = int(os.environ.get("NOTIFICATION_PROCESSING_WORKERS", 8))
+# threads resolving the recipients and projects of a batch of transactional emails
+EMAIL_PREFETCH_WORKERS = int(os.environ.get("EMAIL_PREFETCH_WORKERS", 8))
+NOTIFICATIONS_PAGE_SIZE = 100
+# the status index is hashed on "<processing status>#<shard>", so that items of the
+# same status are spread over this many partitions. Indexes are queried up to the
+# highest value ever used (see get_status_shard_count), so it can safely be lowered
+NOTIFICATION_STATUS_SHARDS = int(os.environ.get("NOTIFICATION_STATUS_SHARDS", 10))
+STATUS_SHARD_INDEX = "processing-status-shard-index"
+# sparse index only holding notifications that have not reached a final status
+PENDING_WORK_INDEX = "pending-work-index"
+# unsharded index (processing_status, created) of stacks deployed before sharding;
+# processed notifications are cleared from it until processing-status-shard-index
+# is created (see NotificationsIndexMigrationStep in template.yaml)
+LEGACY_STATUS_INDEX = "processing-status-index"
+CLEAR_FROM_LEGACY_STATUS_INDEX = (
+    os.environ.get("NOTIFICATIONS_CLEAR_FROM_LEGACY_INDEX", "false").lower() == "true"
+)
+# stop dispatching notifications when the lambda has less than this left to run;
+# notifications already dispatched must be able to finish within this margin
+PROCESSING_DEADLINE_MARGIN_SECONDS = int(
+    os.environ.get("NOTIFICATION_PROCESSING_DEADLINE_MARGIN", 60)
+)
+# maximum number of items in a DynamoDB transaction
+CLAIM_BATCH_SIZE = 100
+MAX_CLAIM_CONFLICT_RETRIES = 3
+COMPLETION_BUFFER_SIZE = 25
+COMPLETION_FLUSH_INTERVAL_SECONDS = 5
+# attempts at writing the updates left in a completion buffer when it is closed;
+# the delay between attempts doubles each time
+COMPLETION_FINAL_FLUSH_ATTEMPTS = 3
+COMPLETION_FINAL_FLUSH_DELAY_SECONDS = 0.5
+LOOKUPS_TABLE_NAME = "lookups"
+RESUME_CURSOR_KEY = "process_notifications_resume_cursor"
+# lookups item recording that notifications saved before the status shard and
+# pending work keys were introduced have been given those keys
+INDEX_KEYS_BACKFILL_KEY = "notifications_index_keys_backfill"
+PROCESSING_TRIGGER_KEY = "process_notifications_trigger"
+# lookups item recording the highest value of NOTIFICATION_STATUS_SHARDS ever used
+STATUS_SHARDS_KEY = "notifications_status_shards"
+# after a process_notifications event is put, further requests for processing are
+# coalesced until the triggered run finishes or this many seconds have passed
+PROCESSING_TRIGGER_WINDOW_SECONDS = 60
 
 
 class NotificationType(Enum):
@@ -59,45 +137,239 @@ class NotificationStatus(Enum):
     DLQ = "dlq"
 
 
+# notifications posted to HubSpot as timeline events
+TIMELINE_EVENT_TYPES = [
+    NotificationType.TASK_SIGNUP.value,
+    NotificationType.USER_LOGIN.value,
+]
+
+# lower values are processed first within a user's lane
+PROCESSING_PRIORITY = {
+    NotificationType.USER_REGISTRATION.value: -1,
+}
+
+
 class NotificationAttributes(Enum):
     STATUS = "processing_status"
+    STATUS_SHARD = "processing_status_shard"
     FAIL_COUNT = "processing_fail_count"
     ERROR_MESSAGE = "processing_error_message"
+    NEXT_ATTEMPT_AT = "next_attempt_at"
+    PENDING_WORK = "pending_work"
     TYPE = "type"
 
 
+# processing statuses of notifications awaiting processing, in the order they are read
+PENDING_STATUSES = [
+    NotificationStatus.RETRYING.value,
+    NotificationStatus.NEW.value,
+]
+# notifications in these statuses are removed from the pending work index
+FINAL_STATUSES = [
+    NotificationStatus.PROCESSED.value,
+    NotificationStatus.DLQ.value,
+]
+
+
+def get_status_shard(notification):
+    """
+    Returns the shard of the status index a notification belongs to. Notifications
+    in the same processing lane (i.e. about the same user) share a shard, so that
+    reading a shard returns them in the order they were created.
+    """
+    lane_key = get_lane_key(notification)
+    return zlib.crc32(lane_key.encode()) % NOTIFICATION_STATUS_SHARDS
+
+
+def get_status_shard_key(status, shard):
+    return f"{status}#{shard}"
+
+
+def get_status_shard_count(correlation_id=None, stack_name=const.STACK_NAME):
+    """
+    Returns the number of status shards to query: the highest value
+    NOTIFICATION_STATUS_SHARDS has had, so that notifications written to shards
+    dropped by lowering it are still read. The current value is recorded in the
+    lookups table if it is the highest so far.
+    """
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        item = ddb.get_item(
+            table_name=LOOKUPS_TABLE_NAME,
+            key=STATUS_SHARDS_KEY,
+            correlation_id=correlation_id,
+        )
+        if (item is not None) and (int(item["shards"]) >= NOTIFICATION_STATUS_SHARDS):
+            return int(item["shards"])
+        ddb.put_item(
+            table_name=LOOKUPS_TABLE_NAME,
+            key=STATUS_SHARDS_KEY,
+            item_type="notifications_status_shards",
+            item_details=dict(),
+            item={"shards": NOTIFICATION_STATUS_SHARDS},
+            update_allowed=True,
+            correlation_id=correlation_id,
+        )
+        return NOTIFICATION_STATUS_SHARDS
+
+
+def get_status_updates(notification, status):
+    """
+    Returns the name_value_pairs setting the processing status of a notification,
+    including the sharded status keys of the status and pending work indexes. The
+    pending work key is None (i.e. the attribute is removed) for final statuses.
+    """
+    status_shard_key = get_status_shard_key(status, get_status_shard(notification))
+    pending_work_key = None if status in FINAL_STATUSES else status_shard_key
+    return {
+        NotificationAttributes.STATUS.value: status,
+        NotificationAttributes.STATUS_SHARD.value: status_shard_key,
+        NotificationAttributes.PENDING_WORK.value: pending_work_key,
+    }
+
+
+def iter_shard_pages(table, pending_work_key, page_size, due_before, resume_from=None):
+    """
+    Generator yielding pages of the notifications in one shard of the pending work
+    index that are due for processing, in next_attempt_at order
+
+    Args:
+        table: boto3 Table resource of the notifications table
+        pending_work_key (str): Value of pending_work to query
+        page_size (int): Maximum number of notifications per page
+        due_before (str): Skip notifications whose next_attempt_at is after this
+        resume_from (str): Skip notifications whose next_attempt_at is before this
+    """
+    next_attempt_at = NotificationAttributes.NEXT_ATTEMPT_AT.value
+    key_condition = f"{NotificationAttributes.PENDING_WORK.value} = :pending_work"
+    attribute_values = {
+        ":pending_work": pending_work_key,
+        ":now": due_before,
+    }
+    if resume_from is None:
+        key_condition += f" AND {next_attempt_at} <= :now"
+    else:
+        key_condition += f" AND {next_attempt_at} BETWEEN :resume_from AND :now"
+        attribute_values[":resume_from"] = resume_from
+    query_kwargs = {
+        "IndexName": PENDING_WORK_INDEX,
+        "KeyConditionExpression": key_condition,
+        "ExpressionAttributeValues": attribute_values,
+        "Limit": page_size,
+    }
+    while True:
+        result = table.query(**query_kwargs)
+        if result["Items"]:
+            yield result["Items"]
+        last_evaluated_key = result.get("LastEvaluatedKey")
+        if last_evaluated_key is None:
+            break
+        query_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+
+def iter_notification_pages(
+    page_size=NOTIFICATIONS_PAGE_SIZE,
+    resume_cursor=None,
+    correlation_id=None,
+    stack_name=const.STACK_NAME,
+):
+    """
+    Generator yielding pages of notifications awaiting processing, read from the
+    sparse pending work index, so that the cost of fetching work does not depend on
+    how many notifications have already been processed. The shards of the index are
+    queried in parallel and pages are yielded as soon as they are read from any
+    shard. Each page only contains notifications of a single shard (and therefore
+    of a single processing status).
+
+    RETRYING notifications are read before NEW ones, so that a registration that
+    failed on a previous run is queued ahead of any newer task signups of the same
+    user. RETRYING notifications whose next_attempt_at is in the future are skipped.
+
+    Args:
+        page_size (int): Maximum number of notifications per page
+        resume_cursor (dict): Maps pending work keys to the next_attempt_at value of
+                the first notification left unprocessed by a previous run in that
+                shard; notifications before that are skipped
+        correlation_id:
+        stack_name:
+    """
+    if resume_cursor is None:
+        resume_cursor = dict()
+    shard_count = get_status_shard_count(correlation_id, stack_name=stack_name)
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        table = ddb.get_table(NOTIFICATION_TABLE_NAME)
+        now = str(now_with_tz())
+        for status in PENDING_STATUSES:
+            shard_keys = [
+                get_status_shard_key(status, shard)
+                for shard in range(shard_count)
+            ]
+            yield from merge_parallel(
+                iter_shard_pages(
+                    table,
+                    shard_key,
+                    page_size,
+                    due_before=now,
+                    resume_from=resume_cursor.get(shard_key),
+                )
+                for shard_key in shard_keys
+            )
+
+
 def get_notifications_to_process(correlation_id=None, stack_name=const.STACK_NAME):
-    ddb = Dynamodb(
-        stack_name=stack_name,
-        correlation_id=correlation_id,
-    )
-    notifications_to_process = list()
-    for status in [NotificationStatus.NEW.value, NotificationStatus.RETRYING.value]:
-        notifications_to_process += ddb.query(
-            table_name=NOTIFICATION_TABLE_NAME,
-            IndexName="processing-status-index",
-            KeyConditionExpression="processing_status = :status",
-            ExpressionAttributeValues={
-                ":status": status,
-            },
+    return [
+        notification
+        for page in iter_notification_pages(
+            correlation_id=correlation_id, stack_name=stack_name
         )
-    return notifications_to_process
+        for notification in page
+    ]
 
 
 def get_notifications_to_clear(
     datetime_threshold, correlation_id=None, stack_name=const.STACK_NAME
 ):
-    ddb = Dynamodb(stack_name=stack_name, correlation_id=correlation_id)
-    return ddb.query(
-        table_name=NOTIFICATION_TABLE_NAME,
-        IndexName="processing-status-index",
-        KeyConditionExpression="processing_status = :status " "AND created < :t1",
-        ExpressionAttributeValues={
-            ":status": NotificationStatus.PROCESSED.value,
-            ":t1": str(datetime_threshold),
-        },
-        ScanIndexForward=False,
-    )
+    if CLEAR_FROM_LEGACY_STATUS_INDEX:
+        with use_client(
+            DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+        ) as ddb:
+            return ddb.query(
+                table_name=NOTIFICATION_TABLE_NAME,
+                IndexName=LEGACY_STATUS_INDEX,
+                KeyConditionExpression=f"{NotificationAttributes.STATUS.value} = "
+                ":status AND created < :t1",
+                ExpressionAttributeValues={
+                    ":status": NotificationStatus.PROCESSED.value,
+                    ":t1": str(datetime_threshold),
+                },
+                ScanIndexForward=False,
+            )
+
+    def query_shard(shard):
+        with use_client(
+            DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+        ) as ddb:
+            return ddb.query(
+                table_name=NOTIFICATION_TABLE_NAME,
+                IndexName=STATUS_SHARD_INDEX,
+                KeyConditionExpression=f"{NotificationAttributes.STATUS_SHARD.value} = "
+                ":status_shard AND created < :t1",
+                ExpressionAttributeValues={
+                    ":status_shard": get_status_shard_key(
+                        NotificationStatus.PROCESSED.value, shard
+                    ),
+                    ":t1": str(datetime_threshold),
+                },
+                ScanIndexForward=False,
+            )
+
+    shard_count = get_status_shard_count(correlation_id, stack_name=stack_name)
+    with ThreadPoolExecutor(max_workers=shard_count) as executor:
+        shard_results = executor.map(query_shard, range(shard_count))
+        return [n for notifications in shard_results for n in notifications]
 
 
 def get_notifications(
@@ -106,16 +378,18 @@ def get_notifications(
     correlation_id=None,
     stack_name=const.STACK_NAME,
 ):
-    ddb = Dynamodb(stack_name=stack_name, correlation_id=correlation_id)
-    notifications = ddb.scan(
-        NOTIFICATION_TABLE_NAME, filter_attr_name, filter_attr_values
-    )
-    return notifications
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        notifications = ddb.scan(
+            NOTIFICATION_TABLE_NAME, filter_attr_name, filter_attr_values
+        )
+        return notifications
 
 
 def delete_all_notifications(stack_name=const.STACK_NAME):
-    ddb = Dynamodb(stack_name=stack_name)
-    ddb.delete_all(NOTIFICATION_TABLE_NAME)
+    with use_client(DYNAMODB_CLIENT, stack_name=stack_name) as ddb:
+        ddb.delete_all(NOTIFICATION_TABLE_NAME)
 
 
 def create_notification(label: str):
@@ -140,6 +414,71 @@ def put_process_notifications_event():
     return result
 
 
+def request_notification_processing(correlation_id=None, stack_name=const.STACK_NAME):
+    """
+    Debounced alternative to put_process_notifications_event. A trigger marker in the
+    lookups table records that a processing run has been requested; while it is
+    present, further requests only flag that more work is pending, and the requested
+    run triggers one follow-up run when it finishes (see release_processing_trigger).
+
+    Returns:
+        True if a process_notifications event was put, False if the request was
+        coalesced with one already in progress
+    """
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        now = now_with_tz()
+        window_ends = now + timedelta(seconds=PROCESSING_TRIGGER_WINDOW_SECONDS)
+        try:
+            ddb.update_item(
+                LOOKUPS_TABLE_NAME,
+                PROCESSING_TRIGGER_KEY,
+                {"window_ends": str(window_ends)},
+                correlation_id,
+                ConditionExpression="attribute_not_exists(window_ends) "
+                "OR window_ends < :now",
+                ExpressionAttributeValues={":now": str(now)},
+            )
+        except ClientError as ex:
+            if ex.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            ddb.update_item(
+                LOOKUPS_TABLE_NAME,
+                PROCESSING_TRIGGER_KEY,
+                {"pending": True},
+                correlation_id,
+            )
+            return False
+        put_process_notifications_event()
+        return True
+
+
+def release_processing_trigger(correlation_id=None, stack_name=const.STACK_NAME):
+    """
+    Removes the trigger marker set by request_notification_processing, so that the
+    next request triggers a new run straight away. If processing was requested
+    while the marker was present, requests a new run.
+
+    Returns:
+        True if a new processing run was requested
+    """
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        table = ddb.get_table(LOOKUPS_TABLE_NAME)
+        response = table.update_item(
+            Key={"id": PROCESSING_TRIGGER_KEY},
+            UpdateExpression="REMOVE window_ends, pending",
+            ReturnValues="UPDATED_OLD",
+        )
+    if response.get("Attributes", dict()).get("pending"):
+        return request_notification_processing(
+            correlation_id=correlation_id, stack_name=stack_name
+        )
+    return False
+
+
 def save_notification(
     key,
     task_type,
@@ -148,19 +487,28 @@ def save_notification(
     correlation_id,
     stack_name=const.STACK_NAME,
 ):
-    ddb = Dynamodb(
-        stack_name=stack_name,
-        correlation_id=correlation_id,
+    notification_item.update(
+        get_status_updates(
+            {"id": key, "type": task_type, "details": task_signup},
+            notification_item[NotificationAttributes.STATUS.value],
+        )
     )
-    ddb.put_item(
-        NOTIFICATION_TABLE_NAME,
-        key,
-        task_type,
-        task_signup,
-        notification_item,
-        False,
-        correlation_id,
+    # new notifications are due straight away
+    notification_item[NotificationAttributes.NEXT_ATTEMPT_AT.value] = str(
+        now_with_tz()
     )
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        ddb.put_item(
+            NOTIFICATION_TABLE_NAME,
+            key,
+            task_type,
+            task_signup,
+            notification_item,
+            False,
+            correlation_id,
+        )
 
 
 def get_fail_count(notification):
@@ -174,34 +522,60 @@ def set_fail_count(notification, new_value):
     notification[NotificationAttributes.FAIL_COUNT.value] = new_value
 
 
+def get_retry_delay(fail_count):
+    """
+    Returns the number of seconds to wait before retrying a notification that has
+    failed fail_count times. The delay doubles with each failure, up to
+    RETRY_MAX_DELAY_SECONDS, and is randomised between half and all of that value
+    so that notifications that failed together are not all retried together.
+    """
+    delay = min(
+        RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** (fail_count - 1)
+    )
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
 def mark_notification_processed(
-    notification, correlation_id, stack_name=const.STACK_NAME
+    notification, correlation_id, stack_name=const.STACK_NAME, completion_buffer=None
 ):
     notification_id = notification["id"]
-    notification_updates = {
-        NotificationAttributes.STATUS.value: NotificationStatus.PROCESSED.value
-    }
-    ddb = Dynamodb(stack_name=stack_name)
-    return ddb.update_item(
-        NOTIFICATION_TABLE_NAME, notification_id, notification_updates, correlation_id
+    notification_updates = get_status_updates(
+        notification, NotificationStatus.PROCESSED.value
+    )
+    if completion_buffer is not None:
+        return completion_buffer.add(notification_id, notification_updates)
+    return update_notification(
+        notification_id, notification_updates, correlation_id, stack_name=stack_name
     )
 
 
 def mark_notification_failure(
-    notification, error_message, correlation_id, stack_name=const.STACK_NAME
+    notification,
+    error_message,
+    correlation_id,
+    stack_name=const.STACK_NAME,
+    completion_buffer=None,
 ):
     def update_notification_item(status_, fail_count_, error_message_=error_message):
         notification_updates = {
-            NotificationAttributes.STATUS.value: status_,
+            **get_status_updates(notification, status_),
             NotificationAttributes.FAIL_COUNT.value: fail_count_,
             NotificationAttributes.ERROR_MESSAGE.value: error_message_,
         }
-        ddb = Dynamodb(stack_name=stack_name)
-        return ddb.update_item(
-            NOTIFICATION_TABLE_NAME,
+        if status_ == NotificationStatus.RETRYING.value:
+            next_attempt_at = now_with_tz() + timedelta(
+                seconds=get_retry_delay(fail_count_)
+            )
+            notification_updates[NotificationAttributes.NEXT_ATTEMPT_AT.value] = str(
+                next_attempt_at
+            )
+        if completion_buffer is not None:
+            return completion_buffer.add(notification_id, notification_updates)
+        return update_notification(
             notification_id,
             notification_updates,
             correlation_id,
+            stack_name=stack_name,
         )
 
     logger = utils.get_logger()
@@ -234,99 +608,795 @@ def mark_notification_failure(
         return update_notification_item(status, fail_count)
 
 
+def mark_notification_deferred(
+    notification,
+    retry_after,
+    correlation_id,
+    stack_name=const.STACK_NAME,
+    completion_buffer=None,
+):
+    """
+    Returns a notification to the queue, to be retried in retry_after seconds,
+    without counting the attempt as a processing failure. Used when processing
+    could not be attempted (e.g. because HubSpot throttled our calls or a circuit
+    breaker is open)
+    """
+    logger = utils.get_logger()
+    logger.info(
+        "Deferred notification processing",
+        extra={
+            "notification_id": notification["id"],
+            "retry_after": retry_after,
+            "correlation_id": correlation_id,
+        },
+    )
+    notification_id = notification["id"]
+    next_attempt_at = now_with_tz() + timedelta(seconds=retry_after)
+    notification_updates = {
+        **get_status_updates(notification, NotificationStatus.RETRYING.value),
+        NotificationAttributes.NEXT_ATTEMPT_AT.value: str(next_attempt_at),
+    }
+    if completion_buffer is not None:
+        return completion_buffer.add(notification_id, notification_updates)
+    return update_notification(
+        notification_id, notification_updates, correlation_id, stack_name=stack_name
+    )
+
+
+class CompletionBuffer:
+    """
+    Write-behind buffer for the status updates made at the end of notification
+    processing (PROCESSED, RETRYING or DLQ), so that processing workers do not wait
+    for these writes.
+
+    Buffered updates are written in transactions of up to CLAIM_BATCH_SIZE items
+    whenever max_size updates are waiting, every flush_interval seconds and when the
+    buffer is used as a context manager and the context exits. On exit, updates
+    that could not be written are retried up to COMPLETION_FINAL_FLUSH_ATTEMPTS
+    times in total, as their notifications stay in PROCESSING otherwise.
+    """
+
+    def __init__(
+        self,
+        correlation_id=None,
+        stack_name=const.STACK_NAME,
+        max_size=COMPLETION_BUFFER_SIZE,
+        flush_interval=COMPLETION_FLUSH_INTERVAL_SECONDS,
+    ):
+        self.correlation_id = correlation_id
+        self.stack_name = stack_name
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.logger = get_logger()
+        self._updates = dict()  # notification id -> name_value_pairs
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._timer = threading.Thread(
+            target=self._flush_periodically, name="completion-buffer", daemon=True
+        )
+
+    def __enter__(self):
+        self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stopped.set()
+        self._timer.join()
+        failed = self.flush()
+        for attempt in range(1, COMPLETION_FINAL_FLUSH_ATTEMPTS):
+            if not failed:
+                break
+            time.sleep(COMPLETION_FINAL_FLUSH_DELAY_SECONDS * 2 ** (attempt - 1))
+            self._requeue(failed)
+            failed = self.flush()
+        if failed:
+            raise utils.DetailedIntegrityError(
+                "Failed to save the outcome of notification processing",
+                details={
+                    "updates": failed,
+                    "correlation_id": self.correlation_id,
+                },
+            )
+
+    def add(self, notification_id, name_value_pairs):
+        with self._lock:
+            self._updates[notification_id] = name_value_pairs
+            full = len(self._updates) >= self.max_size
+        if full:
+            self._requeue(self.flush())
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self._requeue(self.flush())
+            except Exception:
+                # keep flushing; updates not written are still in the buffer
+                self.logger.error(
+                    "Periodic flush of completion buffer failed",
+                    extra={
+                        "traceback": traceback.format_exc(),
+                        "correlation_id": self.correlation_id,
+                    },
+                )
+
+    def _requeue(self, failed_updates):
+        with self._lock:
+            for notification_id, name_value_pairs in failed_updates.items():
+                self._updates.setdefault(notification_id, name_value_pairs)
+
+    def _write_transaction(self, table, batch, modified):
+        table.meta.client.transact_write_items(
+            TransactItems=[
+                get_update_transact_item(
+                    table.name, notification_id, name_value_pairs, modified
+                )
+                for notification_id, name_value_pairs in batch
+            ]
+        )
+
+    def _write_one(self, notification_id, name_value_pairs):
+        update_notification(
+            notification_id,
+            name_value_pairs,
+            self.correlation_id,
+            stack_name=self.stack_name,
+        )
+
+    def flush(self):
+        """
+        Writes all buffered updates. Any error writing an update (not only
+        ClientError, but also connection errors) leaves it among those returned.
+
+        Returns:
+            Dict of updates that could not be written
+        """
+        with self._lock:
+            updates, self._updates = self._updates, dict()
+        failed = dict()
+        if not updates:
+            return failed
+        unwritten = dict(updates)
+        try:
+            with use_client(
+                DYNAMODB_CLIENT,
+                stack_name=self.stack_name,
+                correlation_id=self.correlation_id,
+            ) as ddb:
+                table = ddb.get_table(NOTIFICATION_TABLE_NAME)
+                items = list(updates.items())
+                for i in range(0, len(items), CLAIM_BATCH_SIZE):
+                    batch = items[i : i + CLAIM_BATCH_SIZE]
+                    try:
+                        self._write_transaction(table, batch, str(now_with_tz()))
+                    except Exception:
+                        # write items one by one, so that a single bad update does
+                        # not cause all the others to be lost
+                        self.logger.warning(
+                            "Batched notification status update failed; "
+                            "retrying one by one",
+                            extra={"traceback": traceback.format_exc()},
+                        )
+                        for notification_id, name_value_pairs in batch:
+                            try:
+                                self._write_one(notification_id, name_value_pairs)
+                            except Exception:
+                                self.logger.error(
+                                    "Failed to update notification status",
+                                    extra={
+                                        "notification_id": notification_id,
+                                        "updates": name_value_pairs,
+                                        "traceback": traceback.format_exc(),
+                                    },
+                                )
+                                failed[notification_id] = name_value_pairs
+                            del unwritten[notification_id]
+                    else:
+                        for notification_id, _ in batch:
+                            del unwritten[notification_id]
+        except Exception:
+            self.logger.error(
+                "Flush of completion buffer failed",
+                extra={
+                    "traceback": traceback.format_exc(),
+                    "correlation_id": self.correlation_id,
+                },
+            )
+        failed.update(unwritten)
+        return failed
+
+
+class TimelineEventBuffer:
+    """
+    Collects HubSpot timeline events (task signups and logins) and posts them in
+    batches of up to TIMELINE_EVENTS_BATCH_SIZE events, then marks each event's
+    notification as processed or failed. A batch is posted by the thread adding
+    the event that fills it; the remaining events are posted when the buffer is
+    used as a context manager and the context exits.
+
+    HubSpot accepts or rejects a batch as a whole, so rejected batches are split in
+    halves and retried until the events causing the rejection are isolated. Batches
+    failing because HubSpot is unavailable are not split; batches that are throttled
+    or refused by the circuit breaker are deferred.
+
+    Errors raised while marking notifications (i.e. notifications sent to the DLQ)
+    are collected in self.errors as (notification id, exception) tuples.
+    """
+
+    def __init__(
+        self,
+        completion_buffer=None,
+        dispatcher=None,
+        correlation_id=None,
+        max_size=TIMELINE_EVENTS_BATCH_SIZE,
+        hubspot_base_url=None,
+    ):
+        """
+        Args:
+            completion_buffer (CompletionBuffer): Buffer for status updates
+            dispatcher (LaneExecutor): If set, the buffer is only flushed on exit
+                    once all calls submitted to dispatcher (which may add events)
+                    have run
+            correlation_id:
+            max_size (int): Number of events that triggers posting a batch
+            hubspot_base_url (str): Root URL of the HubSpot API
+        """
+        self.completion_buffer = completion_buffer
+        self.dispatcher = dispatcher
+        self.correlation_id = correlation_id
+        self.max_size = max_size
+        self.errors = list()
+        self.logger = get_logger()
+        self.hs_batch_client = HubSpotBatchClient(
+            base_url=hubspot_base_url, correlation_id=correlation_id
+        )
+        self._events = list()  # (notification, event) tuples
+        self._superseded = dict()  # login notification id -> superseded logins
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.dispatcher is not None:
+            self.dispatcher.wait()
+        self.flush()
+
+    def add_task_signup(self, notification, signup_details):
+        event = get_task_signup_timeline_event(
+            signup_details, self.hs_batch_client.get_task_signup_event_type_id()
+        )
+        self._add(notification, event)
+
+    def add_user_login(self, notification, superseded_logins=()):
+        event = get_login_timeline_event(
+            notification["details"],
+            notification["id"],
+            self.hs_batch_client.get_login_event_type_id(),
+            login_count=len(superseded_logins) + 1,
+        )
+        if superseded_logins:
+            with self._lock:
+                self._superseded[notification["id"]] = superseded_logins
+        self._add(notification, event)
+
+    def _add(self, notification, event):
+        with self._lock:
+            self._events.append((notification, event))
+            if len(self._events) < self.max_size:
+                return
+            batch, self._events = self._events, list()
+        self._post(batch)
+
+    def flush(self):
+        with self._lock:
+            events, self._events = self._events, list()
+        for i in range(0, len(events), self.max_size):
+            self._post(events[i : i + self.max_size])
+
+    def _post(self, batch):
+        try:
+            call_downstream(
+                HUBSPOT_CRM,
+                self.hs_batch_client.create_timeline_events,
+                [event for _, event in batch],
+            )
+        except (ThrottledError, CircuitOpenError) as ex:
+            for notification, _ in batch:
+                self._settle_superseded(notification, ex.retry_after)
+                mark_notification_deferred(
+                    notification,
+                    ex.retry_after,
+                    self.correlation_id,
+                    completion_buffer=self.completion_buffer,
+                )
+        except Exception as ex:
+            if (len(batch) == 1) or is_dependency_failure(ex):
+                for notification, _ in batch:
+                    self._settle_superseded(
+                        notification, get_retry_delay(get_fail_count(notification) + 1)
+                    )
+                    self._mark(mark_notification_failure, notification, str(ex))
+            else:
+                self.logger.info(
+                    "Batch of timeline events rejected; splitting it",
+                    extra={
+                        "batch_size": len(batch),
+                        "error": repr(ex),
+                        "correlation_id": self.correlation_id,
+                    },
+                )
+                middle = len(batch) // 2
+                self._post(batch[:middle])
+                self._post(batch[middle:])
+        else:
+            for notification, _ in batch:
+                self._mark(mark_notification_processed, notification)
+                self._settle_superseded(notification, None)
+
+    def _settle_superseded(self, notification, retry_after):
+        with self._lock:
+            superseded_logins = self._superseded.pop(notification["id"], ())
+        settle_superseded_logins(
+            superseded_logins,
+            retry_after,
+            self.correlation_id,
+            completion_buffer=self.completion_buffer,
+        )
+
+    def _mark(self, marking_function, notification, *args):
+        try:
+            marking_function(
+                notification,
+                *args,
+                self.correlation_id,
+                completion_buffer=self.completion_buffer,
+            )
+        except Exception as ex:
+            with self._lock:
+                self.errors.append((notification["id"], ex))
+
+
+def get_resume_cursor(correlation_id=None, stack_name=const.STACK_NAME):
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        item = ddb.get_item(
+            table_name=LOOKUPS_TABLE_NAME,
+            key=RESUME_CURSOR_KEY,
+            correlation_id=correlation_id,
+        )
+        if item is None:
+            return dict()
+        return item["cursor"]
+
+
+def save_resume_cursor(resume_cursor, correlation_id=None, stack_name=const.STACK_NAME):
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        return ddb.put_item(
+            table_name=LOOKUPS_TABLE_NAME,
+            key=RESUME_CURSOR_KEY,
+            item_type="processing_cursor",
+            item_details=dict(),
+            item={"cursor": resume_cursor},
+            update_allowed=True,
+            correlation_id=correlation_id,
+        )
+
+
+def clear_resume_cursor(correlation_id=None, stack_name=const.STACK_NAME):
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        return ddb.delete_item(
+            LOOKUPS_TABLE_NAME, RESUME_CURSOR_KEY, correlation_id=correlation_id
+        )
+
+
 # region processing
-@utils.lambda_wrapper
-@utils.api_error_handler
-def process_notifications(event, context):
-    logger = get_logger()
-    notifications = get_notifications_to_process(stack_name=const.STACK_NAME)
-    logger.info("process_notifications", extra={"count": str(len(notifications))})
-
-    # note that we need to process all registrations first, then do task signups (otherwise we might try to process a signup for someone not yet registered)
-    signup_notifications = list()
-    login_notifications = list()
-    transactional_emails = list()
-    processing_tests = list()
+def get_lane_key(notification):
+    """
+    Returns the key of the processing lane a notification belongs to. Notifications
+    about the same user share a lane, so that they are processed in order (e.g. a
+    user's registration is posted to HubSpot before their task signups)
+    """
+    details = notification.get("details") or dict()
+    notification_type = notification[NotificationAttributes.TYPE.value]
+    if notification_type in [
+        NotificationType.USER_REGISTRATION.value,
+        NotificationType.USER_LOGIN.value,
+    ]:
+        lane_key = details.get("id")
+    elif notification_type == NotificationType.TASK_SIGNUP.value:
+        lane_key = details.get("user_id")
+    elif notification_type == NotificationType.TRANSACTIONAL_EMAIL.value:
+        lane_key = details.get("to_recipient_id") or details.get("to_recipient_email")
+    else:
+        lane_key = None
+    return lane_key or notification["id"]
+
+
+def get_processing_order(notification):
+    """
+    Sort key placing registrations ahead of other notification types
+    """
+    return (
+        PROCESSING_PRIORITY.get(notification[NotificationAttributes.TYPE.value], 0),
+        notification.get("created", ""),
+    )
+
+
+def get_processing_deadline(context):
+    """
+    Returns the time.monotonic() value after which no more notifications should be
+    dispatched, or None if there is no lambda context to get a time budget from
+    """
+    if context is None:
+        return None
+    remaining_seconds = context.get_remaining_time_in_millis() / 1000
+    return time.monotonic() + remaining_seconds - PROCESSING_DEADLINE_MARGIN_SECONDS
+
+
+def get_processors():
+    return {
+        NotificationType.USER_REGISTRATION.value: process_user_registration,
+        NotificationType.TASK_SIGNUP.value: process_task_signup,
+        NotificationType.USER_LOGIN.value: process_user_login,
+        NotificationType.TRANSACTIONAL_EMAIL.value: process_transactional_email,
+        NotificationType.PROCESSING_TEST.value: process_test,
+    }
+
+
+def coalesce_user_logins(notifications):
+    """
+    Groups user-login notifications by user, so that only each user's most recent
+    login is posted to HubSpot
+
+    Returns:
+        Dict mapping the id of each user's most recent login notification to the
+        list of that user's other login notifications, which it supersedes
+    """
+    logins_by_user = dict()
     for notification in notifications:
-        notification_type = notification["type"]
-        if notification_type == NotificationType.USER_REGISTRATION.value:
-            process_user_registration(notification)
-        elif notification_type == NotificationType.TASK_SIGNUP.value:
-            # add to list for later processing
-            signup_notifications.append(notification)
-        elif notification_type == NotificationType.USER_LOGIN.value:
-            # add to list for later processing
-            login_notifications.append(notification)
-        elif notification_type == NotificationType.TRANSACTIONAL_EMAIL.value:
-            transactional_emails.append(notification)
-        elif notification_type == NotificationType.PROCESSING_TEST.value:
-            processing_tests.append(notification)
+        if notification["type"] == NotificationType.USER_LOGIN.value:
+            logins_by_user.setdefault(get_lane_key(notification), list()).append(
+                notification
+            )
+    latest = dict()
+    for logins in logins_by_user.values():
+        logins.sort(key=lambda n: (n["details"]["login_datetime"], n["created"]))
+        latest[logins[-1]["id"]] = logins[:-1]
+    return latest
+
+
+def settle_superseded_logins(
+    superseded_logins, retry_after, correlation_id, completion_buffer=None
+):
+    """
+    Marks the logins superseded by a login notification (see coalesce_user_logins)
+    once the outcome of posting that login is known: as processed if it was posted
+    (retry_after is None), otherwise as deferred by retry_after seconds, so that
+    they are coalesced with it again when it is retried and their count is not lost
+    """
+    for notification in superseded_logins:
+        if retry_after is None:
+            mark_notification_processed(
+                notification, correlation_id, completion_buffer=completion_buffer
+            )
         else:
-            error_message = (
-                f"Processing of {notification_type} notifications not implemented yet"
+            mark_notification_deferred(
+                notification,
+                retry_after,
+                correlation_id,
+                completion_buffer=completion_buffer,
             )
-            logger.error(error_message)
-            raise NotImplementedError(error_message)
 
-    for signup_notification in signup_notifications:
-        process_task_signup(signup_notification)
 
-    for login_notification in login_notifications:
-        process_user_login(login_notification)
+def dispatch_claimed_notifications(
+    notifications, dispatcher, completion_buffer, timeline_buffer=None
+):
+    """
+    Submits notifications already marked as being processed to dispatcher (a
+    LaneExecutor). Registrations are posted to HubSpot in batches first (see
+    process_user_registration_batch). Only the most recent login of each user is
+    posted; the others are marked along with it (see settle_superseded_logins). If
+    timeline_buffer is set, the timeline events of task signups and logins are
+    added to it instead of being posted one by one.
+
+    Transactional emails are sent in a batch (see
+    process_transactional_email_batch), except those addressed to a user whose
+    registration is being processed, which must wait for it in the user's lane.
+    """
+    processors = get_processors()
+    registrations = list()
+    emails = list()
+    others = list()
+    for notification in sorted(notifications, key=get_processing_order):
+        if notification["type"] == NotificationType.USER_REGISTRATION.value:
+            registrations.append(notification)
+        elif notification["type"] == NotificationType.TRANSACTIONAL_EMAIL.value:
+            emails.append(notification)
+        else:
+            others.append(notification)
+    process_user_registration_batch(registrations, dispatcher, completion_buffer)
+    registering = {get_lane_key(n) for n in registrations}
+    batchable_emails = list()
+    for notification in emails:
+        if get_lane_key(notification) in registering:
+            others.append(notification)
+        else:
+            batchable_emails.append(notification)
+    process_transactional_email_batch(batchable_emails, dispatcher, completion_buffer)
+
+    latest_logins = coalesce_user_logins(others)
+    superseded_ids = {
+        n["id"] for superseded in latest_logins.values() for n in superseded
+    }
+    if superseded_ids:
+        get_logger().info(
+            "Coalesced user logins",
+            extra={"users": len(latest_logins), "superseded": len(superseded_ids)},
+        )
+
+    for notification in others:
+        if notification["id"] in superseded_ids:
+            continue
+        kwargs = dict()
+        if notification["type"] in TIMELINE_EVENT_TYPES:
+            kwargs["timeline_buffer"] = timeline_buffer
+        if notification["id"] in latest_logins:
+            kwargs["superseded_logins"] = latest_logins[notification["id"]]
+        dispatcher.submit(
+            get_lane_key(notification),
+            processors[notification["type"]],
+            notification,
+            claimed=True,
+            completion_buffer=completion_buffer,
+            **kwargs,
+        )
+
 
-    for email in transactional_emails:
-        process_transactional_email(email)
+@utils.lambda_wrapper
+@utils.api_error_handler
+def process_notifications(event, context):
+    """
+    Processes notifications awaiting processing until none are left or the lambda
+    approaches its timeout. Each page of notifications is claimed in a single
+    transactional write before being dispatched. When the lambda approaches its
+    timeout, notifications not yet claimed are left untouched and a resume cursor is
+    saved to the lookups table, so that the next run picks up where this one stopped.
+    """
+    logger = get_logger()
+    correlation_id = event.get("correlation_id")
+    deadline = get_processing_deadline(context)
+    ensure_index_keys_backfilled(correlation_id, deadline=deadline)
+    resume_cursor = get_resume_cursor(correlation_id=correlation_id)
+    get_user_directory().clear()
+    processors = get_processors()
+
+    # notifications about the same user are processed serially in their own lane, so
+    # we must queue registrations first (otherwise we might try to process a signup
+    # for someone not yet registered); notifications about different users are
+    # processed in parallel. Pages are dispatched as soon as they are read, while the
+    # next page is fetched in the background. Processing outcomes are saved by the
+    # completion buffer, which is flushed after all dispatched notifications are done
+    count = 0
+    claim_conflicts = 0
+    deferred = list()
+    with CompletionBuffer(
+        correlation_id=correlation_id
+    ) as completion_buffer, LaneExecutor(
+        max_workers=PROCESSING_WORKERS, max_pending=NOTIFICATIONS_PAGE_SIZE
+    ) as dispatcher, TimelineEventBuffer(
+        completion_buffer, dispatcher, correlation_id=correlation_id
+    ) as timeline_buffer:
+        pages = prefetch(
+            iter_notification_pages(
+                resume_cursor=resume_cursor, stack_name=const.STACK_NAME
+            )
+        )
+        for page in pages:
+            if (deadline is not None) and (time.monotonic() > deadline):
+                deferred = page
+                break
+            for notification in page:
+                notification_type = notification["type"]
+                if notification_type not in processors:
+                    error_message = (
+                        f"Processing of {notification_type} notifications not implemented yet"
+                    )
+                    logger.error(error_message)
+                    raise NotImplementedError(error_message)
+            claimed = claim_notifications(page, correlation_id=correlation_id)
+            claim_conflicts += len(page) - len(claimed)
+            dispatch_claimed_notifications(
+                claimed, dispatcher, completion_buffer, timeline_buffer
+            )
+            count += len(claimed)
+        pages.close()
+
+    summary = {
+        "dispatched": count,
+        "claim_conflicts": claim_conflicts,
+        # set when the deadline was reached with notifications still due; only the
+        # first page of those is read, so the size of the backlog is unknown
+        "more_pending": bool(deferred),
+    }
+    if deferred:
+        # pages only hold notifications of a single shard; the other shards are
+        # read from the start on the next run
+        next_attempt_at = NotificationAttributes.NEXT_ATTEMPT_AT.value
+        deferred_shard_key = deferred[0][NotificationAttributes.PENDING_WORK.value]
+        new_cursor = {
+            deferred_shard_key: min(n[next_attempt_at] for n in deferred),
+        }
+        save_resume_cursor(new_cursor, correlation_id=correlation_id)
+        summary.update(
+            {
+                "resume_cursor": new_cursor,
+                "deferred_notification_ids": [n["id"] for n in deferred],
+            }
+        )
+    elif resume_cursor:
+        clear_resume_cursor(correlation_id=correlation_id)
+    summary["follow_up_requested"] = release_processing_trigger(
+        correlation_id=correlation_id
+    )
+    logger.info("process_notifications", extra=summary)
 
-    for test in processing_tests:
-        process_test(test)
+    errors = dispatcher.errors + timeline_buffer.errors
+    if errors:
+        _, first_error = errors[0]
+        raise first_error
 
     return {
         "statusCode": HTTPStatus.OK,
+        "body": json.dumps(summary),
     }
 
 
-def process_test(notification):
+# process_notifications_stream only handles these; stream records are sharded by
+# notification id, so notifications about the same user may be processed by
+# concurrent invocations. Task signups must follow their user's registration and
+# logins are coalesced per user, so both are left to process_notifications
+STREAM_NOTIFICATION_TYPES = [
+    NotificationType.USER_REGISTRATION.value,
+    NotificationType.TRANSACTIONAL_EMAIL.value,
+]
+
+
+def deserialize_stream_image(image):
+    deserializer = TypeDeserializer()
+    return {k: deserializer.deserialize(v) for k, v in image.items()}
+
+
+@utils.lambda_wrapper
+def process_notifications_stream(event, context):
+    """
+    Processes NEW notifications of the STREAM_NOTIFICATION_TYPES as they are inserted
+    in the notifications table, from batches of DynamoDB stream records.
+    Notifications that fail to process are left as RETRYING for
+    process_notifications, which runs on a schedule as a safety net.
+
+    Only records whose notification could not be claimed are reported as batch item
+    failures, so that the stream retries them. Records whose processing outcome
+    could not be saved (even after the retries made by CompletionBuffer) are not:
+    their notification is already claimed, so a retried record would be skipped.
+    Those notifications are logged and stay in PROCESSING.
+    """
     logger = get_logger()
-    correlation_id = new_correlation_id()
-    mark_notification_being_processed(notification)
-    ddb_client = Dynamodb(stack_name=const.STACK_NAME)
-    test_processing_count = ddb_client.get_item(
-        table_name="lookups",
-        key="test_simultaneous_notification_processing_count",
-    )
-    new_count = int(test_processing_count["processing_attempts"]) + 1
-    ddb_client.put_item(
-        table_name="lookups",
-        key="test_simultaneous_notification_processing_count",
-        item_type="unittest_data",
-        item_details=dict(),
-        item={
-            "processing_attempts": new_count,
+    correlation_id = event.get("correlation_id")
+    logger.debug("Stream records", extra={"records": event["Records"]})
+    sequence_numbers = dict()  # notification id -> stream record sequence number
+    notifications = list()
+    for record in event["Records"]:
+        if record["eventName"] != "INSERT":
+            continue
+        notification = deserialize_stream_image(record["dynamodb"]["NewImage"])
+        if (
+            notification.get(NotificationAttributes.STATUS.value)
+            != NotificationStatus.NEW.value
+        ) or (notification["type"] not in STREAM_NOTIFICATION_TYPES):
+            continue
+        notifications.append(notification)
+        sequence_numbers[notification["id"]] = record["dynamodb"]["SequenceNumber"]
+
+    failed_ids = list()
+    claimed = list()
+    try:
+        with CompletionBuffer(
+            correlation_id=correlation_id
+        ) as completion_buffer, LaneExecutor(
+            max_workers=PROCESSING_WORKERS
+        ) as dispatcher, TimelineEventBuffer(
+            completion_buffer, dispatcher, correlation_id=correlation_id
+        ) as timeline_buffer:
+            try:
+                claimed = claim_notifications(
+                    notifications, correlation_id=correlation_id
+                )
+            except Exception:
+                logger.error(
+                    "Failed to claim notifications from stream",
+                    extra={"traceback": traceback.format_exc()},
+                )
+                failed_ids = list(sequence_numbers)
+            dispatch_claimed_notifications(
+                claimed, dispatcher, completion_buffer, timeline_buffer
+            )
+    except utils.DetailedIntegrityError as err:
+        logger.error(
+            "Notifications left in processing status",
+            extra={
+                "notification_ids": list(err.details["updates"]),
+                "correlation_id": correlation_id,
+            },
+        )
+
+    logger.info(
+        "process_notifications_stream",
+        extra={
+            "records": len(event["Records"]),
+            "dispatched": len(claimed),
+            "failed": len(failed_ids),
         },
-        update_allowed=True,
     )
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": sequence_numbers[x]} for x in failed_ids
+        ],
+    }
+
+
+def process_test(notification, claimed=False, completion_buffer=None):
+    logger = get_logger()
+    correlation_id = new_correlation_id()
+    if not claimed:
+        mark_notification_being_processed(notification)
+    with use_client(DYNAMODB_CLIENT) as ddb_client:
+        test_processing_count = ddb_client.get_item(
+            table_name="lookups",
+            key="test_simultaneous_notification_processing_count",
+        )
+        new_count = int(test_processing_count["processing_attempts"]) + 1
+        ddb_client.put_item(
+            table_name="lookups",
+            key="test_simultaneous_notification_processing_count",
+            item_type="unittest_data",
+            item_details=dict(),
+            item={
+                "processing_attempts": new_count,
+            },
+            update_allowed=True,
+        )
     time.sleep(5)  # simulate a 5-seconds processing routine
-    return mark_notification_processed(notification, str(utils.new_correlation_id()))
+    return mark_notification_processed(
+        notification,
+        str(utils.new_correlation_id()),
+        completion_buffer=completion_buffer,
+    )
 
 
 def mark_notification_being_processed(notification, correlation_id=None):
     notification_id = notification["id"]
-    notification_updates = {
-        NotificationAttributes.STATUS.value: NotificationStatus.PROCESSING.value
-    }
-    ddb_client = Dynamodb(stack_name=const.STACK_NAME)
+    notification_updates = get_status_updates(
+        notification, NotificationStatus.PROCESSING.value
+    )
     try:
-        update_response = ddb_client.update_item(
-            NOTIFICATION_TABLE_NAME,
-            notification_id,
-            notification_updates,
-            correlation_id,
-            ConditionExpression=f"({NotificationAttributes.STATUS.value} IN (:cat1, :cat2))",
-            ExpressionAttributeValues={
-                ":cat1": NotificationStatus.NEW.value,
-                ":cat2": NotificationStatus.RETRYING.value,
-            },
-        )
+        with use_client(DYNAMODB_CLIENT) as ddb_client:
+            update_response = ddb_client.update_item(
+                NOTIFICATION_TABLE_NAME,
+                notification_id,
+                notification_updates,
+                correlation_id,
+                ConditionExpression=f"({NotificationAttributes.STATUS.value} IN "
+                "(:cat1, :cat2))",
+                ExpressionAttributeValues={
+                    ":cat1": NotificationStatus.NEW.value,
+                    ":cat2": NotificationStatus.RETRYING.value,
+                },
+            )
     except ClientError as ex:
         if ex.response["Error"]["Code"] == "ConditionalCheckFailedException":
             error_message = (
@@ -342,10 +1412,285 @@ def mark_notification_being_processed(notification, correlation_id=None):
         return update_response
 
 
-def process_user_registration(notification):
+def get_claim_transact_item(table_full_name, notification, modified):
+    status = NotificationAttributes.STATUS.value
+    update = get_update_transact_item(
+        table_full_name,
+        notification["id"],
+        get_status_updates(notification, NotificationStatus.PROCESSING.value),
+        modified,
+    )
+    update["Update"].update(
+        ConditionExpression=f"({status} IN (:cat1, :cat2))",
+    )
+    update["Update"]["ExpressionAttributeValues"].update(
+        {
+            ":cat1": NotificationStatus.NEW.value,
+            ":cat2": NotificationStatus.RETRYING.value,
+        }
+    )
+    return update
+
+
+def get_update_expression(name_value_pairs, modified):
+    """
+    Returns the UpdateExpression and attribute names and values of an update setting
+    the attributes in name_value_pairs; attributes whose value is None are removed
+    """
+    names = {f"#attr{i}": name for i, name in enumerate(name_value_pairs)}
+    values = dict()
+    assignments = ["modified = :modified"]
+    removals = list()
+    for i, (placeholder, value) in enumerate(zip(names, name_value_pairs.values())):
+        if value is None:
+            removals.append(placeholder)
+        else:
+            values[f":val{i}"] = value
+            assignments.append(f"{placeholder} = :val{i}")
+    update_expression = f"SET {', '.join(assignments)}"
+    if removals:
+        update_expression += f" REMOVE {', '.join(removals)}"
+    return {
+        "UpdateExpression": update_expression,
+        "ExpressionAttributeNames": names,
+        "ExpressionAttributeValues": {**values, ":modified": modified},
+    }
+
+
+def get_update_transact_item(
+    table_full_name, notification_id, name_value_pairs, modified
+):
+    return {
+        "Update": {
+            "TableName": table_full_name,
+            "Key": {"id": notification_id},
+            **get_update_expression(name_value_pairs, modified),
+        }
+    }
+
+
+def update_notification(
+    notification_id,
+    name_value_pairs,
+    correlation_id=None,
+    stack_name=const.STACK_NAME,
+    modified=None,
+):
+    """
+    Alternative to Dynamodb.update_item that removes attributes whose value is None
+    (e.g. the pending work key of notifications reaching a final status)
+    """
+    if modified is None:
+        modified = str(now_with_tz())
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        table = ddb.get_table(NOTIFICATION_TABLE_NAME)
+        return table.update_item(
+            Key={"id": notification_id},
+            **get_update_expression(name_value_pairs, modified),
+        )
+
+
+def get_backfill_progress(correlation_id=None, stack_name=const.STACK_NAME):
+    """
+    Returns the lookups item recording the progress of backfill_index_keys, or None
+    if it has not started
+    """
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        return ddb.get_item(
+            table_name=LOOKUPS_TABLE_NAME,
+            key=INDEX_KEYS_BACKFILL_KEY,
+            correlation_id=correlation_id,
+        )
+
+
+def save_backfill_progress(
+    last_evaluated_key, updated, correlation_id=None, stack_name=const.STACK_NAME
+):
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        return ddb.put_item(
+            table_name=LOOKUPS_TABLE_NAME,
+            key=INDEX_KEYS_BACKFILL_KEY,
+            item_type="notifications_backfill",
+            item_details=dict(),
+            item={
+                "done": last_evaluated_key is None,
+                "last_evaluated_key": last_evaluated_key,
+                "updated": updated,
+            },
+            update_allowed=True,
+            correlation_id=correlation_id,
+        )
+
+
+def backfill_index_keys(
+    correlation_id=None, stack_name=const.STACK_NAME, deadline=None
+):
+    """
+    Gives notifications saved before the status shard and pending work keys were
+    introduced the keys of their current status. Pending notifications without a
+    next_attempt_at are made due straight away. Notifications updated since the
+    scan started (and so given their keys by that update) are left alone.
+
+    The scan position is saved to the lookups table after each page, so a run that
+    stops at deadline (a time.monotonic() value) or times out is resumed by the
+    next call.
+
+    Returns:
+        True if the whole notifications table has been backfilled
+    """
+    progress = get_backfill_progress(correlation_id, stack_name=stack_name) or dict()
+    if progress.get("done"):
+        return True
+    status_shard = NotificationAttributes.STATUS_SHARD.value
+    next_attempt_at = NotificationAttributes.NEXT_ATTEMPT_AT.value
+    updated = int(progress.get("updated", 0))
+    scan_kwargs = {"FilterExpression": f"attribute_not_exists({status_shard})"}
+    if progress.get("last_evaluated_key"):
+        scan_kwargs["ExclusiveStartKey"] = progress["last_evaluated_key"]
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        table = ddb.get_table(NOTIFICATION_TABLE_NAME)
+        while True:
+            if (deadline is not None) and (time.monotonic() > deadline):
+                return False
+            result = table.scan(**scan_kwargs)
+            for item in result["Items"]:
+                status = item[NotificationAttributes.STATUS.value]
+                updates = get_status_updates(item, status)
+                if (status in PENDING_STATUSES) and (next_attempt_at not in item):
+                    updates[next_attempt_at] = item["created"]
+                try:
+                    table.update_item(
+                        Key={"id": item["id"]},
+                        ConditionExpression=f"attribute_not_exists({status_shard})",
+                        **get_update_expression(updates, item["modified"]),
+                    )
+                except ClientError as ex:
+                    error_code = ex.response["Error"]["Code"]
+                    if error_code != "ConditionalCheckFailedException":
+                        raise
+                else:
+                    updated += 1
+            last_evaluated_key = result.get("LastEvaluatedKey")
+            save_backfill_progress(
+                last_evaluated_key,
+                updated,
+                correlation_id=correlation_id,
+                stack_name=stack_name,
+            )
+            if last_evaluated_key is None:
+                get_logger().info(
+                    "Backfilled notification index keys",
+                    extra={"updated": updated, "correlation_id": correlation_id},
+                )
+                return True
+            scan_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+
+_index_keys_backfilled = False
+
+
+def ensure_index_keys_backfilled(
+    correlation_id=None, stack_name=const.STACK_NAME, deadline=None
+):
+    """
+    Runs backfill_index_keys, until deadline, unless it has already completed.
+    Must be called before the status shard or pending work indexes are queried;
+    notifications it has not reached yet are missing from those indexes.
+    """
+    global _index_keys_backfilled
+    if not _index_keys_backfilled:
+        _index_keys_backfilled = backfill_index_keys(
+            correlation_id, stack_name=stack_name, deadline=deadline
+        )
+
+
+def claim_notifications(notifications, correlation_id=None, stack_name=const.STACK_NAME):
+    """
+    Marks notifications as being processed using transactional writes of up to
+    CLAIM_BATCH_SIZE notifications each. Notifications that are no longer NEW or
+    RETRYING (i.e. another processing run claimed them first) are dropped from the
+    transaction, which is then retried with the remaining notifications.
+
+    Returns:
+        List of notifications successfully claimed by this call
+    """
+    logger = get_logger()
+    with use_client(
+        DYNAMODB_CLIENT, stack_name=stack_name, correlation_id=correlation_id
+    ) as ddb:
+        table = ddb.get_table(NOTIFICATION_TABLE_NAME)
+        claimed = list()
+        for i in range(0, len(notifications), CLAIM_BATCH_SIZE):
+            batch = notifications[i : i + CLAIM_BATCH_SIZE]
+            conflict_retries = 0
+            while batch:
+                modified = str(now_with_tz())
+                try:
+                    table.meta.client.transact_write_items(
+                        TransactItems=[
+                            get_claim_transact_item(table.name, n, modified)
+                            for n in batch
+                        ],
+                        ClientRequestToken=str(new_correlation_id()),
+                    )
+                except ClientError as ex:
+                    if ex.response["Error"]["Code"] != "TransactionCanceledException":
+                        raise
+                    reasons = ex.response.get("CancellationReasons", list())
+                    codes = [r.get("Code") for r in reasons]
+                    lost = [
+                        n
+                        for n, code in zip(batch, codes)
+                        if code == "ConditionalCheckFailed"
+                    ]
+                    if lost:
+                        logger.info(
+                            "Notifications already claimed by another processing run",
+                            extra={
+                                "notification_ids": [n["id"] for n in lost],
+                                "correlation_id": correlation_id,
+                            },
+                        )
+                        batch = [
+                            n
+                            for n, code in zip(batch, codes)
+                            if code != "ConditionalCheckFailed"
+                        ]
+                    elif (
+                        "TransactionConflict" in codes
+                        and conflict_retries < MAX_CLAIM_CONFLICT_RETRIES
+                    ):
+                        # another run is claiming some of the same notifications
+                        # right now
+                        conflict_retries += 1
+                        time.sleep(0.1 * conflict_retries)
+                    else:
+                        raise utils.DetailedIntegrityError(
+                            "Failed to mark notifications as being processed",
+                            details={
+                                "notification_ids": [n["id"] for n in batch],
+                                "ddb_response": ex.response,
+                            },
+                        )
+                else:
+                    claimed += batch
+                    break
+        return claimed
+
+
+def process_user_registration(notification, claimed=False, completion_buffer=None):
     logger = get_logger()
     correlation_id = new_correlation_id()
-    mark_notification_being_processed(notification, correlation_id)
+    if not claimed:
+        mark_notification_being_processed(notification, correlation_id)
     try:
         notification_id = notification["id"]
         details = notification["details"]
@@ -359,8 +1704,40 @@ def process_user_registration(notification):
                 "correlation_id": str(correlation_id),
             },
         )
-        hs_client = HubSpotClient(correlation_id=correlation_id)
-        hubspot_id, is_new = hs_client.post_new_user_to_crm(details)
+        with use_client(HUBSPOT_CLIENT, correlation_id=correlation_id) as hs_client:
+            hubspot_id, is_new = call_downstream(
+                HUBSPOT_CRM, hs_client.post_new_user_to_crm, details
+            )
+    except (ThrottledError, CircuitOpenError) as ex:
+        return mark_notification_deferred(
+            notification,
+            ex.retry_after,
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
+    except Exception as ex:
+        return mark_notification_failure(
+            notification,
+            str(ex),
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
+    return complete_user_registration(
+        notification, hubspot_id, is_new, correlation_id, completion_buffer
+    )
+
+
+def complete_user_registration(
+    notification, hubspot_id, is_new, correlation_id, completion_buffer=None
+):
+    """
+    Saves the HubSpot id of a newly registered user to their core record and marks
+    the registration notification as processed
+    """
+    logger = get_logger()
+    try:
+        notification_id = notification["id"]
+        user_id = notification["details"]["id"]
         logger.info(
             "process_user_registration: hubspot details",
             extra={
@@ -375,24 +1752,203 @@ def process_user_registration(notification):
             errorjson = {"user_id": user_id, "correlation_id": str(correlation_id)}
             raise DetailedValueError("could not find user in HubSpot", errorjson)
 
+        # signups and emails processed before core is patched can use the directory
+        try:
+            get_user_directory().put(
+                notification["details"], hubspot_id, correlation_id=correlation_id
+            )
+        except Exception:
+            logger.warning(
+                "Failed to save user to directory",
+                extra={
+                    "user_id": user_id,
+                    "traceback": traceback.format_exc(),
+                    "correlation_id": str(correlation_id),
+                },
+            )
+
         user_jsonpatch = [
             {"op": "replace", "path": "/crm_id", "value": str(hubspot_id)},
         ]
 
-        core_client = CoreApiClient(correlation_id=str(correlation_id))
-        patch_user_response = core_client.patch_user(user_id, user_jsonpatch)
-        marking_result = mark_notification_processed(notification, correlation_id)
+        with use_client(
+            CORE_API_CLIENT, correlation_id=str(correlation_id)
+        ) as core_client:
+            patch_user_response = call_downstream(
+                CORE_API, core_client.patch_user, user_id, user_jsonpatch
+            )
+        marking_result = mark_notification_processed(
+            notification, correlation_id, completion_buffer=completion_buffer
+        )
         return patch_user_response, marking_result
 
+    except (ThrottledError, CircuitOpenError) as ex:
+        mark_notification_deferred(
+            notification,
+            ex.retry_after,
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
     except Exception as ex:
         error_message = str(ex)
-        mark_notification_failure(notification, error_message, correlation_id)
+        mark_notification_failure(
+            notification,
+            error_message,
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
+
+
+def process_user_registration_batch(
+    notifications, dispatcher, completion_buffer=None, hubspot_base_url=None
+):
+    """
+    Posts registrations already marked as being processed to HubSpot using batch
+    contact upserts of up to CONTACTS_BATCH_SIZE users each. Upserts are made in the
+    calling thread; saving each user's HubSpot id and marking their notification
+    are then submitted to dispatcher (a LaneExecutor) in the user's lane, so that
+    they happen before any other notification about that user queued afterwards.
+
+    Registrations sharing an email address with one already in the batch are
+    submitted to process_user_registration instead, because HubSpot rejects batches
+    with duplicate ids. Batches HubSpot rejects as a whole are split until the
+    rejected registrations are isolated (see upsert_registration_batch).
+
+    Args:
+        notifications (list): User registration notifications
+        dispatcher (LaneExecutor):
+        completion_buffer (CompletionBuffer):
+        hubspot_base_url (str): Root URL of the HubSpot API (e.g. of a local
+                stand-in); defaults to common.hubspot.HUBSPOT_BASE_URL
+    """
+    correlation_id = new_correlation_id()
+    hs_batch_client = HubSpotBatchClient(
+        base_url=hubspot_base_url, correlation_id=correlation_id
+    )
+    unique = dict()  # lowercase email -> notification
+    for notification in notifications:
+        email = notification["details"]["email"].lower()
+        if email in unique:
+            dispatcher.submit(
+                get_lane_key(notification),
+                process_user_registration,
+                notification,
+                claimed=True,
+                completion_buffer=completion_buffer,
+            )
+        else:
+            unique[email] = notification
+    batchable = list(unique.items())
+    for i in range(0, len(batchable), CONTACTS_BATCH_SIZE):
+        upsert_registration_batch(
+            batchable[i : i + CONTACTS_BATCH_SIZE],
+            hs_batch_client,
+            dispatcher,
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
+
+
+def upsert_registration_batch(
+    batch, hs_batch_client, dispatcher, correlation_id, completion_buffer=None
+):
+    """
+    Upserts the HubSpot contacts of a batch of registrations and submits their
+    completion to dispatcher. If HubSpot rejects the batch as a whole (e.g. because
+    of a single invalid contact), the batch is split in two and each half retried,
+    so that only the registrations HubSpot actually rejects are marked as failed.
+
+    Args:
+        batch (list): (lowercase email, notification) tuples
+        hs_batch_client (HubSpotBatchClient):
+        dispatcher (LaneExecutor):
+        correlation_id:
+        completion_buffer (CompletionBuffer):
+    """
+    logger = get_logger()
+    logger.info(
+        "process_user_registration_batch: post to hubspot",
+        extra={
+            "notification_ids": [n["id"] for _, n in batch],
+            "correlation_id": str(correlation_id),
+        },
+    )
+    try:
+        results, errors = call_downstream(
+            HUBSPOT_CRM,
+            hs_batch_client.upsert_contacts,
+            [n["details"] for _, n in batch],
+        )
+    except (ThrottledError, CircuitOpenError) as ex:
+        for _, notification in batch:
+            mark_notification_deferred(
+                notification,
+                ex.retry_after,
+                correlation_id,
+                completion_buffer=completion_buffer,
+            )
+        return
+    except Exception as ex:
+        if (len(batch) > 1) and not is_dependency_failure(ex):
+            logger.info(
+                "Batch of HubSpot contacts rejected; splitting it",
+                extra={
+                    "batch_size": len(batch),
+                    "error": repr(ex),
+                    "correlation_id": str(correlation_id),
+                },
+            )
+            middle = len(batch) // 2
+            for half in (batch[:middle], batch[middle:]):
+                upsert_registration_batch(
+                    half,
+                    hs_batch_client,
+                    dispatcher,
+                    correlation_id,
+                    completion_buffer=completion_buffer,
+                )
+            return
+        logger.error(
+            "Batch upsert of HubSpot contacts failed",
+            extra={
+                "error": repr(ex),
+                "traceback": traceback.format_exc(),
+                "correlation_id": str(correlation_id),
+            },
+        )
+        results, errors = dict(), {email: str(ex) for email, _ in batch}
+
+    for email, notification in batch:
+        lane_key = get_lane_key(notification)
+        if email in results:
+            hubspot_id, is_new = results[email]
+            dispatcher.submit(
+                lane_key,
+                complete_user_registration,
+                notification,
+                hubspot_id,
+                is_new,
+                correlation_id,
+                completion_buffer=completion_buffer,
+            )
+        else:
+            dispatcher.submit(
+                lane_key,
+                mark_notification_failure,
+                notification,
+                errors.get(email, "Contact missing from HubSpot batch response"),
+                correlation_id,
+                completion_buffer=completion_buffer,
+            )
 
 
-def process_task_signup(notification):
+def process_task_signup(
+    notification, claimed=False, completion_buffer=None, timeline_buffer=None
+):
     logger = get_logger()
     correlation_id = new_correlation_id()
-    mark_notification_being_processed(notification, correlation_id)
+    if not claimed:
+        mark_notification_being_processed(notification, correlation_id)
     logger.info(
         "Processing task signup notification",
         extra={"notification": notification, "correlation_id": correlation_id},
@@ -413,8 +1969,20 @@ def process_task_signup(notification):
 
         # fetch hubspot id if not present in event
         if signup_details["crm_id"] is None:
-            core_client = CoreApiClient(correlation_id=str(correlation_id))
-            user = core_client.get_user_by_user_id(user_id=signup_details["user_id"])
+            directory_entry = get_user_directory().get(
+                signup_details["user_id"], correlation_id=correlation_id
+            )
+            if directory_entry is not None:
+                signup_details["crm_id"] = directory_entry["crm_id"]
+        if signup_details["crm_id"] is None:
+            with use_client(
+                CORE_API_CLIENT, correlation_id=str(correlation_id)
+            ) as core_client:
+                user = call_downstream(
+                    CORE_API,
+                    core_client.get_user_by_user_id,
+                    user_id=signup_details["user_id"],
+                )
             signup_details["crm_id"] = user["crm_id"]
             if signup_details["crm_id"] is None:
                 errorjson = {
@@ -423,8 +1991,14 @@ def process_task_signup(notification):
                     "correlation_id": str(correlation_id),
                 }
                 raise DetailedValueError("user does not have crm_id yet", errorjson)
-        hs_client = HubSpotClient(correlation_id=correlation_id)
-        posting_result = hs_client.post_task_signup_to_crm(signup_details)
+        if timeline_buffer is not None:
+            # notification is marked once the buffered event is posted
+            timeline_buffer.add_task_signup(notification, signup_details)
+            return posting_result, marking_result
+        with use_client(HUBSPOT_CLIENT, correlation_id=correlation_id) as hs_client:
+            posting_result = call_downstream(
+                HUBSPOT_CRM, hs_client.post_task_signup_to_crm, signup_details
+            )
         logger.debug(
             "Response from HubSpot API",
             extra={
@@ -433,20 +2007,39 @@ def process_task_signup(notification):
             },
         )
         if posting_result == http.HTTPStatus.NO_CONTENT:
-            marking_result = mark_notification_processed(notification, correlation_id)
+            marking_result = mark_notification_processed(
+                notification, correlation_id, completion_buffer=completion_buffer
+            )
+    except (ThrottledError, CircuitOpenError) as ex:
+        marking_result = mark_notification_deferred(
+            notification,
+            ex.retry_after,
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
     except Exception as ex:
         error_message = str(ex)
         marking_result = mark_notification_failure(
-            notification, error_message, correlation_id
+            notification,
+            error_message,
+            correlation_id,
+            completion_buffer=completion_buffer,
         )
     finally:
         return posting_result, marking_result
 
 
-def process_user_login(notification):
+def process_user_login(
+    notification,
+    claimed=False,
+    completion_buffer=None,
+    timeline_buffer=None,
+    superseded_logins=(),
+):
     logger = get_logger()
     correlation_id = new_correlation_id()
-    mark_notification_being_processed(notification, correlation_id)
+    if not claimed:
+        mark_notification_being_processed(notification, correlation_id)
     logger.info(
         "Processing user login notification",
         extra={"notification": notification, "correlation_id": correlation_id},
@@ -456,32 +2049,243 @@ def process_user_login(notification):
     try:
         # get basic data out of notification
         login_details = notification["details"]
-        hs_client = HubSpotClient(
-            correlation_id=correlation_id, stack_name=const.STACK_NAME
-        )
-        posting_result = hs_client.post_user_login_to_crm(login_details)
+        if timeline_buffer is not None:
+            # notification is marked once the buffered event is posted
+            timeline_buffer.add_user_login(
+                notification, superseded_logins=superseded_logins
+            )
+            return posting_result, marking_result
+        with use_client(HUBSPOT_CLIENT, correlation_id=correlation_id) as hs_client:
+            posting_result = call_downstream(
+                HUBSPOT_CRM, hs_client.post_user_login_to_crm, login_details
+            )
         logger.debug(
             "Response from HubSpot API",
             extra={"posting_result": posting_result, "correlation_id": correlation_id},
         )
         if posting_result == http.HTTPStatus.NO_CONTENT:
             marking_result = mark_notification_processed(
-                notification, correlation_id, stack_name=const.STACK_NAME
+                notification,
+                correlation_id,
+                stack_name=const.STACK_NAME,
+                completion_buffer=completion_buffer,
             )
+            settle_superseded_logins(
+                superseded_logins,
+                None,
+                correlation_id,
+                completion_buffer=completion_buffer,
+            )
+    except (ThrottledError, CircuitOpenError) as ex:
+        settle_superseded_logins(
+            superseded_logins,
+            ex.retry_after,
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
+        marking_result = mark_notification_deferred(
+            notification,
+            ex.retry_after,
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
     except Exception as ex:
         logger.debug("Traceback", extra={"traceback": traceback.format_exc()})
         error_message = str(ex)
+        settle_superseded_logins(
+            superseded_logins,
+            get_retry_delay(get_fail_count(notification) + 1),
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
         marking_result = mark_notification_failure(
-            notification, error_message, correlation_id, stack_name=const.STACK_NAME
+            notification,
+            error_message,
+            correlation_id,
+            stack_name=const.STACK_NAME,
+            completion_buffer=completion_buffer,
         )
     finally:
         return posting_result, marking_result
 
 
-def process_transactional_email(notification, mock_server=False):
+def prefetch_email_lookups(notifications, correlation_id=None):
+    """
+    Resolves the distinct recipients and project tasks of transactional emails
+    concurrently, so that the recipient resolver and project index already hold
+    them when the emails are validated. Lookup errors are only logged here; they
+    are raised again for the emails concerned.
+    """
+    logger = get_logger()
+    recipients = dict()  # to_recipient_id -> to_recipient_id_type
+    project_task_ids = set()
+    for notification in notifications:
+        details = notification["details"]
+        if details.get("to_recipient_id"):
+            recipients.setdefault(
+                details["to_recipient_id"], details.get("to_recipient_id_type")
+            )
+        custom_properties = details.get("custom_properties") or dict()
+        if custom_properties.get("project_task_id"):
+            project_task_ids.add(custom_properties["project_task_id"])
+    resolver = get_recipient_resolver()
+    project_index = get_project_index()
+    lookups = [
+        (resolver.resolve, recipient_id, id_space)
+        for recipient_id, id_space in recipients.items()
+    ] + [(project_index.get_project, pt_id) for pt_id in project_task_ids]
+
+    def look_up(lookup):
+        fn, *args = lookup
+        try:
+            fn(*args, correlation_id=correlation_id)
+        except Exception as ex:
+            logger.debug(
+                "Transactional email lookup failed",
+                extra={
+                    "lookup": args,
+                    "error": repr(ex),
+                    "correlation_id": str(correlation_id),
+                },
+            )
+
+    if not lookups:
+        return
+    with ThreadPoolExecutor(
+        max_workers=min(EMAIL_PREFETCH_WORKERS, len(lookups)),
+        thread_name_prefix="email-prefetch",
+    ) as executor:
+        list(executor.map(look_up, lookups))
+
+
+def process_transactional_email_batch(
+    notifications, dispatcher, completion_buffer=None, mock_server=False
+):
+    """
+    Sends transactional emails already marked as being processed. The recipients
+    and projects of all emails are looked up concurrently first (see
+    prefetch_email_lookups). Emails are then validated in the calling thread, one
+    template at a time, so that each template is loaded and compiled once. Sending
+    each valid email and marking its notification, or marking an email that failed
+    validation, is submitted to dispatcher (a LaneExecutor) in the recipient's lane.
+    This bounds the number of concurrent sends, and errors raised when marking
+    (e.g. when a notification is moved to the DLQ) are collected by dispatcher
+    instead of aborting the dispatch of other notifications.
+
+    Args:
+        notifications (list): Transactional email notifications
+        dispatcher (LaneExecutor):
+        completion_buffer (CompletionBuffer):
+        mock_server (bool): Send emails to HubSpot's mock server
+    """
+    from transactional_email import TransactionalEmail
+
     logger = get_logger()
     correlation_id = new_correlation_id()
-    mark_notification_being_processed(notification, correlation_id)
+    prefetch_email_lookups(notifications, correlation_id)
+    by_template = dict()
+    for notification in notifications:
+        template_name = notification["details"].get("template_name")
+        by_template.setdefault(template_name, list()).append(notification)
+    template_cache = get_template_cache()
+    prepared = dict()  # notification id -> TransactionalEmail ready to be sent
+    unprepared = dict()  # notification id -> (marking function, its argument)
+    for template_name, group in by_template.items():
+        logger.info(
+            "process_transactional_email_batch: validate emails",
+            extra={
+                "template_name": template_name,
+                "notification_ids": [n["id"] for n in group],
+                "correlation_id": str(correlation_id),
+            },
+        )
+        template, validator = None, None
+        try:
+            if template_name is not None:
+                template, validator = template_cache.get_with_validator(
+                    template_name, correlation_id=correlation_id
+                )
+        except Exception as ex:
+            # each email of the group will try loading the template itself
+            logger.error(
+                "Loading email template failed",
+                extra={
+                    "template_name": template_name,
+                    "error": repr(ex),
+                    "correlation_id": str(correlation_id),
+                },
+            )
+        for notification in group:
+            try:
+                email = TransactionalEmail(
+                    email_dict=notification["details"],
+                    send_id=notification["id"],
+                    correlation_id=correlation_id,
+                )
+                # emails of a group share their (read-only) template copy
+                email.template, email.validator = template, validator
+                email.prepare()
+            except (ThrottledError, CircuitOpenError) as ex:
+                unprepared[notification["id"]] = (
+                    mark_notification_deferred,
+                    ex.retry_after,
+                )
+            except Exception as ex:
+                unprepared[notification["id"]] = (mark_notification_failure, str(ex))
+            else:
+                prepared[notification["id"]] = email
+
+    # submitted in their original order, so that each lane keeps it
+    for notification in notifications:
+        lane_key = get_lane_key(notification)
+        email = prepared.get(notification["id"])
+        if email is not None:
+            dispatcher.submit(
+                lane_key,
+                process_transactional_email,
+                notification,
+                mock_server=mock_server,
+                claimed=True,
+                completion_buffer=completion_buffer,
+                email=email,
+            )
+        else:
+            marking_function, argument = unprepared[notification["id"]]
+            dispatcher.submit(
+                lane_key,
+                marking_function,
+                notification,
+                argument,
+                correlation_id,
+                completion_buffer=completion_buffer,
+            )
+
+
+def process_transactional_email(
+    notification,
+    mock_server=False,
+    claimed=False,
+    completion_buffer=None,
+    email=None,
+    inline=False,
+):
+    """
+    Args:
+        notification (dict):
+        mock_server (bool): Send the email to HubSpot's mock server
+        claimed (bool): The notification is already marked as being processed
+        completion_buffer (CompletionBuffer):
+        email (TransactionalEmail): The notification's email, if already prepared
+                (see process_transactional_email_batch)
+        inline (bool): The email is sent as its notification is saved (see
+                transactional_email.send_inline). A failed attempt is then not
+                counted as a processing failure and the notification is returned
+                to the queue to be retried straight away
+    """
+    logger = get_logger()
+    correlation_id = new_correlation_id() if email is None else email.correlation_id
+    if not claimed:
+        mark_notification_being_processed(notification, correlation_id)
     logger.info(
         "Processing transactional email",
         extra={"notification": notification, "correlation_id": correlation_id},
@@ -491,23 +2295,54 @@ def process_transactional_email(notification, mock_server=False):
     try:
         from transactional_email import TransactionalEmail
 
-        email = TransactionalEmail(
-            email_dict=notification["details"],
-            send_id=notification["id"],
-            correlation_id=correlation_id,
-        )
+        if email is None:
+            email = TransactionalEmail(
+                email_dict=notification["details"],
+                send_id=notification["id"],
+                correlation_id=correlation_id,
+            )
         posting_result = email.send(mock_server=mock_server)
         logger.debug(
             "Response from HubSpot API",
             extra={"posting_result": posting_result, "correlation_id": correlation_id},
         )
-        if posting_result.status_code == http.HTTPStatus.OK:
-            marking_result = mark_notification_processed(notification, correlation_id)
+        if posting_result.status_code != http.HTTPStatus.OK:
+            errorjson = {
+                "status_code": posting_result.status_code,
+                "correlation_id": str(correlation_id),
+            }
+            raise DetailedValueError("HubSpot did not send email", errorjson)
+        marking_result = mark_notification_processed(
+            notification, correlation_id, completion_buffer=completion_buffer
+        )
+    except (ThrottledError, CircuitOpenError) as ex:
+        marking_result = mark_notification_deferred(
+            notification,
+            ex.retry_after,
+            correlation_id,
+            completion_buffer=completion_buffer,
+        )
     except Exception as ex:
         error_message = str(ex)
-        marking_result = mark_notification_failure(
-            notification, error_message, correlation_id
-        )
+        if inline:
+            logger.warning(
+                "Inline send of transactional email failed",
+                extra={
+                    "notification_id": notification["id"],
+                    "error": error_message,
+                    "correlation_id": correlation_id,
+                },
+            )
+            marking_result = mark_notification_deferred(
+                notification, 0, correlation_id, completion_buffer=completion_buffer
+            )
+        else:
+            marking_result = mark_notification_failure(
+                notification,
+                error_message,
+                correlation_id,
+                completion_buffer=completion_buffer,
+            )
     finally:
         return posting_result, marking_result
 
@@ -521,6 +2356,9 @@ def clear_notification_queue(event, context):
     logger = event["logger"]
     correlation_id = event["correlation_id"]
     seven_days_ago = now_with_tz() - timedelta(days=7)
+    ensure_index_keys_backfilled(
+        correlation_id, deadline=get_processing_deadline(context)
+    )
     # processed_notifications = get_notifications('processing_status', ['processed'])
     processed_notifications = get_notifications_to_clear(
         datetime_threshold=seven_days_ago, stack_name=const.STACK_NAME
@@ -535,29 +2373,29 @@ def clear_notification_queue(event, context):
         )
     ]
     deleted_notifications = list()
-    ddb_client = Dynamodb(stack_name=const.STACK_NAME)
-    for n in notifications_to_delete:
-        response = ddb_client.delete_item(
-            NOTIFICATION_TABLE_NAME, n["id"], correlation_id=correlation_id
-        )
-        if response["ResponseMetadata"]["HTTPStatusCode"] == http.HTTPStatus.OK:
-            deleted_notifications.append(n)
-        else:
-            logger.info(
-                f"Notifications deleted before an error occurred",
-                extra={
-                    "deleted_notifications": deleted_notifications,
-                    "correlation_id": correlation_id,
-                },
-            )
-            logger.error(
-                "Failed to delete notification",
-                extra={"notification": n, "response": response},
-            )
-            raise Exception(
-                f"Failed to delete notification {n}; received response: {response}"
+    with use_client(DYNAMODB_CLIENT) as ddb_client:
+        for n in notifications_to_delete:
+            response = ddb_client.delete_item(
+                NOTIFICATION_TABLE_NAME, n["id"], correlation_id=correlation_id
             )
-    return deleted_notifications
+            if response["ResponseMetadata"]["HTTPStatusCode"] == http.HTTPStatus.OK:
+                deleted_notifications.append(n)
+            else:
+                logger.info(
+                    f"Notifications deleted before an error occurred",
+                    extra={
+                        "deleted_notifications": deleted_notifications,
+                        "correlation_id": correlation_id,
+                    },
+                )
+                logger.error(
+                    "Failed to delete notification",
+                    extra={"notification": n, "response": response},
+                )
+                raise Exception(
+                    f"Failed to delete notification {n}; received response: {response}"
+                )
+        return deleted_notifications
 
 
 # endregion
@@ -88,3 +88,4 @@ def new_transactional_email_notification(email_dict, correlation_id=None):
         notification_item,
         correlation_id,
     )
+    return key
@@ -31,7 +31,7 @@ def record_task_signup_event(event, context):
     correlation_id = event["id"]
     new_user_task = event["detail"]
     notify_new_task_signup(new_user_task, correlation_id)
-    np.put_process_notifications_event()
+    np.request_notification_processing(correlation_id)
     return {
         "statusCode": HTTPStatus.NO_CONTENT,
     }
@@ -15,28 +15,38 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import os
 import validators
 from http import HTTPStatus
 from typing import Dict
 
-import thiscovery_lib.hubspot_utilities as hs
 import thiscovery_lib.utilities as utils
 import notification_process as np
-from thiscovery_lib.core_api_utilities import CoreApiClient
-from thiscovery_lib.dynamodb_utilities import Dynamodb
 
-import common.constants as const
+from common.clients import SINGLE_SEND_CLIENT, use_client
+from common.circuit_breaker import call_downstream
+from common.email_templates import get_template_cache, record_templates_change
+from common.projects import get_project_index
+from common.rate_limiting import HUBSPOT_SINGLE_SEND
+from common.recipients import get_recipient_resolver
 from notification_send import new_transactional_email_notification
 
 
-class TransactionalEmail:
-    templates_table = "HubspotEmailTemplates"
+# if "true", send_transactional_email sends emails straight away instead of leaving
+# them for the next process_notifications run, which retries failed attempts
+INLINE_SEND = (
+    os.environ.get("TRANSACTIONAL_EMAIL_INLINE_SEND", "false").lower() == "true"
+)
+
 
+class TransactionalEmail:
     def __init__(self, email_dict, send_id, correlation_id=None):
         """
         Args:
             email_dict (dict): must contain either a to_recipient_id (user_id or anon_project_specific_user_id) or a to_recipient_email.
-                    If both to_recipient_id and to_recipient_email are present, to_recipient_id will be used
+                    If both to_recipient_id and to_recipient_email are present, to_recipient_id will be used.
+                    An optional to_recipient_id_type ("user_id" or "anon_project_specific_user_id") saves a core API call
+                    if to_recipient_id is an anon_project_specific_user_id
             send_id (str): The ID of a particular send. No more than one email with a given sendId will be send per portal,
                     so including a sendId is a good way to prevent duplicate email sends. This will normally be the item id of the
                     notification table.
@@ -45,6 +55,7 @@ class TransactionalEmail:
         self.send_id = str(send_id)
         self.template_name = email_dict.get("template_name")
         self.to_recipient_id = email_dict.get("to_recipient_id")
+        self.to_recipient_id_type = email_dict.get("to_recipient_id_type")
         self.to_recipient_email = email_dict.get("to_recipient_email")
         if (self.to_recipient_id is None) and (self.to_recipient_email is None):
             raise utils.DetailedValueError(
@@ -60,16 +71,11 @@ class TransactionalEmail:
         self.email_dict = email_dict
         self.logger = utils.get_logger()
         self.correlation_id = str(correlation_id)
-        self.core_client = CoreApiClient(correlation_id=correlation_id)
-        self.ddb_client = Dynamodb(
-            correlation_id=correlation_id, stack_name=const.STACK_NAME
-        )
-        self.ss_client = hs.SingleSendClient(
-            correlation_id=correlation_id, stack_name=const.STACK_NAME
-        )
         self.template = None
+        self.validator = None
         self.user = None
         self.project = None
+        self.prepared = False
         self.template_lookup_map = {
             "user_email": self._lookup_user_email,
             "user_first_name": self._lookup_user_first_name,
@@ -101,10 +107,8 @@ class TransactionalEmail:
         return self.user["last_name"]
 
     def _get_template_details(self):
-        self.template = self.ddb_client.get_item(
-            table_name=self.templates_table,
-            key=self.template_name,
-            correlation_id=self.correlation_id,
+        self.template, self.validator = get_template_cache().get_with_validator(
+            self.template_name, correlation_id=self.correlation_id
         )
         if self.template is None:
             raise utils.ObjectDoesNotExistError(
@@ -115,71 +119,12 @@ class TransactionalEmail:
     def _validate_properties(self):
         if self.template is None:
             self._get_template_details()
-        for p_type in ["contact_properties", "custom_properties"]:
-            type_name = p_type.split("_")[0]
-            required_p_names = list()
-            optional_p_names = list()
-            # check all required properties are present in body of call
-            for p in self.template[p_type]:
-                if p["required"] is True:
-                    required_p_names.append(p["name"])
-                else:
-                    optional_p_names.append(p["name"])
-            self.logger.debug(
-                f"{type_name} properties in template",
-                extra={
-                    "required_p_names": required_p_names,
-                    "optional_p_names": optional_p_names,
-                },
-            )
-
-            for p_name in required_p_names:
-                try:  # get property value from email_dict
-                    p_value = self.email_dict[p_type][p_name]
-                except KeyError:
-                    try:  # lookup property value using appropriate class method
-                        p_value = self.template_lookup_map[p_name]()
-                    except KeyError:
-                        raise utils.DetailedValueError(
-                            f"Required {type_name} property {p_name} not found in call body",
-                            details={
-                                "email_dict": self.email_dict,
-                                "correlation_id": self.correlation_id,
-                            },
-                        )
-
-                if not p_value:
-                    raise utils.DetailedValueError(
-                        f"Required {type_name} property {p_name} cannot be null",
-                        details={
-                            "email_dict": self.email_dict,
-                            "correlation_id": self.correlation_id,
-                        },
-                    )
-                else:
-                    self.email_dict[p_type][p_name] = p_value
-
-            # check all properties in body of call are either specified in template or used for lookup
-            properties_in_call = self.email_dict.get(p_type)
-            if properties_in_call is not None:
-                p_names_in_call = self.email_dict.get(p_type).keys()
-                for p in p_names_in_call:
-                    if p not in [
-                        *required_p_names,
-                        *optional_p_names,
-                        *self.lookup_properties,
-                    ]:
-                        raise utils.DetailedIntegrityError(
-                            f"Call {type_name} property {p} is not specified in email template",
-                            details={
-                                "email_dict": self.email_dict,
-                                f"template_required_{type_name}_properties": self.template[
-                                    p_type
-                                ],
-                                "correlation_id": self.correlation_id,
-                            },
-                        )
-        return True
+        return self.validator.validate(
+            self.email_dict,
+            self.template_lookup_map,
+            self.lookup_properties,
+            self.correlation_id,
+        )
 
     def _get_project(self) -> Dict[str, str]:
         """
@@ -188,29 +133,19 @@ class TransactionalEmail:
         pt_id_name = "project_task_id"
         self.lookup_properties.append(pt_id_name)
         pt_id = self.email_dict["custom_properties"].get(pt_id_name)
-        projects = self.core_client.get_projects()
-        for p in projects:
-            for t in p["tasks"]:
-                if t["id"] == pt_id:
-                    self.project = {"project_name": p["name"]}
-                    return self.project
+        project = get_project_index().get_project(
+            pt_id, correlation_id=self.correlation_id
+        )
+        if project is not None:
+            self.project = {"project_name": project["name"]}
+            return self.project
 
     def _get_user(self):
-        try:
-            self.user = self.core_client.get_user_by_user_id(self.to_recipient_id)
-        except AssertionError:
-            try:
-                self.user = self.core_client.get_user_by_anon_project_specific_user_id(
-                    self.to_recipient_id
-                )
-            except AssertionError:
-                raise utils.ObjectDoesNotExistError(
-                    "Recipient id does not match any known user_id or anon_project_specific_user_id",
-                    details={
-                        "to_recipient_id": self.to_recipient_id,
-                        "correlation_id": self.correlation_id,
-                    },
-                )
+        self.user = get_recipient_resolver().resolve(
+            self.to_recipient_id,
+            id_space=self.to_recipient_id_type,
+            correlation_id=self.correlation_id,
+        )
         return self.user
 
     @staticmethod
@@ -226,10 +161,12 @@ class TransactionalEmail:
                 )
             return output_list
 
-    def send(self, mock_server=False):
-        if mock_server:
-            self.ss_client.mock_server = True
-        self._get_template_details()
+    def prepare(self):
+        """
+        Validates the email's properties against its template and resolves its
+        recipient, without sending it. Templates set beforehand (e.g. shared by a
+        batch of emails) are not reloaded.
+        """
         self._validate_properties()
         if self.to_recipient_id:
             user = self._get_user()
@@ -251,30 +188,80 @@ class TransactionalEmail:
                         "correlation_id": self.correlation_id,
                     },
                 )
+        self.prepared = True
+
+    def send(self, mock_server=False):
+        if not self.prepared:
+            self.prepare()
+        with use_client(
+            SINGLE_SEND_CLIENT, correlation_id=self.correlation_id
+        ) as ss_client:
+            # pooled clients are shared by emails, so this is set on every send
+            ss_client.mock_server = mock_server
+            return call_downstream(
+                HUBSPOT_SINGLE_SEND,
+                ss_client.send_email,
+                template_id=self.template["hs_template_id"],
+                message={
+                    "from": self.template["from"],
+                    "to": self.to_recipient_email,
+                    "cc": self.template["cc"],
+                    "bcc": self.template["bcc"],
+                    "sendId": self.send_id,
+                },
+                contactProperties=self._format_properties_to_name_value(
+                    self.email_dict.get("contact_properties")
+                ),
+                customProperties=self._format_properties_to_name_value(
+                    self.email_dict.get("custom_properties")
+                ),
+            )
 
-        return self.ss_client.send_email(
-            template_id=self.template["hs_template_id"],
-            message={
-                "from": self.template["from"],
-                "to": self.to_recipient_email,
-                "cc": self.template["cc"],
-                "bcc": self.template["bcc"],
-                "sendId": self.send_id,
+
+def send_inline(notification_id, email_dict, correlation_id=None, mock_server=False):
+    """
+    Claims and sends the email of a transactional email notification that has just
+    been saved. The notification id is the email's sendId, so HubSpot never sends
+    it twice, even if a processing run retries it later. If sending fails, the
+    notification is returned to the queue without counting the attempt as a
+    processing failure.
+
+    Returns:
+        True if the email was sent and its notification marked as processed; False
+        if the notification was left for (or already claimed by) a processing run
+    """
+    notification = {
+        "id": notification_id,
+        "type": np.NotificationType.TRANSACTIONAL_EMAIL.value,
+        "details": email_dict,
+    }
+    try:
+        posting_result, marking_result = np.process_transactional_email(
+            notification, mock_server=mock_server, inline=True
+        )
+    except utils.DetailedIntegrityError as err:
+        utils.get_logger().info(
+            "Inline send of transactional email aborted",
+            extra={
+                "notification_id": notification_id,
+                "error": str(err),
+                "correlation_id": correlation_id,
             },
-            contactProperties=self._format_properties_to_name_value(
-                self.email_dict.get("contact_properties")
-            ),
-            customProperties=self._format_properties_to_name_value(
-                self.email_dict.get("custom_properties")
-            ),
         )
+        return False
+    return (
+        posting_result is not None
+        and posting_result.status_code == HTTPStatus.OK
+        and marking_result is not None
+    )
 
 
 @utils.lambda_wrapper
 @utils.api_error_handler
 def send_transactional_email(event, context):
     """
-    Processes transactional_email events
+    Processes transactional_email events. If INLINE_SEND is set, the email is
+    sent straight away and only left for notification processing if that fails.
     """
     logger = event["logger"]
     correlation_id = event["correlation_id"]
@@ -282,8 +269,29 @@ def send_transactional_email(event, context):
     alarm_test = email_dict.get("brew_coffee")
     if alarm_test:
         raise utils.DeliberateError("Coffee is not available", details={})
-    new_transactional_email_notification(email_dict, correlation_id)
-    np.put_process_notifications_event()
+    notification_id = new_transactional_email_notification(email_dict, correlation_id)
+    if INLINE_SEND and not send_inline(notification_id, email_dict, correlation_id):
+        # the stream record of the notification was skipped while it was claimed
+        np.request_notification_processing(correlation_id)
     return {
         "statusCode": HTTPStatus.NO_CONTENT,
     }
+
+
+@utils.lambda_wrapper
+def process_email_templates_stream(event, context):
+    """
+    Processes batches of DynamoDB stream records of the HubspotEmailTemplates
+    table, recording that templates have changed so that cached copies are
+    reloaded
+    """
+    logger = utils.get_logger()
+    correlation_id = event.get("correlation_id")
+    record_templates_change(correlation_id=correlation_id)
+    logger.info(
+        "Recorded email templates change",
+        extra={
+            "record_count": len(event["Records"]),
+            "correlation_id": correlation_id,
+        },
+    )
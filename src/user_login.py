@@ -18,9 +18,9 @@
 import json
 from http import HTTPStatus
 import thiscovery_lib.utilities as utils
-from thiscovery_lib.core_api_utilities import CoreApiClient
 
 import common.constants as const
+from common.clients import CORE_API_CLIENT, use_client
 import notification_process as np
 import notification_send as notif_send
 
@@ -44,8 +44,8 @@ def record_user_login_event(event, context):
     event_type = detail_data["type"]
     login_datetime = detail_data["date"].replace("T", " ").replace("Z", "")
     user_email = detail_data["user_name"]
-    core_api_client = CoreApiClient(correlation_id=event_id)
-    user = core_api_client.get_user_by_email(email=user_email)
+    with use_client(CORE_API_CLIENT, correlation_id=event_id) as core_api_client:
+        user = core_api_client.get_user_by_email(email=user_email)
     for x in ["has_demo_project", "has_live_project", "title"]:
         del user[x]
     login_info = {
@@ -57,5 +57,5 @@ def record_user_login_event(event, context):
         event_id,
         stack_name=const.STACK_NAME,
     )
-    np.put_process_notifications_event()
+    np.request_notification_processing(event_id)
     return {"statusCode": HTTPStatus.OK, "body": json.dumps("")}
@@ -16,12 +16,20 @@
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
 import csv
+import json
 import os
+import ssl
+import subprocess
+import threading
 import thiscovery_lib.utilities as utils
+from collections import deque
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from thiscovery_lib.core_api_utilities import CoreApiClient
 from thiscovery_lib.hubspot_utilities import HubSpotClient
 
 from notification_process import get_notifications
+from common.hubspot import CONTACTS_BATCH_UPSERT_URL, TIMELINE_EVENTS_BATCH_URL
 
 
 BASE_FOLDER = os.path.join(
@@ -30,6 +38,9 @@ BASE_FOLDER = os.path.join(
 TEST_DATA_FOLDER = os.path.join(
     os.path.dirname(os.path.realpath(__file__)), "..", "test_data"
 )
+STREAM_EVENTS_FOLDER = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "stream_events"
+)
 
 
 def post_sample_users_to_crm(user_test_data_csv, hs_client=None):
@@ -61,6 +72,16 @@ def post_sample_users_to_crm(user_test_data_csv, hs_client=None):
             )
 
 
+def load_stream_event(file_name):
+    """
+    Loads a batch of DynamoDB stream records recorded as JSON (e.g. copied from the
+    "Stream records" debug log of process_notifications_stream), so that it can be
+    replayed locally
+    """
+    with open(os.path.join(STREAM_EVENTS_FOLDER, file_name)) as f:
+        return json.load(f)
+
+
 def get_expected_notification(expected_id):
     notifications = get_notifications()
     for n in notifications:
@@ -73,3 +94,210 @@ def get_expected_user_login_notification(expected_user_id):
     for n in notifications:
         if (n["type"] == "user-login") and (n["details"]["id"] == expected_user_id):
             return n
+
+
+class MockLambdaContext:
+    """
+    Minimal stand-in for the context object passed to lambda handlers
+    """
+
+    def __init__(self, remaining_time_in_millis=900000):
+        self.remaining_time_in_millis = remaining_time_in_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_time_in_millis
+
+
+def make_self_signed_certificate(folder):
+    """
+    Creates a self-signed certificate for 127.0.0.1 using the openssl command line
+    tool
+
+    Returns:
+        Tuple (certfile, keyfile) of paths in folder
+    """
+    certfile = os.path.join(folder, "cert.pem")
+    keyfile = os.path.join(folder, "key.pem")
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            "/CN=127.0.0.1",
+            "-addext",
+            "subjectAltName=IP:127.0.0.1",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return certfile, keyfile
+
+
+class HubSpotStandIn:
+    """
+    Local stand-in for the HubSpot API endpoints called by common.hubspot, served
+    on a free port of localhost over plain HTTP or, if certfile and keyfile are
+    given, HTTPS (see make_self_signed_certificate). Connections are kept alive
+    between requests. Use as a context manager and pass base_url to the client
+    under test.
+
+    Attributes:
+        app_id (str): HubSpot app id to pass to the client under test
+        contacts (dict): Lowercase email -> contact (id and properties)
+        timeline_events (dict): Event id -> timeline event
+        received (list): (method, path, parsed body) of every request received
+        rejected_emails (set): Contacts with these emails are reported as errors
+        invalid_emails (set): Batches of contacts including any of these emails
+                are rejected as a whole
+        rejected_event_ids (set): Batches of timeline events including any of
+                these event ids are rejected
+        queued_statuses (deque): Status codes returned, in order, instead of
+                processing the next requests (e.g. 429 or 500)
+    """
+
+    def __init__(self, certfile=None, keyfile=None):
+        self.app_id = "1"
+        self.contacts = dict()
+        self.timeline_events = dict()
+        self.received = list()
+        self.rejected_emails = set()
+        self.invalid_emails = set()
+        self.rejected_event_ids = set()
+        self.queued_statuses = deque()
+        self.routes = {
+            ("POST", CONTACTS_BATCH_UPSERT_URL): self.upsert_contacts,
+            (
+                "PUT",
+                TIMELINE_EVENTS_BATCH_URL.format(app_id=self.app_id),
+            ): self.create_timeline_events,
+        }
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._scheme = "http"
+        if certfile is not None:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self._server.socket = context.wrap_socket(
+                self._server.socket, server_side=True
+            )
+            self._scheme = "https"
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="hubspot-stand-in", daemon=True
+        )
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"{self._scheme}://{host}:{port}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _handler_class(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep connections alive
+            # headers and body are sent separately; don't let Nagle's algorithm
+            # hold the body back until the client acknowledges the headers
+            disable_nagle_algorithm = True
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or "null")
+                status, response_body = stand_in.handle(self.command, self.path, body)
+                self.send_response(status)
+                if response_body is None:
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                payload = json.dumps(response_body).encode()
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_PATCH = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def handle(self, method, path, body):
+        with self._lock:
+            self.received.append((method, path, body))
+            if self.queued_statuses:
+                status = self.queued_statuses.popleft()
+                return status, {"status": "error", "message": status.phrase}
+            try:
+                route = self.routes[(method, path)]
+            except KeyError:
+                return HTTPStatus.NOT_FOUND, {"status": "error"}
+            return route(body)
+
+    def upsert_contacts(self, body):
+        invalid = [
+            i["id"] for i in body["inputs"] if i["id"].lower() in self.invalid_emails
+        ]
+        if invalid:
+            return HTTPStatus.BAD_REQUEST, {
+                "status": "error",
+                "category": "VALIDATION_ERROR",
+                "message": f"Invalid contacts {invalid}",
+            }
+        results = list()
+        errors = list()
+        for contact_input in body["inputs"]:
+            email = contact_input["id"].lower()
+            if email in self.rejected_emails:
+                errors.append(
+                    {
+                        "status": "error",
+                        "category": "VALIDATION_ERROR",
+                        "message": f"Invalid contact {email}",
+                        "context": {"ids": [contact_input["id"]]},
+                    }
+                )
+                continue
+            is_new = email not in self.contacts
+            contact = self.contacts.setdefault(
+                email, {"id": str(len(self.contacts) + 1), "properties": dict()}
+            )
+            contact["properties"].update(contact_input["properties"], email=email)
+            results.append({**contact, "new": is_new})
+        status = HTTPStatus.MULTI_STATUS if errors else HTTPStatus.OK
+        return status, {"status": "COMPLETE", "results": results, "errors": errors}
+
+    def create_timeline_events(self, body):
+        events = body["eventWrappers"]
+        rejected = [e["id"] for e in events if e["id"] in self.rejected_event_ids]
+        if rejected:
+            return HTTPStatus.BAD_REQUEST, {
+                "status": "error",
+                "message": f"Invalid events {rejected}",
+            }
+        for event in events:
+            self.timeline_events[event["id"]] = event
+        return HTTPStatus.NO_CONTENT, None
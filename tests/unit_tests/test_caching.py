@@ -0,0 +1,45 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import time
+
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from src.common.caching import MISSING, TTLCache
+
+
+class TestTTLCache(test_tools.BaseTestCase):
+    def test_01_least_recently_used_entries_are_evicted(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.get("a"))
+        self.assertIs(MISSING, cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+
+    def test_02_entries_expire(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1, ttl=0.01)
+        cache.set("b", None)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a", None))
+        self.assertIs(MISSING, cache.get("a"))
+        # cached None values are told apart from missing entries
+        self.assertIsNone(cache.get("b"))
@@ -0,0 +1,123 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import time
+from http import HTTPStatus
+
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import src.common.circuit_breaker as cb
+
+
+def fail_with_connection_error():
+    raise ConnectionError("test connection error")
+
+
+class TestCircuitBreaker(test_tools.BaseTestCase):
+    def setUp(self):
+        self.breaker = cb.CircuitBreaker(
+            "unittest", failure_threshold=3, reset_timeout=0.2
+        )
+
+    def test_01_opens_after_consecutive_failures(self):
+        for _ in range(3):
+            self.breaker.before_call()
+            self.breaker.record_failure()
+        self.assertEqual(cb.CircuitState.OPEN, self.breaker.state)
+        with self.assertRaises(cb.CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_02_success_resets_failure_count(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.breaker.record_success()
+        for _ in range(2):
+            self.breaker.record_failure()
+        self.assertEqual(cb.CircuitState.CLOSED, self.breaker.state)
+
+    def test_03_half_open_probe(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        time.sleep(0.25)
+        self.breaker.before_call()  # probe
+        self.assertEqual(cb.CircuitState.HALF_OPEN, self.breaker.state)
+        with self.assertRaises(cb.CircuitOpenError):
+            self.breaker.before_call()  # only one probe at a time
+        self.breaker.record_success()
+        self.assertEqual(cb.CircuitState.CLOSED, self.breaker.state)
+        self.breaker.before_call()
+
+    def test_04_failed_probe_reopens_circuit(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        time.sleep(0.25)
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(cb.CircuitState.OPEN, self.breaker.state)
+
+
+class TestCallDownstream(test_tools.BaseTestCase):
+    def setUp(self):
+        cb._breakers["unittest"] = cb.CircuitBreaker(
+            "unittest", failure_threshold=2, reset_timeout=60
+        )
+
+    def test_01_only_dependency_failures_open_circuit(self):
+        for _ in range(3):
+            with self.assertRaises(KeyError):
+                cb.call_downstream("unittest", dict().__getitem__, "missing")
+        self.assertEqual(HTTPStatus.OK, cb.call_downstream("unittest", lambda: 200))
+
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                cb.call_downstream("unittest", fail_with_connection_error)
+        with self.assertRaises(cb.CircuitOpenError):
+            cb.call_downstream("unittest", lambda: 200)
+
+    def test_02_server_errors_count_as_failures(self):
+        for _ in range(2):
+            cb.call_downstream("unittest", lambda: HTTPStatus.BAD_GATEWAY)
+        with self.assertRaises(cb.CircuitOpenError):
+            cb.call_downstream("unittest", lambda: 200)
+
+    def test_03_core_api_server_errors_count_as_failures(self):
+        def core_api_call(status_code):
+            # mimics CoreApiClient, which asserts on every non-OK response
+            result = {"statusCode": status_code, "body": "{}"}
+            assert result["statusCode"] == HTTPStatus.OK, (
+                f"Call to core API returned error: {result}"
+            )
+            return result
+
+        breaker = cb._breakers[cb.CORE_API] = cb.CircuitBreaker(
+            cb.CORE_API, failure_threshold=2, reset_timeout=60
+        )
+        self.addCleanup(cb._breakers.pop, cb.CORE_API)
+        for _ in range(3):
+            with self.assertRaises(AssertionError):
+                cb.call_downstream(cb.CORE_API, core_api_call, HTTPStatus.NOT_FOUND)
+        self.assertEqual(cb.CircuitState.CLOSED, breaker.state)
+
+        for _ in range(2):
+            with self.assertRaises(cb.DependencyError) as context:
+                cb.call_downstream(
+                    cb.CORE_API, core_api_call, HTTPStatus.INTERNAL_SERVER_ERROR
+                )
+            self.assertEqual(500, context.exception.status_code)
+            self.assertIsInstance(context.exception.__cause__, AssertionError)
+        with self.assertRaises(cb.CircuitOpenError):
+            cb.call_downstream(cb.CORE_API, core_api_call, HTTPStatus.OK)
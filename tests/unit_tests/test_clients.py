@@ -0,0 +1,46 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from src.common.clients import DYNAMODB_CLIENT, ClientRegistry
+
+
+class TestClientRegistry(test_tools.BaseTestCase):
+    def setUp(self):
+        self.registry = ClientRegistry()
+
+    def test_01_clients_are_reused_with_the_correlation_id_of_each_checkout(self):
+        with self.registry.checkout(DYNAMODB_CLIENT, correlation_id="first") as c1:
+            self.assertEqual("first", c1.correlation_id)
+        with self.registry.checkout(DYNAMODB_CLIENT, correlation_id="second") as c2:
+            self.assertIs(c1, c2)
+            self.assertEqual("second", c2.correlation_id)
+        self.assertIsNone(c2.correlation_id)
+
+    def test_02_a_client_is_never_checked_out_twice_at_the_same_time(self):
+        with self.registry.checkout(DYNAMODB_CLIENT) as c1:
+            with self.registry.checkout(DYNAMODB_CLIENT) as c2:
+                self.assertIsNot(c1, c2)
+        with self.registry.checkout(DYNAMODB_CLIENT) as c3:
+            self.assertIn(c3, [c1, c2])
+
+    def test_03_clients_of_different_stacks_are_not_shared(self):
+        with self.registry.checkout(DYNAMODB_CLIENT, stack_name="stack-a") as c1:
+            pass
+        with self.registry.checkout(DYNAMODB_CLIENT, stack_name="stack-b") as c2:
+            self.assertIsNot(c1, c2)
@@ -0,0 +1,113 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import random
+import threading
+import time
+
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from src.common.concurrency import LaneExecutor, merge_parallel, prefetch
+
+
+class TestLaneExecutor(test_tools.BaseTestCase):
+    def test_01_calls_in_same_lane_run_in_submission_order(self):
+        calls = list()
+        lock = threading.Lock()
+
+        def record_call(lane, index):
+            time.sleep(random.random() / 100)
+            with lock:
+                calls.append((lane, index))
+
+        with LaneExecutor(max_workers=4) as executor:
+            for index in range(10):
+                for lane in ["a", "b", "c"]:
+                    executor.submit(lane, record_call, lane, index)
+
+        self.assertEqual(30, len(calls))
+        for lane in ["a", "b", "c"]:
+            self.assertEqual(list(range(10)), [i for l, i in calls if l == lane])
+
+    def test_02_lanes_run_in_parallel(self):
+        start = time.time()
+        with LaneExecutor(max_workers=5) as executor:
+            for lane in range(5):
+                executor.submit(lane, time.sleep, 0.5)
+        self.assertLess(time.time() - start, 2)
+
+    def test_03_errors_do_not_stop_lane(self):
+        calls = list()
+
+        def fail():
+            raise ValueError("test_03_errors_do_not_stop_lane")
+
+        with LaneExecutor(max_workers=2) as executor:
+            executor.submit("a", fail)
+            executor.submit("a", calls.append, "second call")
+        self.assertEqual(["second call"], calls)
+        self.assertEqual(1, len(executor.errors))
+        lane_key, error = executor.errors[0]
+        self.assertEqual("a", lane_key)
+        self.assertIsInstance(error, ValueError)
+
+
+class TestPrefetch(test_tools.BaseTestCase):
+    def test_01_prefetch_yields_all_items_in_order(self):
+        self.assertEqual(list(range(5)), list(prefetch(range(5))))
+
+    def test_02_next_item_fetched_while_current_one_is_processed(self):
+        def slow_pages():
+            for page in range(3):
+                time.sleep(0.3)
+                yield page
+
+        start = time.time()
+        for _ in prefetch(slow_pages()):
+            time.sleep(0.3)
+        # sequential fetching and processing would take 1.8 seconds
+        self.assertLess(time.time() - start, 1.5)
+
+
+class TestMergeParallel(test_tools.BaseTestCase):
+    @staticmethod
+    def slow_items(name, count):
+        for i in range(count):
+            time.sleep(0.3)
+            yield name, i
+
+    def test_01_items_of_each_iterable_yielded_in_order(self):
+        items = list(
+            merge_parallel(self.slow_items(name, 3) for name in ["a", "b", "c"])
+        )
+        self.assertEqual(9, len(items))
+        for name in ["a", "b", "c"]:
+            self.assertEqual([0, 1, 2], [i for n, i in items if n == name])
+
+    def test_02_iterables_consumed_in_parallel(self):
+        start = time.time()
+        list(merge_parallel(self.slow_items(name, 3) for name in range(5)))
+        # sequential reading would take 4.5 seconds
+        self.assertLess(time.time() - start, 2)
+
+    def test_03_errors_are_reraised(self):
+        def failing_items():
+            yield 1
+            raise ValueError("test_03_errors_are_reraised")
+
+        with self.assertRaises(ValueError):
+            list(merge_parallel([failing_items(), self.slow_items("a", 3)]))
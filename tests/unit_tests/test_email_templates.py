@@ -0,0 +1,120 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import thiscovery_dev_tools.testing_tools as test_tools
+from thiscovery_lib.dynamodb_utilities import Dynamodb
+from thiscovery_lib.utilities import DetailedIntegrityError, DetailedValueError
+
+import src.common.constants as const
+import src.common.email_templates as et
+
+
+TEST_TEMPLATE = {
+    "id": "unittests_email_template_cache",
+    "bcc": [],
+    "cc": [],
+    "contact_properties": [],
+    "custom_properties": [],
+    "from": "Sender Name <sender@hubspot.com>",
+    "hs_template_id": "1",
+}
+
+
+class TestTemplateCache(test_tools.BaseTestCase):
+    def setUp(self):
+        self.templates_table = Dynamodb(stack_name=const.STACK_NAME).get_table(
+            et.TEMPLATES_TABLE_NAME
+        )
+        self.templates_table.put_item(Item=TEST_TEMPLATE)
+
+    def tearDown(self):
+        self.templates_table.delete_item(Key={"id": TEST_TEMPLATE["id"]})
+
+    def save_template_change(self):
+        self.templates_table.put_item(Item={**TEST_TEMPLATE, "hs_template_id": "2"})
+
+    def test_01_templates_are_served_from_memory_until_a_change_is_recorded(self):
+        cache = et.TemplateCache(version_check_interval=0)
+        self.assertEqual(TEST_TEMPLATE, cache.get(TEST_TEMPLATE["id"]))
+        self.save_template_change()
+        self.assertEqual("1", cache.get(TEST_TEMPLATE["id"])["hs_template_id"])
+        et.record_templates_change()
+        self.assertEqual("2", cache.get(TEST_TEMPLATE["id"])["hs_template_id"])
+
+    def test_02_templates_are_reloaded_when_ttl_expires(self):
+        cache = et.TemplateCache(ttl=0)
+        cache.get(TEST_TEMPLATE["id"])
+        self.save_template_change()
+        self.assertEqual("2", cache.get(TEST_TEMPLATE["id"])["hs_template_id"])
+
+    def test_03_missing_template(self):
+        self.assertIsNone(et.TemplateCache().get("non_existent_email_template"))
+
+    def test_04_callers_get_copies(self):
+        cache = et.TemplateCache()
+        cache.get(TEST_TEMPLATE["id"])["cc"].append("someone@email.com")
+        self.assertEqual([], cache.get(TEST_TEMPLATE["id"])["cc"])
+
+    def test_05_validators_are_compiled_once_per_load(self):
+        cache = et.TemplateCache()
+        _, validator_1 = cache.get_with_validator(TEST_TEMPLATE["id"])
+        _, validator_2 = cache.get_with_validator(TEST_TEMPLATE["id"])
+        self.assertIs(validator_1, validator_2)
+        self.assertEqual((None, None), cache.get_with_validator("non_existent"))
+
+
+VALIDATED_TEMPLATE = {
+    **TEST_TEMPLATE,
+    "contact_properties": [],
+    "custom_properties": [
+        {"name": "project_name", "required": True},
+        {"name": "project_results_url", "required": False},
+    ],
+}
+
+
+class TestTemplateValidator(test_tools.BaseTestCase):
+    def setUp(self):
+        self.validator = et.TemplateValidator(VALIDATED_TEMPLATE)
+        self.lookup_properties = list()
+
+        def lookup_project_name():
+            self.lookup_properties.append("project_task_id")
+            return "CTG Monitoring"
+
+        self.lookup_map = {"project_name": lookup_project_name}
+
+    def validate(self, custom_properties):
+        email_dict = {"custom_properties": custom_properties}
+        self.validator.validate(
+            email_dict, self.lookup_map, self.lookup_properties, None
+        )
+        return email_dict["custom_properties"]
+
+    def test_01_missing_required_properties_are_looked_up(self):
+        self.assertEqual(
+            {"project_task_id": "task-1", "project_name": "CTG Monitoring"},
+            self.validate({"project_task_id": "task-1"}),
+        )
+
+    def test_02_properties_not_in_template_are_rejected(self):
+        with self.assertRaises(DetailedIntegrityError):
+            self.validate({"project_name": "CTG Monitoring", "colour": "blue"})
+
+    def test_03_required_properties_cannot_be_null(self):
+        with self.assertRaises(DetailedValueError):
+            self.validate({"project_name": ""})
@@ -0,0 +1,133 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import os
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import unittest
+
+import requests
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import src.common.hubspot as hubspot
+import tests.testing_utilities as test_utils
+from src.common.http_pool import HostConnectionPools
+
+
+UPSERT_BODY = {
+    "inputs": [
+        {
+            "idProperty": "email",
+            "id": "altha@email.co.uk",
+            "properties": {"email": "altha@email.co.uk"},
+        }
+    ]
+}
+
+
+class TestHostConnectionPools(test_tools.BaseTestCase):
+    def setUp(self):
+        self.hubspot = test_utils.HubSpotStandIn().start()
+        self.url = f"{self.hubspot.base_url}{hubspot.CONTACTS_BATCH_UPSERT_URL}"
+        self.pools = HostConnectionPools(pool_maxsize=2)
+
+    def tearDown(self):
+        self.pools.close()
+        self.hubspot.stop()
+
+    def test_01_consecutive_requests_reuse_a_connection(self):
+        for _ in range(5):
+            response = self.pools.request("POST", self.url, json=UPSERT_BODY)
+            self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            {self.hubspot.base_url: {"requests": 5, "hits": 4, "misses": 1}},
+            self.pools.get_stats(),
+        )
+
+    def test_02_connections_per_host_are_bounded(self):
+        def post_contacts():
+            for _ in range(5):
+                self.pools.request("POST", self.url, json=UPSERT_BODY)
+
+        threads = [threading.Thread(target=post_contacts) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = self.pools.get_stats()[self.hubspot.base_url]
+        self.assertEqual(40, stats["requests"])
+        self.assertLessEqual(stats["misses"], 2)
+
+
+# wall-clock timings vary with the load of the machine running the tests
+RUN_BENCHMARKS = os.environ.get("RUN_BENCHMARKS") == "1"
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, "set RUN_BENCHMARKS=1 to run benchmarks")
+@unittest.skipUnless(shutil.which("openssl"), "openssl is needed to create a TLS cert")
+class TestConnectionPoolingBenchmark(test_tools.BaseTestCase):
+    """
+    Compares the latency of HTTPS calls to a local HubSpot stand-in with and without
+    connection pooling. Only the TLS handshake and connection setup differ, so
+    pooled calls should be faster even on localhost; the gap is wider against
+    remote hosts.
+    """
+
+    calls = 50
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.certfile, keyfile = test_utils.make_self_signed_certificate(self.folder)
+        self.hubspot = test_utils.HubSpotStandIn(self.certfile, keyfile).start()
+        self.url = f"{self.hubspot.base_url}{hubspot.CONTACTS_BATCH_UPSERT_URL}"
+        self.pools = HostConnectionPools()
+
+    def tearDown(self):
+        self.pools.close()
+        self.hubspot.stop()
+        shutil.rmtree(self.folder)
+
+    def time_calls(self, request_function):
+        latencies = list()
+        for _ in range(self.calls):
+            start = time.perf_counter()
+            response = request_function(
+                "POST", self.url, json=UPSERT_BODY, verify=self.certfile
+            )
+            latencies.append(time.perf_counter() - start)
+            self.assertEqual(200, response.status_code)
+        return latencies
+
+    def test_01_pooled_calls_are_faster(self):
+        unpooled = self.time_calls(requests.request)
+        pooled = self.time_calls(self.pools.request)
+        self.logger.info(
+            "HTTPS calls to local stand-in",
+            extra={
+                "calls": self.calls,
+                "median_unpooled_ms": statistics.median(unpooled) * 1000,
+                "median_pooled_ms": statistics.median(pooled) * 1000,
+                "pool_stats": self.pools.get_stats(),
+            },
+        )
+        self.assertEqual(
+            self.calls - 1, self.pools.get_stats()[self.hubspot.base_url]["hits"]
+        )
+        self.assertLess(statistics.median(pooled), statistics.median(unpooled))
@@ -0,0 +1,203 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+
+import requests
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import src.common.hubspot as hubspot
+import tests.testing_utilities as test_utils
+
+
+TEST_USERS = [
+    {
+        "id": "d1070e81-557e-40eb-a7ba-b951ddb7ebdc",
+        "created": "2018-08-17 12:10:56.70011+00",
+        "email": "Altha@email.co.uk",
+        "first_name": "Altha",
+        "last_name": "Alcorn",
+        "country_name": "France",
+    },
+    {
+        "id": "35224bd5-f8a8-41f6-8502-f96e12d6ddde",
+        "created": "2018-08-17 12:10:56.70011+00",
+        "email": "delia@email.co.uk",
+        "first_name": "Delia",
+        "last_name": "Davies",
+        "country_name": "United States",
+    },
+]
+
+
+def token_item(access_token, expires_in, saved_seconds_ago=0):
+    saved_at = datetime.now(timezone.utc) - timedelta(seconds=saved_seconds_ago)
+    return {
+        "details": {"access_token": access_token, "expires_in": expires_in},
+        "modified": str(saved_at),
+    }
+
+
+class CountingTokenCache(hubspot.HubSpotTokenCache):
+    """
+    Token cache issuing numbered tokens instead of using the tokens table
+    """
+
+    def __init__(self, expires_in=1800, saved_seconds_ago=0):
+        super().__init__()
+        self.expires_in = expires_in
+        self.saved_seconds_ago = saved_seconds_ago
+        self.reads = 0
+        self.refreshes = 0
+
+    def _read_token(self, correlation_id):
+        self.reads += 1
+        return token_item("token-0", self.expires_in, self.saved_seconds_ago)
+
+    def _refresh_token(self, correlation_id):
+        time.sleep(0.05)  # give other threads time to pile up
+        self.refreshes += 1
+        return token_item(f"token-{self.refreshes}", self.expires_in)
+
+
+class TestHubSpotTokenCache(test_tools.BaseTestCase):
+    def test_01_token_is_read_once_while_valid(self):
+        cache = CountingTokenCache()
+        for _ in range(3):
+            self.assertEqual("token-0", cache.get_access_token())
+        self.assertEqual((1, 0), (cache.reads, cache.refreshes))
+
+    def test_02_token_is_refreshed_before_it_expires(self):
+        cache = CountingTokenCache(expires_in=hubspot.TOKEN_EXPIRY_MARGIN_SECONDS + 1)
+        self.assertEqual("token-0", cache.get_access_token())
+        time.sleep(1)
+        self.assertEqual("token-1", cache.get_access_token())
+        self.assertEqual(1, cache.refreshes)
+
+    def test_03_concurrent_refreshes_of_a_rejected_token_are_single_flight(self):
+        cache = CountingTokenCache()
+        rejected_token = cache.get_access_token()
+        results = list()
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(cache.refresh(rejected_token))
+            )
+            for _ in range(8)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(1, cache.refreshes)
+        self.assertEqual(["token-1"] * 8, results)
+
+    def test_04_token_expiry_counts_from_when_it_was_saved(self):
+        cache = CountingTokenCache(expires_in=1800, saved_seconds_ago=1700)
+        self.assertEqual("token-1", cache.get_access_token())
+        self.assertEqual("token-1", cache.get_access_token())
+        self.assertEqual((1, 1), (cache.reads, cache.refreshes))
+
+
+class TestHubSpotBatchClient(test_tools.BaseTestCase):
+    def setUp(self):
+        self.hubspot = test_utils.HubSpotStandIn().start()
+        self.client = hubspot.HubSpotBatchClient(
+            base_url=self.hubspot.base_url,
+            access_token="test-token",
+            app_id=self.hubspot.app_id,
+        )
+
+    def tearDown(self):
+        self.hubspot.stop()
+
+    def test_01_upsert_contacts_maps_ids_by_email(self):
+        self.hubspot.contacts["delia@email.co.uk"] = {"id": "99", "properties": {}}
+        results, errors = self.client.upsert_contacts(TEST_USERS)
+        self.assertEqual(
+            {
+                "altha@email.co.uk": ("2", True),
+                "delia@email.co.uk": ("99", False),
+            },
+            results,
+        )
+        self.assertEqual(dict(), errors)
+        self.assertEqual(1, len(self.hubspot.received))
+        method, path, body = self.hubspot.received[0]
+        self.assertEqual(("POST", hubspot.CONTACTS_BATCH_UPSERT_URL), (method, path))
+        self.assertEqual(
+            ["email", "email"], [i["idProperty"] for i in body["inputs"]]
+        )
+        self.assertEqual(
+            1534507856700,
+            body["inputs"][0]["properties"]["thiscovery_registered_date"],
+        )
+
+    def test_02_rejected_contacts_reported_per_item(self):
+        self.hubspot.rejected_emails.add("altha@email.co.uk")
+        results, errors = self.client.upsert_contacts(TEST_USERS)
+        self.assertEqual(["delia@email.co.uk"], list(results))
+        self.assertEqual(["altha@email.co.uk"], list(errors))
+
+    def test_03_error_responses_raise_http_error(self):
+        self.hubspot.queued_statuses.append(HTTPStatus.TOO_MANY_REQUESTS)
+        with self.assertRaises(requests.HTTPError) as context:
+            self.client.upsert_contacts(TEST_USERS)
+        self.assertEqual(
+            HTTPStatus.TOO_MANY_REQUESTS, context.exception.response.status_code
+        )
+
+    def test_04_create_timeline_events(self):
+        events = [
+            hubspot.get_login_timeline_event(
+                {**user, "login_datetime": "2021-03-01 10:00:00+00"},
+                f"login-{i}",
+                event_type_id="123",
+            )
+            for i, user in enumerate(TEST_USERS)
+        ]
+        response = self.client.create_timeline_events(events)
+        self.assertEqual(HTTPStatus.NO_CONTENT, response.status_code)
+        self.assertEqual(["login-0", "login-1"], list(self.hubspot.timeline_events))
+        self.assertEqual(
+            1614592800000, self.hubspot.timeline_events["login-0"]["timestamp"]
+        )
+
+    def test_05_rejected_timeline_event_batch_raises_http_error(self):
+        self.hubspot.rejected_event_ids.add("login-1")
+        events = [
+            {"id": f"login-{i}", "email": u["email"], "eventTypeId": "123"}
+            for i, u in enumerate(TEST_USERS)
+        ]
+        with self.assertRaises(requests.HTTPError) as context:
+            self.client.create_timeline_events(events)
+        self.assertEqual(HTTPStatus.BAD_REQUEST, context.exception.response.status_code)
+        self.assertEqual(dict(), self.hubspot.timeline_events)
+
+    def test_06_rejected_access_token_is_refreshed_once(self):
+        token_cache = CountingTokenCache()
+        client = hubspot.HubSpotBatchClient(
+            base_url=self.hubspot.base_url,
+            app_id=self.hubspot.app_id,
+            token_cache=token_cache,
+        )
+        self.hubspot.queued_statuses.append(HTTPStatus.UNAUTHORIZED)
+        results, _ = client.upsert_contacts(TEST_USERS)
+        self.assertEqual(2, len(results))
+        self.assertEqual(1, token_cache.refreshes)
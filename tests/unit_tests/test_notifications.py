@@ -15,6 +15,7 @@
 #   A copy of the GNU Affero General Public License is available in the
 #   docs folder of this project.  It is also available www.gnu.org/licenses/
 #
+import json
 import time
 import unittest
 
@@ -25,6 +26,7 @@ except ModuleNotFoundError:
     pass
 
 import copy
+import requests
 import thiscovery_lib.utilities as utils
 import thiscovery_dev_tools.testing_tools as test_tools
 
@@ -36,6 +38,7 @@ from thiscovery_lib.utilities import DetailedValueError
 from test_transactional_email import test_email_dict
 
 import src.common.constants as const
+from src.common.concurrency import LaneExecutor
 import notification_process as np
 import tests.testing_utilities as test_utils
 from notification_process import (
@@ -53,6 +56,7 @@ from src.notification_send import (
     notify_user_login,
     new_transactional_email_notification,
 )
+from src.transactional_email import TransactionalEmail, send_inline
 
 TIME_TOLERANCE_SECONDS = 10
 
@@ -85,6 +89,11 @@ TEST_USER_03_JSON = {
     "country_name": "United States",
     # "status": "new",
 }
+
+TEST_USER_03_LOGIN_JSON = {
+    **TEST_USER_03_JSON,
+    "login_datetime": "2021-03-01 10:00:00",
+}
 # endregion
 
 
@@ -132,6 +141,47 @@ def create_transactional_email_notification():
     new_transactional_email_notification(email_dict=test_email_dict)
 
 
+class FlakyCompletionBuffer(np.CompletionBuffer):
+    """
+    Completion buffer whose writes fail with a connection error (as raised by
+    botocore, not a ClientError) while self.fail is set
+    """
+
+    fail = True
+
+    def _write_transaction(self, table, batch, modified):
+        if self.fail:
+            raise ConnectionResetError("Connection reset by peer")
+        super()._write_transaction(table, batch, modified)
+
+    def _write_one(self, notification_id, name_value_pairs):
+        if self.fail:
+            raise ConnectionResetError("Connection reset by peer")
+        super()._write_one(notification_id, name_value_pairs)
+
+
+class RecoveringCompletionBuffer(FlakyCompletionBuffer):
+    """
+    Completion buffer whose writes only fail on its first flush
+    """
+
+    def flush(self):
+        failed = super().flush()
+        self.fail = False
+        return failed
+
+
+class RejectedTransactionalEmail(TransactionalEmail):
+    """
+    Transactional email HubSpot responds to with an error status instead of sending
+    """
+
+    def send(self, mock_server=False):
+        response = requests.Response()
+        response.status_code = HTTPStatus.BAD_REQUEST
+        return response
+
+
 # endregion
 
 
@@ -189,14 +239,13 @@ class TestNotifications(test_tools.BaseTestCase):
         notification = get_notifications(
             NotificationAttributes.TYPE.value, [notification_type_value]
         )[0]
-        self.ddb_client.update_item(
-            table_name=NOTIFICATION_TABLE_NAME,
-            key=notification["id"],
-            name_value_pairs={
+        np.update_notification(
+            notification["id"],
+            {
                 "created": modified_datetime.isoformat(),
-                "modified": modified_datetime.isoformat(),
-                NotificationAttributes.STATUS.value: target_status,
+                **np.get_status_updates(notification, target_status),
             },
+            modified=modified_datetime.isoformat(),
         )
         return (notification["id"], np.clear_notification_queue(dict(), None))
 
@@ -392,6 +441,10 @@ class TestNotifications(test_tools.BaseTestCase):
         self.assertEqual(
             test_error_message, notification[NotificationAttributes.ERROR_MESSAGE.value]
         )
+        self.assertGreater(
+            notification[NotificationAttributes.NEXT_ATTEMPT_AT.value],
+            str(utils.now_with_tz()),
+        )
 
         mark_notification_failure(notification, test_error_message, None)
         test_error_message = "test_03_fail_processing - DLQ"
@@ -536,6 +589,576 @@ class TestNotifications(test_tools.BaseTestCase):
             HTTPStatus.OK, marking_result["ResponseMetadata"]["HTTPStatusCode"]
         )
 
+    def test_19_notifications_about_same_user_share_processing_lane(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        create_task_signup_notification(user_id=TEST_USER_03_JSON["id"])
+        create_login_notification(TEST_USER_02_JSON)
+        notifications = get_notifications()
+        lane_keys = {n["type"]: np.get_lane_key(n) for n in notifications}
+        self.assertEqual(
+            lane_keys[NotificationType.USER_REGISTRATION.value],
+            lane_keys[NotificationType.TASK_SIGNUP.value],
+        )
+        self.assertEqual(
+            TEST_USER_02_JSON["id"], lane_keys[NotificationType.USER_LOGIN.value]
+        )
+        ordered_types = [
+            n["type"] for n in sorted(notifications, key=np.get_processing_order)
+        ]
+        self.assertEqual(NotificationType.USER_REGISTRATION.value, ordered_types[0])
+
+    def test_20_process_notifications_defers_work_close_to_timeout(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        notification = test_utils.get_expected_notification(TEST_USER_03_JSON["id"])
+        context = test_utils.MockLambdaContext(
+            remaining_time_in_millis=(np.PROCESSING_DEADLINE_MARGIN_SECONDS - 1) * 1000
+        )
+        result = np.process_notifications(dict(), context)
+        summary = json.loads(result["body"])
+        self.assertEqual(0, summary["dispatched"])
+        self.assertTrue(summary["more_pending"])
+        self.assertEqual([notification["id"]], summary["deferred_notification_ids"])
+        self.assertEqual(
+            {
+                notification[NotificationAttributes.PENDING_WORK.value]: notification[
+                    NotificationAttributes.NEXT_ATTEMPT_AT.value
+                ]
+            },
+            np.get_resume_cursor(),
+        )
+        # deferred notification is left untouched
+        notification = test_utils.get_expected_notification(TEST_USER_03_JSON["id"])
+        self.assertEqual(
+            NotificationStatus.NEW.value,
+            notification[NotificationAttributes.STATUS.value],
+        )
+
+        # next run picks it up and clears the cursor
+        result = np.process_notifications(dict(), test_utils.MockLambdaContext())
+        summary = json.loads(result["body"])
+        self.assertEqual(1, summary["dispatched"])
+        self.assertFalse(summary["more_pending"])
+        self.assertEqual(dict(), np.get_resume_cursor())
+
+    def test_21_claim_notifications_drops_notifications_claimed_elsewhere(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        create_task_signup_notification(user_id=TEST_USER_03_JSON["id"])
+        notifications = get_notifications()
+        self.assertEqual(2, len(notifications))
+        np.mark_notification_being_processed(notifications[0])
+        claimed = np.claim_notifications(notifications)
+        self.assertEqual([notifications[1]["id"]], [n["id"] for n in claimed])
+        for n in get_notifications():
+            self.assertEqual(
+                NotificationStatus.PROCESSING.value,
+                n[NotificationAttributes.STATUS.value],
+            )
+
+    def test_22_completion_buffer_writes_status_updates_on_exit(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        create_task_signup_notification(user_id=TEST_USER_03_JSON["id"])
+        registration, signup = sorted(
+            get_notifications(), key=np.get_processing_order
+        )
+        with np.CompletionBuffer(flush_interval=60) as completion_buffer:
+            np.mark_notification_processed(
+                registration, None, completion_buffer=completion_buffer
+            )
+            mark_notification_failure(
+                signup,
+                "test_22_completion_buffer_writes_status_updates_on_exit",
+                None,
+                completion_buffer=completion_buffer,
+            )
+            # nothing is written until the buffer is flushed
+            for n in get_notifications():
+                self.assertEqual(
+                    NotificationStatus.NEW.value,
+                    n[NotificationAttributes.STATUS.value],
+                )
+
+        registration = test_utils.get_expected_notification(registration["id"])
+        self.assertEqual(
+            NotificationStatus.PROCESSED.value,
+            registration[NotificationAttributes.STATUS.value],
+        )
+        signup = test_utils.get_expected_notification(signup["id"])
+        self.assertEqual(
+            NotificationStatus.RETRYING.value,
+            signup[NotificationAttributes.STATUS.value],
+        )
+        self.assertEqual(1, signup[NotificationAttributes.FAIL_COUNT.value])
+
+    def test_23_retry_delay_grows_exponentially_with_jitter(self):
+        for fail_count in range(1, 5):
+            expected_delay = min(
+                np.RETRY_MAX_DELAY_SECONDS,
+                np.RETRY_BASE_DELAY_SECONDS * 2 ** (fail_count - 1),
+            )
+            delays = [np.get_retry_delay(fail_count) for _ in range(20)]
+            for delay in delays:
+                self.assertGreaterEqual(delay, expected_delay / 2)
+                self.assertLessEqual(delay, expected_delay)
+            self.assertGreater(len(set(delays)), 1)
+
+    def test_24_retrying_notifications_not_fetched_until_due(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        notification = test_utils.get_expected_notification(TEST_USER_03_JSON["id"])
+        mark_notification_failure(
+            notification, "test_24_retrying_notifications_not_fetched_until_due", None
+        )
+        self.assertEqual([], np.get_notifications_to_process())
+
+        self.ddb_client.update_item(
+            table_name=NOTIFICATION_TABLE_NAME,
+            key=notification["id"],
+            name_value_pairs={
+                NotificationAttributes.NEXT_ATTEMPT_AT.value: str(
+                    utils.now_with_tz() - timedelta(seconds=1)
+                ),
+            },
+        )
+        self.assertEqual(
+            [notification["id"]],
+            [n["id"] for n in np.get_notifications_to_process()],
+        )
+
+    def test_25_process_notifications_from_stream_records(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        stream_event = test_utils.load_stream_event("registration_insert.json")
+        result = np.process_notifications_stream(stream_event, None)
+        self.assertEqual({"batchItemFailures": list()}, result)
+        notification = test_utils.get_expected_notification(TEST_USER_03_JSON["id"])
+        self.assertEqual(
+            NotificationStatus.PROCESSED.value,
+            notification[NotificationAttributes.STATUS.value],
+        )
+
+    def test_26_stream_records_of_claimed_notifications_are_skipped(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        notification = test_utils.get_expected_notification(TEST_USER_03_JSON["id"])
+        np.mark_notification_being_processed(notification)
+        stream_event = test_utils.load_stream_event("registration_insert.json")
+        result = np.process_notifications_stream(stream_event, None)
+        self.assertEqual({"batchItemFailures": list()}, result)
+        notification = test_utils.get_expected_notification(TEST_USER_03_JSON["id"])
+        self.assertEqual(
+            NotificationStatus.PROCESSING.value,
+            notification[NotificationAttributes.STATUS.value],
+        )
+
+    def test_27_processing_requests_are_coalesced(self):
+        self.ddb_client.delete_item("lookups", np.PROCESSING_TRIGGER_KEY)
+        self.assertTrue(np.request_notification_processing())
+        self.assertFalse(np.request_notification_processing())
+        self.assertFalse(np.request_notification_processing())
+        # the coalesced requests result in a single follow-up run
+        self.assertTrue(np.release_processing_trigger())
+        self.assertFalse(np.release_processing_trigger())
+        self.assertTrue(np.request_notification_processing())
+        self.ddb_client.delete_item("lookups", np.PROCESSING_TRIGGER_KEY)
+
+    def test_28_status_shard_key_follows_processing_status(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        create_task_signup_notification(user_id=TEST_USER_03_JSON["id"])
+        registration, signup = sorted(
+            get_notifications(), key=np.get_processing_order
+        )
+        shard = np.get_status_shard(registration)
+        self.assertEqual(shard, np.get_status_shard(signup))
+        self.assertEqual(
+            f"{NotificationStatus.NEW.value}#{shard}",
+            registration[NotificationAttributes.STATUS_SHARD.value],
+        )
+        self.assertEqual(2, len(np.get_notifications_to_process()))
+
+        np.claim_notifications([registration])
+        mark_notification_failure(
+            signup, "test_28_status_shard_key_follows_processing_status", None
+        )
+        registration = test_utils.get_expected_notification(registration["id"])
+        self.assertEqual(
+            f"{NotificationStatus.PROCESSING.value}#{shard}",
+            registration[NotificationAttributes.STATUS_SHARD.value],
+        )
+        signup = test_utils.get_expected_notification(signup["id"])
+        self.assertEqual(
+            f"{NotificationStatus.RETRYING.value}#{shard}",
+            signup[NotificationAttributes.STATUS_SHARD.value],
+        )
+
+    def test_29_notifications_leave_pending_work_index_when_done(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        create_task_signup_notification(user_id=TEST_USER_03_JSON["id"])
+        registration, signup = sorted(
+            get_notifications(), key=np.get_processing_order
+        )
+        self.assertEqual(
+            registration[NotificationAttributes.STATUS_SHARD.value],
+            registration[NotificationAttributes.PENDING_WORK.value],
+        )
+        np.mark_notification_processed(registration, None)
+        np.set_fail_count(signup, np.MAX_RETRIES)
+        with self.assertRaises(DetailedValueError):
+            mark_notification_failure(
+                signup, "test_29_notifications_leave_pending_work_index_when_done", None
+            )
+        for n in get_notifications():
+            self.assertNotIn(NotificationAttributes.PENDING_WORK.value, n)
+        self.assertEqual([], np.get_notifications_to_process())
+
+    def test_30_registrations_posted_to_hubspot_in_batches(self):
+        create_registration_notification(user_json=TEST_USER_01_JSON)
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        notifications = np.claim_notifications(get_notifications())
+        with test_utils.HubSpotStandIn() as hubspot, np.CompletionBuffer() as cb:
+            hubspot.rejected_emails.add(TEST_USER_01_JSON["email"])
+            with LaneExecutor(max_workers=2) as dispatcher:
+                np.process_user_registration_batch(
+                    notifications,
+                    dispatcher,
+                    completion_buffer=cb,
+                    hubspot_base_url=hubspot.base_url,
+                )
+        self.assertEqual(1, len(hubspot.received))
+        rejected = test_utils.get_expected_notification(TEST_USER_01_JSON["id"])
+        self.assertEqual(
+            NotificationStatus.RETRYING.value,
+            rejected[NotificationAttributes.STATUS.value],
+        )
+        upserted = test_utils.get_expected_notification(TEST_USER_03_JSON["id"])
+        self.assertEqual(
+            NotificationStatus.PROCESSED.value,
+            upserted[NotificationAttributes.STATUS.value],
+        )
+
+    def test_31_rejected_timeline_event_batches_are_split(self):
+        create_login_notification(TEST_USER_02_JSON)
+        create_login_notification(TEST_USER_03_LOGIN_JSON)
+        create_login_notification(
+            {**TEST_USER_03_LOGIN_JSON, "login_datetime": "2021-03-02 10:00:00"}
+        )
+        notifications = np.claim_notifications(get_notifications())
+        rejected_id = notifications[1]["id"]
+        with test_utils.HubSpotStandIn() as hubspot, np.CompletionBuffer() as cb:
+            hubspot.rejected_event_ids.add(rejected_id)
+            with np.TimelineEventBuffer(
+                cb, hubspot_base_url=hubspot.base_url
+            ) as timeline_buffer:
+                for n in notifications:
+                    np.process_user_login(
+                        n,
+                        claimed=True,
+                        completion_buffer=cb,
+                        timeline_buffer=timeline_buffer,
+                    )
+                # nothing is posted until the buffer is flushed
+                self.assertEqual(list(), hubspot.received)
+        # whole batch, then halves of 1 and 2 events, then the 2 events one by one
+        self.assertEqual(5, len(hubspot.received))
+        for n in get_notifications():
+            expected_status = (
+                NotificationStatus.RETRYING.value
+                if n["id"] == rejected_id
+                else NotificationStatus.PROCESSED.value
+            )
+            self.assertEqual(expected_status, n[NotificationAttributes.STATUS.value])
+
+    def test_32_user_logins_are_coalesced_by_user(self):
+        create_login_notification(TEST_USER_02_JSON)
+        for login_datetime in ["2021-03-02 10:00:00", "2021-03-01 10:00:00"]:
+            create_login_notification(
+                {**TEST_USER_03_LOGIN_JSON, "login_datetime": login_datetime}
+            )
+        notifications = get_notifications()
+        latest = np.coalesce_user_logins(notifications)
+        latest_notifications = [n for n in notifications if n["id"] in latest]
+        self.assertCountEqual(
+            ["2019-12-05T17:48:56+01:00", "2021-03-02 10:00:00"],
+            [n["details"]["login_datetime"] for n in latest_notifications],
+        )
+        self.assertCountEqual(
+            [[], ["2021-03-01 10:00:00"]],
+            [
+                [n["details"]["login_datetime"] for n in superseded]
+                for superseded in latest.values()
+            ],
+        )
+
+    def test_33_transactional_emails_sent_in_batches(self):
+        email_dict = copy.deepcopy(test_email_dict)
+        del email_dict["to_recipient_id"]
+        email_dict["to_recipient_email"] = "recipient@email.com"
+        new_transactional_email_notification(email_dict=email_dict)
+        new_transactional_email_notification(
+            email_dict={**email_dict, "template_name": "non-existent-template"}
+        )
+        notifications = np.claim_notifications(get_notifications())
+        with np.CompletionBuffer() as cb:
+            with LaneExecutor(max_workers=2) as dispatcher:
+                np.process_transactional_email_batch(
+                    notifications, dispatcher, completion_buffer=cb, mock_server=True
+                )
+        for n in get_notifications():
+            expected_status = (
+                NotificationStatus.PROCESSED.value
+                if n["details"]["template_name"] == email_dict["template_name"]
+                else NotificationStatus.RETRYING.value
+            )
+            self.assertEqual(expected_status, n[NotificationAttributes.STATUS.value])
+
+    def test_34_transactional_email_sent_inline(self):
+        email_dict = copy.deepcopy(test_email_dict)
+        del email_dict["to_recipient_id"]
+        email_dict["to_recipient_email"] = "recipient@email.com"
+        notification_id = new_transactional_email_notification(email_dict=email_dict)
+        self.assertTrue(send_inline(notification_id, email_dict, mock_server=True))
+        notification = get_notifications()[0]
+        self.assertEqual(notification_id, notification["id"])
+        self.assertEqual(
+            NotificationStatus.PROCESSED.value,
+            notification[NotificationAttributes.STATUS.value],
+        )
+
+    def test_35_claimed_transactional_email_not_sent_inline(self):
+        email_dict = copy.deepcopy(test_email_dict)
+        del email_dict["to_recipient_id"]
+        email_dict["to_recipient_email"] = "recipient@email.com"
+        notification_id = new_transactional_email_notification(email_dict=email_dict)
+        np.claim_notifications(get_notifications())
+        self.assertFalse(send_inline(notification_id, email_dict, mock_server=True))
+        notification = get_notifications()[0]
+        self.assertEqual(
+            NotificationStatus.PROCESSING.value,
+            notification[NotificationAttributes.STATUS.value],
+        )
+
+    def test_36_notifications_saved_before_sharding_are_backfilled(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        # strip the keys save_notification now adds, as on notifications saved
+        # before status sharding
+        np.update_notification(
+            TEST_USER_03_JSON["id"],
+            {
+                NotificationAttributes.STATUS_SHARD.value: None,
+                NotificationAttributes.PENDING_WORK.value: None,
+                NotificationAttributes.NEXT_ATTEMPT_AT.value: None,
+            },
+        )
+        self.ddb_client.delete_item("lookups", np.INDEX_KEYS_BACKFILL_KEY)
+        self.assertEqual([], np.get_notifications_to_process())
+        # a run past its deadline leaves the backfill for the next one
+        self.assertFalse(np.backfill_index_keys(deadline=time.monotonic() - 1))
+        self.assertEqual([], np.get_notifications_to_process())
+        self.assertTrue(np.backfill_index_keys())
+        self.assertEqual(
+            [TEST_USER_03_JSON["id"]],
+            [n["id"] for n in np.get_notifications_to_process()],
+        )
+        self.assertEqual(1, np.get_backfill_progress()["updated"])
+
+    def test_37_completion_buffer_keeps_updates_after_connection_errors(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        registration = get_notifications()[0]
+        with FlakyCompletionBuffer(flush_interval=0.1) as completion_buffer:
+            np.mark_notification_processed(
+                registration, None, completion_buffer=completion_buffer
+            )
+            time.sleep(0.5)  # several periodic flushes fail
+            registration = test_utils.get_expected_notification(registration["id"])
+            self.assertEqual(
+                NotificationStatus.NEW.value,
+                registration[NotificationAttributes.STATUS.value],
+            )
+            completion_buffer.fail = False
+            time.sleep(0.3)  # the periodic flush is still running
+            registration = test_utils.get_expected_notification(registration["id"])
+            self.assertEqual(
+                NotificationStatus.PROCESSED.value,
+                registration[NotificationAttributes.STATUS.value],
+            )
+
+        create_registration_notification(user_json=TEST_USER_01_JSON)
+        registration = test_utils.get_expected_notification(TEST_USER_01_JSON["id"])
+        with self.assertRaises(utils.DetailedIntegrityError) as context:
+            with FlakyCompletionBuffer(flush_interval=60) as completion_buffer:
+                np.mark_notification_processed(
+                    registration, None, completion_buffer=completion_buffer
+                )
+        self.assertIn(registration["id"], context.exception.details["updates"])
+
+    def test_38_rejected_registration_batches_are_split(self):
+        create_registration_notification(user_json=TEST_USER_01_JSON)
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        notifications = np.claim_notifications(get_notifications())
+        with test_utils.HubSpotStandIn() as hubspot, np.CompletionBuffer() as cb:
+            hubspot.invalid_emails.add(TEST_USER_01_JSON["email"])
+            with LaneExecutor(max_workers=2) as dispatcher:
+                np.process_user_registration_batch(
+                    notifications,
+                    dispatcher,
+                    completion_buffer=cb,
+                    hubspot_base_url=hubspot.base_url,
+                )
+        # whole batch, then each registration on its own
+        self.assertEqual(3, len(hubspot.received))
+        rejected = test_utils.get_expected_notification(TEST_USER_01_JSON["id"])
+        self.assertEqual(
+            NotificationStatus.RETRYING.value,
+            rejected[NotificationAttributes.STATUS.value],
+        )
+        upserted = test_utils.get_expected_notification(TEST_USER_03_JSON["id"])
+        self.assertEqual(
+            NotificationStatus.PROCESSED.value,
+            upserted[NotificationAttributes.STATUS.value],
+        )
+
+    def test_39_rejected_transactional_email_is_returned_to_queue(self):
+        create_transactional_email_notification()
+        notification = get_notifications()[0]
+        email = RejectedTransactionalEmail(
+            email_dict=notification["details"], send_id=notification["id"]
+        )
+        # a failed inline attempt is retried straight away and not counted
+        np.process_transactional_email(notification, email=email, inline=True)
+        notification = get_notifications()[0]
+        self.assertEqual(
+            NotificationStatus.RETRYING.value,
+            notification[NotificationAttributes.STATUS.value],
+        )
+        self.assertNotIn(NotificationAttributes.FAIL_COUNT.value, notification)
+        self.assertLessEqual(
+            notification[NotificationAttributes.NEXT_ATTEMPT_AT.value],
+            str(utils.now_with_tz()),
+        )
+
+        np.process_transactional_email(notification, email=email)
+        notification = get_notifications()[0]
+        self.assertEqual(
+            NotificationStatus.RETRYING.value,
+            notification[NotificationAttributes.STATUS.value],
+        )
+        self.assertEqual(1, notification[NotificationAttributes.FAIL_COUNT.value])
+
+    def test_40_email_moved_to_dlq_does_not_abort_dispatch(self):
+        create_login_notification(TEST_USER_03_LOGIN_JSON)
+        new_transactional_email_notification(
+            email_dict={**test_email_dict, "template_name": "non-existent-template"}
+        )
+        email_notification = get_notifications(
+            NotificationAttributes.TYPE.value,
+            [NotificationType.TRANSACTIONAL_EMAIL.value],
+        )[0]
+        np.update_notification(
+            email_notification["id"],
+            {NotificationAttributes.FAIL_COUNT.value: np.MAX_RETRIES},
+        )
+        notifications = np.claim_notifications(get_notifications())
+        with test_utils.HubSpotStandIn() as hubspot, np.CompletionBuffer() as cb:
+            with LaneExecutor(max_workers=2) as dispatcher, np.TimelineEventBuffer(
+                cb, dispatcher, hubspot_base_url=hubspot.base_url
+            ) as timeline_buffer:
+                np.dispatch_claimed_notifications(
+                    notifications, dispatcher, cb, timeline_buffer
+                )
+        self.assertEqual(
+            [DetailedValueError], [type(ex) for _, ex in dispatcher.errors]
+        )
+        for n in get_notifications():
+            expected_status = (
+                NotificationStatus.DLQ.value
+                if n["id"] == email_notification["id"]
+                else NotificationStatus.PROCESSED.value
+            )
+            self.assertEqual(expected_status, n[NotificationAttributes.STATUS.value])
+
+    def test_41_stream_records_of_task_signups_are_left_for_processing_runs(self):
+        ut_json = create_task_signup_notification()
+        stream_event = test_utils.load_stream_event("task_signup_insert.json")
+        result = np.process_notifications_stream(stream_event, None)
+        self.assertEqual({"batchItemFailures": list()}, result)
+        notification = test_utils.get_expected_notification(ut_json["id"])
+        self.assertEqual(
+            NotificationStatus.NEW.value,
+            notification[NotificationAttributes.STATUS.value],
+        )
+
+    def test_42_completion_buffer_retries_failed_writes_on_exit(self):
+        create_registration_notification(user_json=TEST_USER_03_JSON)
+        registration = get_notifications()[0]
+        with RecoveringCompletionBuffer(flush_interval=60) as completion_buffer:
+            np.mark_notification_processed(
+                registration, None, completion_buffer=completion_buffer
+            )
+        registration = test_utils.get_expected_notification(TEST_USER_03_JSON["id"])
+        self.assertEqual(
+            NotificationStatus.PROCESSED.value,
+            registration[NotificationAttributes.STATUS.value],
+        )
+
+    def test_43_superseded_logins_wait_for_the_latest_login(self):
+        def process_logins():
+            notifications = np.claim_notifications(get_notifications())
+            ((latest_id, superseded),) = np.coalesce_user_logins(notifications).items()
+            with np.CompletionBuffer() as cb, np.TimelineEventBuffer(
+                cb, hubspot_base_url=hubspot.base_url
+            ) as timeline_buffer:
+                np.process_user_login(
+                    [n for n in notifications if n["id"] == latest_id][0],
+                    claimed=True,
+                    completion_buffer=cb,
+                    timeline_buffer=timeline_buffer,
+                    superseded_logins=superseded,
+                )
+            return latest_id
+
+        for login_datetime in ["2021-03-01 10:00:00", "2021-03-02 10:00:00"]:
+            create_login_notification(
+                {**TEST_USER_03_LOGIN_JSON, "login_datetime": login_datetime}
+            )
+        with test_utils.HubSpotStandIn() as hubspot:
+            hubspot.rejected_event_ids.add(get_notifications()[0]["id"])
+            hubspot.rejected_event_ids.add(get_notifications()[1]["id"])
+            process_logins()
+            # the superseded login is retried along with the latest one
+            self.assertEqual(
+                [NotificationStatus.RETRYING.value] * 2,
+                [n[NotificationAttributes.STATUS.value] for n in get_notifications()],
+            )
+            hubspot.rejected_event_ids.clear()
+            latest_id = process_logins()
+        self.assertEqual([latest_id], list(hubspot.timeline_events.keys()))
+        self.assertEqual(
+            [NotificationStatus.PROCESSED.value] * 2,
+            [n[NotificationAttributes.STATUS.value] for n in get_notifications()],
+        )
+
+    def test_44_shards_dropped_by_lowering_the_shard_count_are_still_read(self):
+        create_login_notification(TEST_USER_03_LOGIN_JSON)
+        # as if written when NOTIFICATION_STATUS_SHARDS was higher than it is now
+        dropped_shard = np.NOTIFICATION_STATUS_SHARDS + 5
+        np.update_notification(
+            get_notifications()[0]["id"],
+            {
+                NotificationAttributes.PENDING_WORK.value: np.get_status_shard_key(
+                    NotificationStatus.NEW.value, dropped_shard
+                )
+            },
+        )
+        self.ddb_client.delete_item("lookups", np.STATUS_SHARDS_KEY)
+        self.assertEqual([], np.get_notifications_to_process())
+        self.ddb_client.put_item(
+            "lookups",
+            np.STATUS_SHARDS_KEY,
+            "notifications_status_shards",
+            dict(),
+            {"shards": dropped_shard + 1},
+            update_allowed=True,
+        )
+        self.assertEqual(1, len(np.get_notifications_to_process()))
+        self.assertEqual(dropped_shard + 1, np.get_status_shard_count())
+        self.ddb_client.delete_item("lookups", np.STATUS_SHARDS_KEY)
+
     @unittest.skipUnless(
         test_tools.tests_running_on_aws(),
         "The goal of this test is to check we can trigger notification processing "
@@ -0,0 +1,77 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import thiscovery_dev_tools.testing_tools as test_tools
+
+from src.common.projects import ProjectIndex
+
+
+PROJECTS = [
+    {
+        "id": "project-1",
+        "name": "CTG Monitoring",
+        "tasks": [{"id": "task-1"}, {"id": "task-2"}],
+    },
+    {"id": "project-2", "name": "PSFU", "tasks": [{"id": "task-3"}]},
+]
+
+
+class CountingProjectIndex(ProjectIndex):
+    """
+    Project index reading a local catalogue instead of calling core
+    """
+
+    def __init__(self, projects, **kwargs):
+        super().__init__(**kwargs)
+        self.projects = projects
+        self.fetches = 0
+
+    def _fetch_projects(self, correlation_id):
+        self.fetches += 1
+        return self.projects
+
+
+class TestProjectIndex(test_tools.BaseTestCase):
+    def test_01_catalogue_is_fetched_once_for_many_lookups(self):
+        index = CountingProjectIndex(PROJECTS)
+        for task_id, name in [
+            ("task-1", "CTG Monitoring"),
+            ("task-3", "PSFU"),
+            ("task-2", "CTG Monitoring"),
+        ]:
+            self.assertEqual(name, index.get_project(task_id)["name"])
+        self.assertEqual(1, index.fetches)
+
+    def test_02_misses_refresh_at_most_once_per_window(self):
+        index = CountingProjectIndex(PROJECTS)
+        self.assertIsNone(index.get_project("task-4"))
+        self.assertIsNone(index.get_project("task-4"))
+        self.assertEqual(1, index.fetches)
+
+        index = CountingProjectIndex(PROJECTS, miss_refresh_interval=0)
+        index.get_project("task-1")
+        index.projects = PROJECTS + [
+            {"id": "project-3", "name": "New project", "tasks": [{"id": "task-4"}]}
+        ]
+        self.assertEqual("New project", index.get_project("task-4")["name"])
+        self.assertEqual(2, index.fetches)
+
+    def test_03_catalogue_is_fetched_again_when_ttl_expires(self):
+        index = CountingProjectIndex(PROJECTS, ttl=0)
+        index.get_project("task-1")
+        index.get_project("task-1")
+        self.assertEqual(2, index.fetches)
@@ -0,0 +1,91 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import time
+from http import HTTPStatus
+
+import thiscovery_dev_tools.testing_tools as test_tools
+
+import src.common.rate_limiting as rl
+
+
+class MockResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or dict()
+
+
+class TestTokenBucket(test_tools.BaseTestCase):
+    def test_01_burst_then_rate(self):
+        bucket = rl.TokenBucket(rate=10, capacity=5)
+        start = time.monotonic()
+        for _ in range(5):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.05)
+        for _ in range(5):
+            bucket.acquire()
+        self.assertGreater(time.monotonic() - start, 0.45)
+
+    def test_02_pause(self):
+        bucket = rl.TokenBucket(rate=100, capacity=100)
+        bucket.pause(0.3)
+        start = time.monotonic()
+        bucket.acquire()
+        self.assertGreater(time.monotonic() - start, 0.25)
+
+    def test_03_hubspot_limits_fit_in_ten_second_window(self):
+        for endpoint_family in [rl.HUBSPOT_CRM, rl.HUBSPOT_SINGLE_SEND]:
+            rate, capacity = rl.RATE_LIMITS[endpoint_family]
+            self.assertLessEqual(capacity + rate * 10, 100)
+
+
+class TestCallRateLimited(test_tools.BaseTestCase):
+    def setUp(self):
+        rl.RATE_LIMITS["unittest"] = (100, 100)
+        self.default_retry_after = rl.DEFAULT_RETRY_AFTER_SECONDS
+
+    def tearDown(self):
+        rl.DEFAULT_RETRY_AFTER_SECONDS = self.default_retry_after
+
+    def test_01_throttled_call_is_retried(self):
+        responses = [
+            MockResponse(HTTPStatus.TOO_MANY_REQUESTS, {"Retry-After": "0.2"}),
+            MockResponse(HTTPStatus.OK),
+        ]
+        start = time.monotonic()
+        result = rl.call_rate_limited("unittest", responses.pop, 0)
+        self.assertEqual(HTTPStatus.OK, result.status_code)
+        self.assertGreater(time.monotonic() - start, 0.15)
+
+    def test_02_persistently_throttled_call_raises_throttled_error(self):
+        rl.DEFAULT_RETRY_AFTER_SECONDS = 0.01
+        with self.assertRaises(rl.ThrottledError) as context:
+            rl.call_rate_limited(
+                "unittest", lambda: HTTPStatus.TOO_MANY_REQUESTS.value
+            )
+        self.assertEqual(0.01, context.exception.retry_after)
+
+    def test_03_other_errors_are_not_retried(self):
+        calls = list()
+
+        def fail():
+            calls.append(1)
+            raise ValueError("test_03_other_errors_are_not_retried")
+
+        with self.assertRaises(ValueError):
+            rl.call_rate_limited("unittest", fail)
+        self.assertEqual(1, len(calls))
@@ -0,0 +1,103 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+import thiscovery_dev_tools.testing_tools as test_tools
+from thiscovery_lib.utilities import ObjectDoesNotExistError
+
+import src.common.recipients as rec
+
+
+TEST_USER = {
+    "id": "d1070e81-557e-40eb-a7ba-b951ddb7ebdc",
+    "email": "altha@email.co.uk",
+    "first_name": "Altha",
+    "last_name": "Alcorn",
+    "crm_id": "1234",
+}
+ANON_ID = "1406c523-6d24-4158-8dd2-8eaaf7a64ad8"
+USERS = {
+    rec.USER_ID: {TEST_USER["id"]: TEST_USER},
+    rec.ANON_PROJECT_SPECIFIC_USER_ID: {ANON_ID: TEST_USER},
+}
+
+
+class EmptyDirectory:
+    def __init__(self):
+        self.looked_up = list()
+        self.saved = list()
+
+    def get(self, user_id, max_age=None, correlation_id=None):
+        self.looked_up.append(user_id)
+        return None
+
+    def put(self, user, crm_id, correlation_id=None):
+        self.saved.append(user["id"])
+
+
+class CountingRecipientResolver(rec.RecipientResolver):
+    """
+    Resolver looking recipients up in USERS instead of calling core
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(directory=EmptyDirectory(), **kwargs)
+        self.calls = list()
+
+    def _fetch_user(self, id_space, recipient_id, correlation_id):
+        self.calls.append(id_space)
+        assert recipient_id in USERS[id_space], "User not found"
+        return USERS[id_space][recipient_id]
+
+
+class TestRecipientResolver(test_tools.BaseTestCase):
+    def test_01_repeat_recipients_cost_no_core_calls(self):
+        resolver = CountingRecipientResolver()
+        for _ in range(3):
+            self.assertEqual(TEST_USER, resolver.resolve(TEST_USER["id"]))
+        self.assertEqual([rec.USER_ID], resolver.calls)
+        self.assertEqual([TEST_USER["id"]], resolver.directory.saved)
+
+    def test_02_anon_ids_cost_one_call_if_id_space_is_given_or_known(self):
+        resolver = CountingRecipientResolver()
+        resolver.resolve(ANON_ID, id_space=rec.ANON_PROJECT_SPECIFIC_USER_ID)
+        self.assertEqual([rec.ANON_PROJECT_SPECIFIC_USER_ID], resolver.calls)
+        self.assertEqual(list(), resolver.directory.looked_up)
+
+        resolver = CountingRecipientResolver(ttl=0)
+        resolver.resolve(ANON_ID)
+        resolver.resolve(ANON_ID)
+        self.assertEqual(
+            [
+                rec.USER_ID,
+                rec.ANON_PROJECT_SPECIFIC_USER_ID,
+                rec.ANON_PROJECT_SPECIFIC_USER_ID,
+            ],
+            resolver.calls,
+        )
+
+    def test_03_unknown_ids_are_cached_briefly(self):
+        resolver = CountingRecipientResolver()
+        for _ in range(2):
+            with self.assertRaises(ObjectDoesNotExistError):
+                resolver.resolve("unknown-id")
+        self.assertEqual(2, len(resolver.calls))
+
+        resolver = CountingRecipientResolver(not_found_ttl=0)
+        for _ in range(2):
+            with self.assertRaises(ObjectDoesNotExistError):
+                resolver.resolve("unknown-id")
+        self.assertEqual(4, len(resolver.calls))
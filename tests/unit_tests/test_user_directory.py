@@ -0,0 +1,83 @@
+#
+#   Thiscovery API - THIS Institute’s citizen science platform
+#   Copyright (C) 2019 THIS Institute
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU Affero General Public License as
+#   published by the Free Software Foundation, either version 3 of the
+#   License, or (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+#
+#   A copy of the GNU Affero General Public License is available in the
+#   docs folder of this project.  It is also available www.gnu.org/licenses/
+#
+from datetime import timedelta
+
+import thiscovery_dev_tools.testing_tools as test_tools
+import thiscovery_lib.utilities as utils
+from thiscovery_lib.dynamodb_utilities import Dynamodb
+
+import src.common.constants as const
+import src.common.user_directory as ud
+
+
+TEST_USER = {
+    "id": "35224bd5-f8a8-41f6-8502-f96e12d6ddde",
+    "email": "delia@email.co.uk",
+    "first_name": "Delia",
+    "last_name": "Davies",
+}
+
+
+class TestUserDirectory(test_tools.BaseTestCase):
+    def setUp(self):
+        self.ddb_client = Dynamodb(stack_name=const.STACK_NAME)
+        self.ddb_key = f"{ud.USER_DIRECTORY_KEY_PREFIX}{TEST_USER['id']}"
+        self.ddb_client.delete_item(ud.LOOKUPS_TABLE_NAME, self.ddb_key)
+        self.directory = ud.UserDirectory(stack_name=const.STACK_NAME)
+
+    def tearDown(self):
+        self.ddb_client.delete_item(ud.LOOKUPS_TABLE_NAME, self.ddb_key)
+
+    def test_01_saved_users_are_read_back_from_lookups_table(self):
+        self.assertIsNone(self.directory.get(TEST_USER["id"]))
+        self.directory.put(TEST_USER, 1234)
+        # a new directory has an empty in-memory map
+        entry = ud.UserDirectory(stack_name=const.STACK_NAME).get(TEST_USER["id"])
+        self.assertEqual("1234", entry["crm_id"])
+        self.assertEqual(TEST_USER["email"], entry["email"])
+
+    def test_02_missing_users_are_remembered_until_cleared(self):
+        self.assertIsNone(self.directory.get(TEST_USER["id"]))
+        ud.UserDirectory(stack_name=const.STACK_NAME).put(TEST_USER, 1234)
+        self.assertIsNone(self.directory.get(TEST_USER["id"]))
+        self.directory.clear()
+        self.assertEqual("1234", self.directory.get(TEST_USER["id"])["crm_id"])
+
+    def test_03_old_entries_are_ignored_if_max_age_is_set(self):
+        self.directory.put(TEST_USER, 1234)
+        self.directory._users.get(TEST_USER["id"])["updated"] = str(
+            utils.now_with_tz() - timedelta(seconds=ud.USER_DETAILS_MAX_AGE_SECONDS + 1)
+        )
+        self.assertIsNone(
+            self.directory.get(
+                TEST_USER["id"], max_age=ud.USER_DETAILS_MAX_AGE_SECONDS
+            )
+        )
+        self.assertEqual("1234", self.directory.get(TEST_USER["id"])["crm_id"])
+
+    def test_04_missing_users_are_looked_up_again_after_not_found_ttl(self):
+        directory = ud.UserDirectory(stack_name=const.STACK_NAME, not_found_ttl=0)
+        self.assertIsNone(directory.get(TEST_USER["id"]))
+        ud.UserDirectory(stack_name=const.STACK_NAME).put(TEST_USER, 1234)
+        self.assertEqual("1234", directory.get(TEST_USER["id"])["crm_id"])
+
+    def test_05_in_memory_copy_is_bounded(self):
+        directory = ud.UserDirectory(stack_name=const.STACK_NAME, maxsize=2)
+        for i in range(5):
+            directory.get(f"{TEST_USER['id']}-{i}")
+        self.assertEqual(2, len(directory._users))